@@ -12,6 +12,7 @@ from solute.epfl.jinja import jinja_helpers
 from zope.interface import Interface
 
 from solute.epfl.core import (epfltransaction,
+                              epfltransactionstore,
                               epflutil,
                               epflpage,
                               epfltempdata,
@@ -25,6 +26,7 @@ from solute.epfl.core import (epfltransaction,
 from webassets import Bundle
 from webassets import Environment
 
+from pyramid.events import ApplicationCreated
 from pyramid.path import AssetResolver
 from pyramid.settings import asbool
 
@@ -152,6 +154,10 @@ def set_nodeglobaldata_provider(config, nodeglobaldata_provider):
     config.registry.registerUtility(nodeglobaldata_provider, epfltempdata.INodeGlobalDataProvider)
 
 
+def set_transaction_store(config, transaction_store):
+    config.registry.registerUtility(transaction_store, epfltransactionstore.ITransactionStore)
+
+
 def extract_static_assets_from_components(compo_list):
     ar = AssetResolver()
 
@@ -250,6 +256,7 @@ def includeme(config):
 
     config.add_directive("set_tempdata_provider", set_tempdata_provider)
     config.add_directive("set_nodeglobaldata_provider", set_nodeglobaldata_provider)
+    config.add_directive("set_transaction_store", set_transaction_store)
     config.add_directive("add_epfl_model", epflmodel.add_epfl_model)
     config.add_directive("set_timezone_provider", epfli18n.set_timezone_provider)
 
@@ -262,6 +269,14 @@ def includeme(config):
 
     config.set_root_factory(epflacl.DefaultACLRootFactory)
 
+    # Views registered after the route index has been used are only known to it once it is rebuilt.
+    config.add_subscriber(epflutil.clear_route_index, ApplicationCreated)
+    config.add_subscriber(epflassets.clear_nav_cache, ApplicationCreated)
+
+    # The transaction store is selected once, if it is not configured here it will be on first use.
+    if config.get_settings().get('epfl.transaction.store'):
+        set_transaction_store(config, epfltransactionstore.create_transaction_store(config.get_settings()))
+
     epflassets.EPFLView.configure(config)
 
     epflutil.Discover()
@@ -158,13 +158,14 @@ class Link(ComponentBase):
         """
         if not self.container_compo:
             return True
-        siblings = self.container_compo.components
-        position = siblings.index(self)
+        compo_struct = self.container_compo.compo_struct
+        position = compo_struct.index(self.cid)
         if position == 0:
             return True
 
-        for i in range(0, position):
-            if siblings[i].slot == self.slot:
+        # Only the compo_info of the siblings is needed, so they do not have to be instantiated.
+        for cid in compo_struct[:position]:
+            if self.page.transaction.get_component(cid).get('slot') == self.slot:
                 return False
 
         return True
@@ -1,4 +1,7 @@
 from pyramid import security
+from pyramid.authorization import ACLAuthorizationPolicy
+from pyramid.interfaces import IAuthenticationPolicy, IAuthorizationPolicy
+from pyramid.location import lineage
 from functools import wraps
 
 
@@ -70,6 +73,66 @@ def epfl_acl(permissions, default_allow=True, default_principal='system.Everyone
     return wrapper
 
 
+def get_acl_key(context):
+    """Return a hashable representation of the acls of the lineage of context, as evaluated by the
+    :class:`pyramid.authorization.ACLAuthorizationPolicy`.
+    """
+    key = []
+    for location in lineage(context):
+        try:
+            acl = location.__acl__
+        except AttributeError:
+            continue
+        if callable(acl):
+            acl = acl()
+        key.append(tuple((action, principal, tuple(permissions) if isinstance(permissions, (list, tuple, set))
+                          else permissions) for action, principal, permissions in acl))
+    return tuple(key)
+
+
+def has_permission(permission, context, request):
+    """Same as :meth:`pyramid.request.Request.has_permission`, but the decisions of an ACLAuthorizationPolicy are cached
+    for the request by permission, acls and principals. Equal acls are thus evaluated once per request, no matter how
+    many components use them. Use :func:`clear_permission_cache` if the principals change during a request.
+    """
+    cache = get_permission_cache(request)
+    if cache is None:
+        return request.has_permission(permission, context)
+
+    authz_policy = request.registry.queryUtility(IAuthorizationPolicy)
+    try:
+        key = permission, get_acl_key(context), cache['principals']
+        result = cache.get(key)
+    except TypeError:
+        # Acls containing unhashable entries are not cached.
+        return authz_policy.permits(context, cache['principals'], permission)
+    if result is None:
+        result = cache[key] = authz_policy.permits(context, cache['principals'], permission)
+    return result
+
+
+def get_permission_cache(request):
+    """Return the cache of :func:`has_permission` for the request, holding the effective principals of the request as
+    principals. Returns None if the authorization policy is not an ACLAuthorizationPolicy.
+    """
+    cache = getattr(request, '__epfl_permission_cache', None)
+    if cache is not None:
+        return cache
+
+    registry = request.registry
+    authn_policy = registry.queryUtility(IAuthenticationPolicy)
+    if authn_policy is None or type(registry.queryUtility(IAuthorizationPolicy)) is not ACLAuthorizationPolicy:
+        return None
+    cache = {'principals': tuple(authn_policy.effective_principals(request))}
+    setattr(request, '__epfl_permission_cache', cache)
+    return cache
+
+
+def clear_permission_cache(request):
+    """Drop the decisions cached by :func:`has_permission` for the request."""
+    setattr(request, '__epfl_permission_cache', None)
+
+
 def epfl_has_permission(permission, fail_callback=None, obj=None, use_global_acl=False):
     def wrapper(func):
         @wraps(func)
@@ -79,7 +142,7 @@ def epfl_has_permission(permission, fail_callback=None, obj=None, use_global_acl
             if use_global_acl:
                 target = DefaultACLRootFactory
             _request = self.request
-            if not _request.has_permission(permission, target):
+            if not has_permission(permission, target, _request):
                 if fail_callback:
                     return fail_callback(*args, **kwargs)
                 return
@@ -88,7 +151,7 @@ def epfl_has_permission(permission, fail_callback=None, obj=None, use_global_acl
         return wrap
 
     if obj:
-        return obj.request.has_permission(permission, obj)
+        return has_permission(permission, obj, obj.request)
 
     return wrapper
 
@@ -99,7 +162,7 @@ def epfl_has_role(role, fail_callback=None):
         def wrap(*args, **kwargs):
             self = args[0]
             request = self.request
-            if not request.has_permission('has_role', ACL([(security.Allow, role, 'has_role')])):
+            if not has_permission('has_role', ACL([(security.Allow, role, 'has_role')]), request):
                 if fail_callback:
                     return fail_callback(*args, **kwargs)
                 return
@@ -111,7 +174,7 @@ def epfl_has_role(role, fail_callback=None):
 
 
 def epfl_check_role(role, request):
-    if request.has_permission('has_role', ACL([(security.Allow, role, 'has_role')])):
+    if has_permission('has_role', ACL([(security.Allow, role, 'has_role')]), request):
         return True
     else:
         return False
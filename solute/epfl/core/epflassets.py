@@ -1,12 +1,15 @@
 from pyramid.view import view_config
 from pyramid import security
 from pyramid.settings import aslist
+from zope.interface import Interface
 
 from functools import wraps
+from collections import OrderedDict
+import threading
 from solute.epfl.components import GroupedLinkListLayout
 from solute.epfl.core import epflutil
 
-from epflacl import epfl_acl, ACL
+from epflacl import epfl_acl, ACL, get_permission_cache
 
 
 def get_item_or_attr(obj, key):
@@ -115,6 +118,10 @@ class EPFLView(object):
     def add_link(self):
         if not self.route_text:
             return
+        if self.config is not None:
+            nav_cache = self.config.registry.queryUtility(INavCache)
+            if nav_cache is not None:
+                nav_cache.clear()
         self.counter['id'] += 1
         self.register.append({'id': self.counter['id'],
                               'route': self.route_url,
@@ -178,5 +185,81 @@ class EPFLView(object):
         EPFLView.acl.extend(acl.__acl__)
 
 
+class INavCache(Interface):
+    """ Marker for the :class:`NavCache` registered as utility, see :func:`get_nav_cache`.
+    """
+
+
+class NavCache(object):
+    """
+    The link lists of :class:`EPFLViewLinks` visible to a set of principals, kept per registry and bounded to
+    :attr:`size` entries, dropping the least recently used one first.
+    """
+
+    #: Number of link lists kept.
+    size = 1024
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            links = self.entries.pop(key, None)
+            if links is not None:
+                self.entries[key] = links
+        return links
+
+    def set(self, key, links):
+        with self.lock:
+            self.entries[key] = links
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def get_nav_cache(registry):
+    """
+    Return the :class:`NavCache` of the registry, creating it on first use.
+    """
+    nav_cache = registry.queryUtility(INavCache)
+    if nav_cache is None:
+        nav_cache = NavCache()
+        registry.registerUtility(nav_cache, INavCache)
+    return nav_cache
+
+
+def clear_nav_cache(event):
+    """
+    Subscriber for :class:`pyramid.events.ApplicationCreated` dropping the cached link lists, since the permissions of
+    the routes may have changed with the configuration.
+    """
+    nav_cache = event.app.registry.queryUtility(INavCache)
+    if nav_cache is not None:
+        nav_cache.clear()
+
+
 class EPFLViewLinks(GroupedLinkListLayout):
-    pass
+
+    def get_data(self, row_offset=None, row_limit=None, row_data=None):
+        """The links visible to a set of principals only change with the configuration, so they are cached in the
+        :class:`NavCache` of the registry by the ids of the links and the effective principals of the request. Without
+        an ACLAuthorizationPolicy nothing is cached.
+        """
+        cache = get_permission_cache(self.request)
+        ids = tuple(link.get('id') for link in self.links or [])
+        if cache is None or None in ids:
+            return super(EPFLViewLinks, self).get_data(row_offset, row_limit, row_data)
+
+        nav_cache = get_nav_cache(self.request.registry)
+        key = ids, self.event_name, tuple(sorted(cache['principals']))
+        links = nav_cache.get(key)
+        if links is None:
+            links = super(EPFLViewLinks, self).get_data(row_offset, row_limit, row_data)
+            nav_cache.set(key, links)
+
+        # The entries are handed to the children, so every caller gets copies.
+        return [dict(link) for link in links]
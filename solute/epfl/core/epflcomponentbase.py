@@ -1,20 +1,90 @@
 # coding: utf-8
-from collections import MutableSequence, MutableMapping
+from collections import MutableSequence, MutableMapping, OrderedDict
+import cPickle as pickle
+import hashlib
+import threading
 import types
 import copy
 import inspect
 
-from pyramid import security
 import ujson as json
 import jinja2
 import jinja2.runtime
 from jinja2.exceptions import TemplateNotFound
 
 from solute.epfl.core import epflutil, epflacl, epflvalidators
-from solute.epfl.core.epfldescriptor import Descriptor, Reference, CompoStateAttribute
+from solute.epfl.core.epfldescriptor import Descriptor, Reference, CompoStateAttribute, CompoConfigAttribute
 from solute.epfl.core.epflutil import Lifecycle, generate_dynamic_class_id, generate_cid
 
 
+#: Number of dynamic component classes kept by :func:`get_dynamic_class`.
+DYNAMIC_CLASS_CACHE_SIZE = 4096
+#: Maps base classes and config fingerprints to dynamic component classes, least recently used first.
+dynamic_class_cache = OrderedDict()
+dynamic_class_cache_lock = threading.Lock()
+
+
+#: Config entries defining the component class itself, they are always set on the dynamic class.
+DYNAMIC_CLASS_CONFIG = ('compo_state', 'compo_config')
+
+
+#: Types of config values that may be shared by all components using the same dynamic class.
+SHARED_CONFIG_TYPES = (type(None), bool, int, long, float, complex, str, unicode, type, types.ClassType,
+                       types.FunctionType, types.BuiltinFunctionType, Descriptor)
+
+
+def is_shared_config_value(value):
+    """Return True if value may be shared by all components using the same dynamic class. Only immutable builtins,
+    classes, functions and descriptors are shared, all other values are kept by every component instead. Descriptors
+    are shared, they only work as class attributes.
+    """
+    if isinstance(value, (tuple, frozenset)):
+        return all(is_shared_config_value(item) for item in value)
+    return isinstance(value, SHARED_CONFIG_TYPES)
+
+
+def get_dynamic_class(cls, config):
+    """Return a subclass of cls with the entries of config as class attributes. Classes are cached by their base class
+    and a fingerprint of their config, so a component instantiated on every request reuses the same class. The cache is
+    bounded by :data:`DYNAMIC_CLASS_CACHE_SIZE`. Configs that can not be pickled get a new class every time.
+
+    Only values passing :func:`is_shared_config_value` become class attributes of a cached class. The keys of all other
+    values are listed in its _instance_config, components take them from their own config instead.
+
+    :param cls: :class:`ComponentBase` subclass.
+    :param config: dict of class attributes.
+    """
+    shared_config = {}
+    instance_config = []
+    for key, value in config.iteritems():
+        if key in DYNAMIC_CLASS_CONFIG or is_shared_config_value(value):
+            shared_config[key] = value
+        else:
+            instance_config.append(key)
+    shared_config['_instance_config'] = frozenset(instance_config)
+
+    try:
+        blob = pickle.dumps(sorted(shared_config.iteritems()), pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        blob = None
+
+    if blob is None:
+        name = cls.__name__ + '_auto_' + generate_dynamic_class_id()
+        return type(name, (cls, ), config)
+
+    key = cls, hashlib.sha1(blob).digest()
+    with dynamic_class_cache_lock:
+        dynamic_cls = dynamic_class_cache.pop(key, None)
+        if dynamic_cls is None:
+            name = cls.__name__ + '_auto_' + generate_dynamic_class_id()
+            dynamic_cls = type(name, (cls, ), shared_config)
+            setattr(dynamic_cls, '__epfl_do_not_track', True)
+        dynamic_class_cache[key] = dynamic_cls
+        while len(dynamic_class_cache) > DYNAMIC_CLASS_CACHE_SIZE:
+            dynamic_class_cache.popitem(last=False)
+    return dynamic_cls
+
+
 class MissingContainerComponentException(Exception):
     pass
 
@@ -144,6 +214,9 @@ class UnboundComponent(object):
     instantiated component if it is called with an :class:`.UnboundComponent`.
     """
     __dynamic_class_store__ = None  #: Internal caching for :attr:`UnboundComponent.__dynamic_class__`
+    #: True if this component is created from the default_child_cls of its container. Its config is then stored as
+    #: delta to the config of its siblings, see :meth:`.Transaction.get_config_delta`.
+    __template_child__ = False
 
     def __init__(self, cls, config):
         """
@@ -177,16 +250,26 @@ class UnboundComponent(object):
         else:
             if 'config' in kwargs:
                 kwargs.update(kwargs.pop('config'))
-            self.__unbound_config__.update(kwargs)
-            self.__dynamic_class_store__ = None
+            # Configs stored in the transaction are usually passed unchanged, so the dynamic class is kept.
+            unbound_config = self.__unbound_config__
+            if any(key not in unbound_config or unbound_config[key] is not value for key, value in kwargs.iteritems()):
+                unbound_config.update(kwargs)
+                self.__dynamic_class_store__ = None
             kwargs['__instantiate__'] = True
 
         cls = self.__dynamic_class__
-        return cls(*args, **kwargs)
+        for key in cls._instance_config:
+            kwargs.setdefault(key, self.__unbound_config__[key])
+        compo_obj = cls(*args, **kwargs)
+        if cls is not self.__unbound_cls__:
+            # Dynamic classes are shared, so the reference to this UnboundComponent is kept by the instance.
+            compo_obj.___unbound_component__ = self
+        return compo_obj
 
     @classmethod
     def create_from_state(cls, state):
-        ubc = cls(None, {})
+        # The state provides the config and position, so neither a copy nor a cid is generated as in __init__.
+        ubc = cls.__new__(cls)
         ubc.__setstate__(state)
         return ubc
 
@@ -202,29 +285,48 @@ class UnboundComponent(object):
         stripped_conf = self.__unbound_config__.copy()
         stripped_conf.pop('cid', None)
         stripped_conf.pop('slot', None)
+        # The generated cid only matters to the UnboundComponent, keeping it would prevent sharing the class.
+        stripped_conf.pop('__autogen_cid__', None)
         if len(stripped_conf) > 0:
-            name = self.__unbound_cls__.__name__ + '_auto_' + generate_dynamic_class_id()
-            self.__dynamic_class_store__ = type(name, (self.__unbound_cls__, ), self.__unbound_config__)
-
-            setattr(self.__dynamic_class_store__, '___unbound_component__', self)
-            setattr(self.__dynamic_class_store__, '__epfl_do_not_track', True)
-
+            self.__dynamic_class_store__ = get_dynamic_class(self.__unbound_cls__, stripped_conf)
             return self.__dynamic_class_store__
 
         else:
             return self.__unbound_cls__
 
-    def register_in_transaction(self, container, slot=None, position=None):
+    def get_compo_info(self, container, slot=None):
+        """Return the transaction entry of this component as child of container."""
         compo_info = {'class': self.__getstate__(),
                       'config': self.__unbound_config__,
                       'ccid': container.cid,
                       'cid': self.position[0],
                       'slot': slot}
+
+        # Children created from the default_child_cls of their container only store the config that differs from the
+        # config of their siblings.
+        if self.__template_child__:
+            delta = container.page.transaction.get_config_delta(container.cid, self.__unbound_cls__,
+                                                                self.__unbound_config__)
+            if delta is not None:
+                compo_info['class'] = self.__unbound_cls__, delta, self.position
+                compo_info['config'] = delta
+                compo_info['template_cid'] = container.cid
+        return compo_info
+
+    def register_in_transaction(self, container, slot=None, position=None, instantiate=True):
+        """Create the transaction entry of this component as child of container. Returns the instantiated component, or
+        only its cid if instantiate is False.
+        """
+        compo_info = self.get_compo_info(container, slot)
         try:
             container.page.transaction.set_component(self.position[0], compo_info, position=position)
         except Exception:
             if self.position[0] == self.__unbound_config__.get('__autogen_cid__'):
-                return self(cid=None).register_in_transaction(container, slot, position)
+                ubc = self(cid=None)
+                ubc.__template_child__ = self.__template_child__
+                return ubc.register_in_transaction(container, slot, position, instantiate)
+        if not instantiate:
+            return self.position[0]
         return container.page.transaction.get_component_instance(container.page, self.position[0])
 
     def __getstate__(self):
@@ -307,7 +409,8 @@ class ComponentBase(object):
     css_name = []  #: List of css files to be statically loaded with this component.
     css_name_no_bundle = []  #: List of css files to be statically loaded with this component but never in a bundle.
     compo_state = []  #: List of object attributes to be persisted into the :class:`.epfltransaction.Transaction`.
-    compo_config = []  #: List of attributes to be copied into instance-variables using :func:`copy.deepcopy`.
+    #: List of attributes to be copied into instance-variables using :func:`copy.copy` on first access.
+    compo_config = []
 
     #: Flag this component as event sink, any event will stop here if True. If no handler is found it is discarded.
     event_sink = False
@@ -329,6 +432,9 @@ class ComponentBase(object):
     redraw_requested = False  #: Flag if this component wants to be redrawn.
 
     _compo_info = None  #: Compo_info cache.
+    _state_cache = None  #: Cache of the hashable compo_state values read by this instance, see :meth:`get_state_attr`.
+    #: Config keys kept by the instances of a dynamic class instead of the class, see :func:`get_dynamic_class`.
+    _instance_config = frozenset()
     _handles = None  #: Cache for a list of handle_event functions this component provides.
     combined_compo_state = frozenset()  #: The combined compo_state + base_compo_state
     deleted = False  #: Flag if this component has been deleted this request.
@@ -398,14 +504,12 @@ class ComponentBase(object):
         self.page, self.cid = args[:2]
 
         self.__config = config
+        self._state_cache = {}
 
-        for attr_name in self.compo_config:
-            if attr_name in config:
-                config_value = config[attr_name]
-            else:
-                config_value = getattr(self, attr_name)
-
-            setattr(self, attr_name, copy.copy(config_value))  # copy from class to instance
+        for key in cls._instance_config:
+            # Compo state and config attributes read their value from the config on first access.
+            if key in config and key not in cls.combined_compo_state and key not in cls.compo_config:
+                self.__dict__[key] = config[key]
 
         return self
 
@@ -418,13 +522,23 @@ class ComponentBase(object):
     def get_state_attr(self, key, value=None):
         """Get the attribute as stored in the compo_state or return the original value. If the original value is not
         hashable - as all mutable builtins are - a copy is generated in the compo state.
+
+        Hashable values are cached until they are set again by :meth:`set_state_attr`, so only the first read of an
+        attribute by this instance, usually living for a single request, has to look them up.
         """
         try:
             result = self.compo_info['compo_state'][key]
             if isinstance(result, Descriptor):
                 return result.__get__(self, self.__class__)
-            return result
+            try:
+                hash(result)
+            except TypeError:
+                # Mutable values may be changed in place by the caller, so the entry is considered changed.
+                self.page.transaction.set_component_dirty(self.cid)
+                return result
         except KeyError:
+            if key in self._instance_config:
+                value = self.__config.get(key, value)
             if isinstance(value, Descriptor):
                 return value.__get__(self, self.__class__)
             try:
@@ -433,13 +547,34 @@ class ComponentBase(object):
                 # Only the immutable builtins are hashable, mutable builtins are not and cause a TypeError.
                 setattr(self, key, copy.deepcopy(value))
                 return getattr(self, key, value)
-            return value
+            result = value
+
+        # Values are only cached once the entry of this component exists, it may provide a different value otherwise.
+        if self._compo_info is not None and self._state_cache is not None:
+            self._state_cache[key] = result
+        return result
+
+    def get_config_attr(self, key, value=None):
+        """Get a copy of the attribute as given by the config of this instance or of the original value. The copy is
+        stored in the instance, so the config and class attributes are shared until a component accesses it.
+        """
+        result = copy.copy(self.__config.get(key, value))
+        self.__dict__[key] = result
+        return result
 
     def set_state_attr(self, key, value):
+        if self._state_cache:
+            self._state_cache.pop(key, None)
         if isinstance(self.compo_info.setdefault('compo_state', {}).get(key), Descriptor):
             self.compo_info['compo_state'][key].__set__(self, value)
         else:
             self.compo_info.setdefault('compo_state', {})[key] = value
+        self.page.transaction.set_component_dirty(self.cid)
+
+    @property
+    def window_components(self):
+        """The child components to be rendered, see :attr:`ComponentContainerBase.window_components`."""
+        return self.components
 
     @property
     def reflect(self):
@@ -489,6 +624,7 @@ class ComponentBase(object):
     @container_slot.setter
     def container_slot(self, value):
         self.compo_info['slot'] = value
+        self.page.transaction.set_component_dirty(self.cid)
 
     @property
     def container_compo(self):
@@ -501,6 +637,8 @@ class ComponentBase(object):
     @container_compo.setter
     def container_compo(self, value):
         self.compo_info['ccid'] = value.cid
+        self.page.transaction.set_component_parent(self.cid, value.cid)
+        self.page.transaction.set_component_dirty(self.cid)
 
     def get_component_info(self):
         info = {"class": self.__unbound_component__.__getstate__(),
@@ -536,6 +674,7 @@ class ComponentBase(object):
         self.add_js_response('epfl.destroy_component("{cid}");'.format(cid=self.cid))
 
         self.page.transaction['__initialized_components__'].remove(self.cid)
+        self.page.transaction.set_dirty('__initialized_components__')
 
     @Lifecycle(name=('component', 'finalize'))
     def finalize(self):
@@ -549,7 +688,7 @@ class ComponentBase(object):
         Normally called by a condition in the jinja-template.
         """
         if self._access is None:
-            self._access = security.has_permission("access", self, self.page.request)
+            self._access = epflacl.has_permission("access", self, self.page.request)
 
         return self._access
 
@@ -752,10 +891,11 @@ class ComponentBase(object):
 
     def reset_render_cache(self, recursive=False):
         self.render_cache = None
-        if recursive and self.components:
-            for compo in self.components:
+        if recursive and self.window_components:
+            for compo in self.window_components:
                 compo.reset_render_cache(recursive=recursive)
 
+    @Lifecycle(name=('component', 'render'), trace_only=True)
     def render(self, target='main'):
         """Called to render this component including all potential sub components.
 
@@ -782,8 +922,8 @@ class ComponentBase(object):
             self.render_cache['main'] = jinja2.Markup("<div epflid='{cid}'></div>".format(cid=self.cid))
             return self.render_cache[target]
 
-        if self.components:
-            js_raw = [compo.render(target='js_raw') for compo in self.components]
+        if self.window_components:
+            js_raw = [compo.render(target='js_raw') for compo in self.window_components]
         else:
             js_raw = []
 
@@ -819,6 +959,13 @@ class ComponentBase(object):
                     and not isinstance(original, types.MethodType):
                 setattr(cls, name, CompoStateAttribute(original, name))
 
+        for name in set(cls.compo_config).difference(cls.combined_compo_state):
+            # The descriptor is placed on the class defining the attribute, which may not have been discovered itself.
+            owner = next((klass for klass in cls.__mro__ if name in klass.__dict__), None)
+            original = owner.__dict__[name] if owner else None
+            if owner and not isinstance(original, (CompoConfigAttribute, types.FunctionType, property)):
+                setattr(owner, name, CompoConfigAttribute(original, name))
+
         if not cls.template_name:
             raise Exception("You did not setup the 'self.template_name' in " + repr(cls))
 
@@ -1073,7 +1220,7 @@ class ComponentContainerBase(ComponentBase):
     node_list = []
 
     compo_config = ['node_list']
-    compo_state = ['row_offset', 'row_limit', 'row_count', 'row_data']
+    compo_state = ['row_offset', 'row_limit', 'row_count', 'row_data', 'data_inputs']
 
     default_child_cls = None
     data_interface = {'id': None}
@@ -1087,6 +1234,20 @@ class ComponentContainerBase(ComponentBase):
     auto_update_children = True
     #: Update is triggered initially in :meth:`init_transaction` if True
     auto_initialize_children = True
+    #: If True the updates triggered in after_event_handling are skipped as long as row_offset, row_limit and row_data
+    #: did not change since the last call of :meth:`get_data` and :meth:`invalidate` has not been called. Only to be
+    #: used by components whose get_data does not depend on anything else.
+    lazy_update_children = False
+    #: The row_offset, row_limit and row_data of the last call of get_data, used by :attr:`lazy_update_children`.
+    data_inputs = None
+
+    #: Opt-in for containers with many children following the :meth:`get_data` pattern. If True :meth:`get_data` is
+    #: called with a row_offset of 0 and a row_limit of None and has to return all rows, but only the window of
+    #: :attr:`row_limit` children starting at :attr:`row_offset` is instantiated and rendered. All other children only
+    #: exist as entries in the transaction until the window is moved onto them by a set_row event, as sent by
+    #: paginated and infinite scrolling lists. :attr:`row_count` is set to the number of rows. The window is rendered
+    #: from :attr:`window_components`, :attr:`components` covers all children and instantiates them on access.
+    virtual_window = False
 
     #: True if update children has been called at least once. Will be used for duplicate call prevention.
     __update_children_done__ = False
@@ -1149,8 +1310,24 @@ class ComponentContainerBase(ComponentBase):
         the :meth:`get_data` pattern.
         """
         super(ComponentContainerBase, self).after_event_handling()
-        if self.auto_update_children:
-            self.update_children(force=True)
+        if not self.auto_update_children:
+            return
+        if self.lazy_update_children and self.data_inputs is not None \
+                and self.data_inputs == self.get_data_inputs():
+            return
+        self.update_children(force=True)
+
+    def get_data_inputs(self):
+        """Return the parameters :meth:`get_data` is called with by :meth:`update_children`."""
+        if self.virtual_window:
+            return [0, None, self.row_data]
+        return [self.row_offset, self.row_limit, self.row_data]
+
+    def invalidate(self):
+        """Make sure :meth:`update_children` is called in after_event_handling of this request even if
+        :attr:`lazy_update_children` is set. To be called whenever the data returned by get_data has changed.
+        """
+        self.data_inputs = None
 
     def is_smart(self):
         """Returns true if component uses get_data scheme."""
@@ -1160,9 +1337,99 @@ class ComponentContainerBase(ComponentBase):
     def sleeping_children(self):
         return self.compo_info.get('sleeping_compo_struct', {})
 
+    def get_window(self):
+        """Return the start and end position of the children accessible as :attr:`window_components`, see
+        :attr:`virtual_window`. Without a :attr:`row_limit` all children are part of the window.
+        """
+        length = len(self.compo_struct)
+        if not self.virtual_window or self.row_limit is None:
+            return 0, length
+        start = min(self.row_offset or 0, length)
+        return start, min(start + self.row_limit, length)
+
+    def in_window(self, position):
+        """Return True if a child at the given position will be part of the window, see :attr:`virtual_window`."""
+        if not self.virtual_window or self.row_limit is None:
+            return True
+        start = self.row_offset or 0
+        return start <= position < start + self.row_limit
+
+    @property
+    def window_components(self):
+        """The child components to be rendered. For a container with a :attr:`virtual_window` only the children inside
+        the window are covered, while :attr:`components` covers all of them.
+        """
+        if self.virtual_window and self.components is not None:
+            return ComponentList(self, windowed=True)
+        return self.components
+
+    def materialize_child(self, compo_obj):
+        """Complete the initialisation of a child created outside of the window once it is accessed, see
+        :attr:`virtual_window`.
+        """
+        initialized_components = self.page.transaction['__initialized_components__']
+        if compo_obj.cid not in initialized_components:
+            compo_obj.init_transaction()
+            initialized_components.add(compo_obj.cid)
+            self.page.transaction.set_dirty('__initialized_components__')
+        return compo_obj
+
+    def get_child_data_ids(self, data_index=None):
+        """Return a list of the cids and data ids of all children without instantiating them. Children not created from
+        data get a data id of None.
+
+        The ids are taken from the data_index kept by :meth:`update_children`, so the transaction entries of the children
+        are not loaded. Only containers without a data_index yet read them from the transaction entries.
+        """
+        if data_index is None:
+            data_index = self.compo_info.get('data_index')
+        if data_index is not None:
+            return [(cid, data_index[cid][0] if cid in data_index else None) for cid in self.compo_struct]
+
+        transaction = self.page.transaction
+        transaction.prefetch_components(self.compo_struct)
+        child_data_ids = []
+        for cid in self.compo_struct:
+            compo_state = transaction.get_component(cid).get('compo_state', {})
+            child_data_ids.append((cid, compo_state.get('id', transaction.get_component_config(cid).get('id'))))
+        return child_data_ids
+
+    def get_row_fingerprint(self, row):
+        """Return a digest of a row returned by :meth:`get_data`, or None if it can not be computed."""
+        try:
+            return hashlib.sha1(pickle.dumps(sorted(row.iteritems()), pickle.HIGHEST_PROTOCOL)).digest()
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return None
+
+    def is_child_changed(self, cid, data):
+        """Return True if the transaction entry of a child differs from the given data, without instantiating it."""
+        transaction = self.page.transaction
+        config = transaction.get_component_config(cid)
+        compo_state = transaction.get_component(cid).get('compo_state', {})
+        for key, value in data.iteritems():
+            if key not in compo_state and key not in config:
+                return True
+            if compo_state.get(key, config.get(key)) != value:
+                return True
+        return False
+
+    def remove_child(self, cid):
+        """Delete a child that may not have been instantiated yet, see :attr:`virtual_window`."""
+        if cid in self.page.transaction['__initialized_components__']:
+            self.del_component(cid)
+        else:
+            self.page.transaction.del_component(cid)
+
     def update_children(self, force=False):
         """If a default_child_cls has been set this updates all child components to reflect the current state from
-        get_data(). Will raise an exception if called twice without the force parameter present."""
+        get_data(). Will raise an exception if called twice without the force parameter present.
+
+        The container keeps the data id and a fingerprint of the row of every child in the data_index of its compo_info,
+        so neither the ids nor unchanged rows require the children to be instantiated. Children are only updated if
+        their row changed since the last call.
+
+        With :attr:`virtual_window` set only the children inside the window are instantiated, children outside of it are
+        compared to the data using their transaction entries and recreated if they changed."""
 
         if self.__update_children_done__ and not force:
             raise Exception('update_children called twice without force parameter for component %s.' % self.cid)
@@ -1171,9 +1438,14 @@ class ComponentContainerBase(ComponentBase):
         if not self.is_smart():
             return
 
-        data = self._get_data(self.row_offset, self.row_limit, self.row_data)
+        data_inputs = self.get_data_inputs()
+        data = self._get_data(*data_inputs)
+        if self.lazy_update_children:
+            # row_data may be changed in place, so a copy is kept for comparison.
+            self.data_inputs = copy.deepcopy(data_inputs)
 
-        tipping_point = len([c for c in self.components if not hasattr(c, 'id')])
+        if self.virtual_window and self.row_count != len(data):
+            self.row_count = len(data)
 
         current_order = []
         new_order = []
@@ -1181,22 +1453,28 @@ class ComponentContainerBase(ComponentBase):
         data_dict = {}
         data_cid_dict = {}
         data_order_dict = {}
+        fingerprints = {}
+        data_index = self.compo_info.get('data_index')
 
         for i, d in enumerate(data):
             new_order.append(d['id'])
             data_order_dict[d['id']] = i
             data_dict[d['id']] = d
+            fingerprints[d['id']] = self.get_row_fingerprint(d)
 
         # IDs of components once represented in data and now active again. They are reactivated.
         for data_id in set(self.sleeping_children.keys()).intersection(new_order):
             self.page.transaction.wake_component_id(self.cid, data_id)
             self.redraw()
 
-        for v in self.components:
-            if getattr(v, 'id', None) is None:
+        child_data_ids = self.get_child_data_ids(data_index)
+        data_index = data_index or {}
+        tipping_point = len([cid for cid, data_id in child_data_ids if data_id is None])
+        for cid, data_id in child_data_ids:
+            if data_id is None:
                 continue
-            current_order.append(v.id)
-            data_cid_dict[v.id] = v.cid
+            current_order.append(data_id)
+            data_cid_dict[data_id] = cid
 
         # IDs of components no longer present in data. Their matching components are deleted.
         for data_id in set(current_order).difference(new_order):
@@ -1205,11 +1483,23 @@ class ComponentContainerBase(ComponentBase):
 
         # IDs of data represented by a component. Matching components are updated.
         for data_id in set(new_order).intersection(current_order):
+            # Rows unchanged since the last call are skipped.
+            fingerprint = data_index.get(data_cid_dict[data_id], (None, None))[1]
+            if fingerprint is not None and fingerprint == fingerprints[data_id]:
+                continue
+            # Children outside of the window are recreated from the data if it changed instead of being instantiated.
+            if not self.in_window(data_order_dict[data_id] + tipping_point):
+                if self.is_child_changed(data_cid_dict[data_id], data_dict[data_id]):
+                    self.remove_child(data_cid_dict.pop(data_id))
+                    current_order.remove(data_id)
+                continue
             compo = getattr(self.page, data_cid_dict[data_id])
+            if self.virtual_window:
+                self.materialize_child(compo)
             # A component may decide that it can not be updated by this mechanism. Relevant for components doing heavy
             # lifting in their :meth:`ComponentBase.init_transaction`.
             if compo.disable_auto_update:
-                self.del_component(data_cid_dict.pop(data_id))
+                self.remove_child(data_cid_dict.pop(data_id))
                 current_order.remove(data_id)
                 self.redraw()
                 continue
@@ -1218,30 +1508,43 @@ class ComponentContainerBase(ComponentBase):
                     setattr(compo, k, v)
                     compo.redraw()
 
-        compo_len = len(self.components)
-
-        # IDs of data not yet represented by a component. Matching components are created.
+        # IDs of data not yet represented by a component. Matching components are created in bulk and put into place
+        # when the order is rebuilt. Children outside of the window are not instantiated.
+        new_children, new_virtual_children = [], []
         for data_id in new_order:
             if data_id in current_order:
                 continue
-            position = data_order_dict[data_id]
-            if position > compo_len:
-                position = None
             if self.skip_child_access:
                 data_dict[data_id]['_access'] = True
             ubc = self.default_child_cls(**data_dict[data_id])
-            bc = self.add_component(ubc, position=position)
-            compo_len += 1
-            data_cid_dict[data_id] = bc.cid
+            ubc.__template_child__ = True
+            if self.in_window(data_order_dict[data_id] + tipping_point):
+                new_children.append((data_id, ubc))
+            else:
+                new_virtual_children.append((data_id, ubc))
 
+        new_cids = self.register_components([ubc for data_id, ubc in new_virtual_children])
+        new_cids += [compo_obj.cid for compo_obj in self.add_components([ubc for data_id, ubc in new_children])]
+        for (data_id, ubc), cid in zip(new_virtual_children + new_children, new_cids):
+            data_cid_dict[data_id] = cid
+        if new_children:
             self.redraw()
 
-        # Rebuild order.
-        for i, data_id in enumerate(new_order):
-            compo_cid = self.compo_info['compo_struct'][i + tipping_point]
-            if compo_cid != data_cid_dict[data_id]:
-                self.switch_component(self.cid, data_cid_dict[data_id], position=i + tipping_point)
-                self.redraw()
+        # Rebuild order, only moving the children not part of a longest increasing subsequence of current positions.
+        moved_cids = self.page.transaction.reorder_children(self.cid, [data_cid_dict[data_id] for data_id in new_order],
+                                                            offset=tipping_point)
+        # Children created in this call are rendered with the container, so they only need to be put into place.
+        new_cids = set(new_cids)
+        moved_cids = [cid for cid in moved_cids if cid not in new_cids]
+        if moved_cids:
+            if self.page.request.is_xhr:
+                self.add_js_response(''.join('epfl.switch_component("{cid}");'.format(cid=cid) for cid in moved_cids))
+            self.redraw()
+
+        data_index = dict((data_cid_dict[data_id], (data_id, fingerprints[data_id])) for data_id in new_order)
+        if data_index != self.compo_info.get('data_index'):
+            self.compo_info['data_index'] = data_index
+            self.page.transaction.set_component_dirty(self.cid)
 
     def _get_data(self, *args, **kwargs):
         """
@@ -1274,6 +1577,9 @@ class ComponentContainerBase(ComponentBase):
         Default handler to deal with setting row offset, limit and data parameters.
         """
         self.row_offset, self.row_limit, self.row_data = row_offset, row_limit, row_data
+        if self.virtual_window:
+            # Moving the window changes the rendered children even if the data stays the same.
+            self.redraw()
 
     def init_struct(self):
         """
@@ -1291,11 +1597,7 @@ class ComponentContainerBase(ComponentBase):
         super(ComponentContainerBase, self).init_transaction()
 
         self.node_list = self.init_struct() or self.node_list  # if init_struct returns None, keep original value.
-        for node in self.node_list:
-            cid, slot = node.position
-            self.add_component(node,
-                               slot=slot,
-                               cid=cid)
+        self.add_components(self.node_list)
 
         if self.auto_initialize_children:
             self.update_children(force=True)
@@ -1322,11 +1624,64 @@ class ComponentContainerBase(ComponentBase):
         # the transaction-setup has to be redone because the component can be displayed directly in this request.
         compo_obj.init_transaction()
         self.page.transaction['__initialized_components__'].add(cid)
+        self.page.transaction.set_dirty('__initialized_components__')
         if ('page', 'handle_transaction') not in Lifecycle.get_state():
             compo_obj.setup_component()
 
         return compo_obj
 
+    def register_components(self, compo_objs, position=None):
+        """Create the transaction entries of several unbound components as children of this container in a single step
+        without instantiating them. The components are inserted consecutively starting at position, or appended if
+        position is None. Returns the list of their cids.
+
+        As in :meth:`UnboundComponent.register_in_transaction` components with a known cid keep the existing entry,
+        unless the cid has been generated, in which case a new one is generated.
+        """
+        transaction = self.page.transaction
+        entries = []
+        cids = []
+        registered = set()
+        for compo_obj in compo_objs:
+            if not isinstance(compo_obj, UnboundComponent):
+                raise DeprecationWarning("Directly adding a component that was instantiated is no longer supported.")
+            cid, slot = compo_obj.position
+            if cid in registered or transaction.has_component(cid):
+                if cid != compo_obj.__unbound_config__.get('__autogen_cid__'):
+                    cids.append(cid)
+                    continue
+                template_child = compo_obj.__template_child__
+                compo_obj = compo_obj(cid=None)
+                compo_obj.__template_child__ = template_child
+                cid = compo_obj.position[0]
+            registered.add(cid)
+            cids.append(cid)
+            entries.append((cid, compo_obj.get_compo_info(self, slot)))
+
+        transaction.set_components(entries, position=position)
+        return cids
+
+    def add_components(self, compo_objs, position=None):
+        """Add several unbound components to this container, see :meth:`add_component`. Their transaction entries are
+        created in a single step before they are initialized in order. The components are inserted consecutively
+        starting at position, or appended if position is None. Returns the list of component instances.
+        """
+        transaction = self.page.transaction
+        compo_objs = [transaction.get_component_instance(self.page, cid)
+                      for cid in self.register_components(compo_objs, position=position)]
+
+        initialized_components = transaction['__initialized_components__']
+        setup = ('page', 'handle_transaction') not in Lifecycle.get_state()
+        for compo_obj in compo_objs:
+            compo_obj.init_transaction()
+            initialized_components.add(compo_obj.cid)
+            if setup:
+                compo_obj.setup_component()
+        if compo_objs:
+            transaction.set_dirty('__initialized_components__')
+
+        return compo_objs
+
     def setup_component_slots(self):
         """ Overwrite me. This method must initialize the slots that this
         container-component provides to accumulate components """
@@ -1348,11 +1703,16 @@ class ComponentContainerBase(ComponentBase):
 
 class ComponentList(MutableSequence):
     """
+    The child components of a container, instantiated on access. Slices and iteration instantiate the children of a
+    range in a single step, :attr:`cids` and :attr:`compo_infos` give read-only access without instantiating them.
 
+    A windowed list, as returned by :attr:`ComponentContainerBase.window_components`, only covers the children inside
+    the window of a container with a :attr:`~ComponentContainerBase.virtual_window`.
     """
 
-    def __init__(self, container_compo):
+    def __init__(self, container_compo, windowed=False):
         self.container_compo = container_compo
+        self.windowed = windowed
 
     def __setitem__(self, index, value):
         pass
@@ -1361,16 +1721,67 @@ class ComponentList(MutableSequence):
         pass
 
     def __len__(self):
+        if self.windowed:
+            start, end = self.container_compo.get_window()
+            return end - start
         return len(self.container_compo.compo_struct)
 
+    @property
+    def cids(self):
+        """List of the component ids of the child components."""
+        if self.windowed:
+            start, end = self.container_compo.get_window()
+            return self.container_compo.compo_struct[start:end]
+        return self.container_compo.compo_struct[:]
+
+    @property
+    def compo_infos(self):
+        """List of the transaction entries of the child components, loaded without instantiating them. Read-only."""
+        transaction = self.container_compo.page.transaction
+        cids = self.cids
+        transaction.prefetch_components(cids)
+        return [transaction.get_component(cid) for cid in cids]
+
+    def get_instances(self, cids):
+        """Return the child components of the given cids, instantiated in a single step."""
+        container_compo = self.container_compo
+        try:
+            compo_objs = container_compo.page.transaction.get_component_instances(container_compo.page, cids)
+        except Exception as e:
+            e.message += '\nParent cid was %s.' % container_compo.cid
+            raise e
+        if container_compo.virtual_window:
+            for compo_obj in compo_objs:
+                container_compo.materialize_child(compo_obj)
+        return compo_objs
+
+    def __iter__(self):
+        """Iterate over the child components, loading the entries of the ones not instantiated yet in a single step
+        beforehand. Children removed while iterating are skipped.
+        """
+        transaction = self.container_compo.page.transaction
+        cids = self.cids
+        transaction.prefetch_components([cid for cid in cids if cid not in transaction.instances])
+        for cid in cids:
+            if cid not in transaction.instances and not transaction.has_component(cid):
+                continue
+            yield self.get_instances([cid])[0]
+
     def __getitem__(self, index):
+        container_compo = self.container_compo
+        cids = self.cids if self.windowed else container_compo.compo_struct
+        if isinstance(index, slice):
+            return self.get_instances(cids[index])
         try:
-            return self.container_compo.page.transaction.get_component_instance(
-                self.container_compo.page,
-                self.container_compo.compo_struct[index]
+            compo_obj = container_compo.page.transaction.get_component_instance(
+                container_compo.page,
+                cids[index]
             )
+            if container_compo.virtual_window:
+                container_compo.materialize_child(compo_obj)
+            return compo_obj
         except Exception as e:
-            e.message += '\nParent cid was %s.' % self.container_compo.cid
+            e.message += '\nParent cid was %s.' % container_compo.cid
             raise e
 
     def __delitem__(self, index):
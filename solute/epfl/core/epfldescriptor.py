@@ -25,6 +25,8 @@ class Descriptor(object):
 
 
 class Reference(Descriptor):
+    tree_targets = ('container_compo', 'page')  #: Targets only depending on the component tree.
+
     def __init__(self, target=None, parent=None):
         self.target = target
         self.parent = parent
@@ -44,10 +46,11 @@ class Reference(Descriptor):
     def __getattr__(self, item):
         """This allows for free attribute names to be accessed, even chained, on a reflection. Only __value is a special
         case, since it not being present (thus being searched using this function) makes the AttributeError mandatory.
+        The same goes for special attributes, which pickle probes for.
         You may change this behavior in order to implement storage chains using :class:`Reference`.
         """
-        if item == '__value':
-            raise AttributeError()
+        if item == '__value' or item.startswith('__') and item.endswith('__'):
+            raise AttributeError(item)
         return Reference(item, self)
 
     def __get__(self, instance, owner):
@@ -56,14 +59,43 @@ class Reference(Descriptor):
 
         if hasattr(self, '__value'):
             return self.__value
-        if self.target == 'container_compo':
-            return self.parent.__get__(instance, owner).container_compo
-        if self.target == 'page':
-            return self.parent.__get__(instance, owner).page
+        if self.target in self.tree_targets:
+            return self.resolve(instance, owner)
         if self.target is not None:
-            return getattr(self.parent.__get__(instance, owner), self.target)
+            return getattr(self.parent.resolve(instance, owner), self.target)
         return instance
 
+    @property
+    def is_tree_reference(self):
+        """True if this reference only consists of :attr:`tree_targets`, so it points to the same object until the
+        component tree is changed.
+        """
+        reference = self
+        while reference.target is not None:
+            if reference.target not in self.tree_targets:
+                return False
+            reference = reference.parent
+        return True
+
+    def resolve(self, instance, owner):
+        """Resolve this reference on the given instance. Targets of references consisting only of
+        :attr:`tree_targets` are cached in the transaction, so a chain is walked once per request unless the component
+        tree is changed in between.
+        """
+        if self.target not in self.tree_targets:
+            return self.__get__(instance, owner)
+        transaction = getattr(getattr(instance, 'page', None), 'transaction', None)
+        if transaction is None:
+            return getattr(self.parent.resolve(instance, owner), self.target)
+        try:
+            return transaction.get_reference_target(instance.cid, self)
+        except KeyError:
+            pass
+        target = getattr(self.parent.resolve(instance, owner), self.target)
+        if self.is_tree_reference:
+            transaction.set_reference_target(instance.cid, self, target)
+        return target
+
     def __set__(self, instance, value):
         """Sets a shadow value to the private attribute __value. This method may be overwritten or expanded in order to
         implement storage chains.
@@ -117,9 +149,32 @@ class CompoStateAttribute(object):
         self.type = CompoStateAttribute
 
     def __get__(self, obj, cls):
-        if obj:
+        if obj is None:
+            return self
+        try:
+            return obj._state_cache[self.name]
+        except (KeyError, TypeError):
             return obj.get_state_attr(self.name, self.initial_value)
-        return self
 
     def __set__(self, obj, value):
         return obj.set_state_attr(self.name, value)
+
+
+class CompoConfigAttribute(object):
+    """Descriptor for component config attributes.
+    """
+
+    def __init__(self, initial_value=None, name='var'):
+        """Wrapper to copy the value of a compo config attribute into the instance on first access. Being a non data
+        descriptor, the copy in the instance shadows it afterwards. Accessed on the class the original value is returned.
+
+        :param initial_value: The initial value of this compo config attribute.
+        :param name: The name of this compo config attribute.
+        """
+        self.initial_value = initial_value
+        self.name = name
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self.initial_value
+        return obj.get_config_attr(self.name, self.initial_value)
@@ -11,7 +11,6 @@ from pyramid import security
 from pyramid.settings import asbool
 
 import ujson as json
-import socket
 
 from solute.epfl.core import epflclient, epflutil, epflacl
 from solute.epfl.core.epflutil import Lifecycle
@@ -303,7 +302,7 @@ class Page(object):
         """ Checks if the current user has sufficient rights to see/access this page.
         """
 
-        if security.has_permission("access", self, self.request):
+        if epflacl.has_permission("access", self, self.request):
             return True
         else:
             return False
@@ -379,9 +378,12 @@ class Page(object):
             render_env = self.get_render_environment()
             out = self.response.render_jinja(self.template, **render_env)
         else:
-            # Get render entry points.
-            for compo in self.get_active_components(sorted_by_depth=True)[:]:
-                if compo.redraw_requested and not compo.is_rendered:
+            # Get render entry points, components already rendered along with their container are skipped.
+            redrawn = [compo for compo in self.get_active_components()
+                       if compo.redraw_requested and not compo.is_rendered]
+            redrawn.sort(key=lambda x: self.transaction.get_component_depth(x.cid))
+            for compo in redrawn:
+                if not compo.is_rendered:
                     self.add_js_response("epfl.replace_component('{cid}', {parts})".format(
                         cid=compo.cid,
                         parts=json.encode({'js': compo.render('js_raw'),
@@ -411,6 +413,7 @@ class Page(object):
         if 'root_node' not in self.transaction['__initialized_components__']:
             self.root_node.init_transaction()
             self.transaction['__initialized_components__'].add('root_node')
+            self.transaction.set_dirty('__initialized_components__')
 
         for compo in self.get_active_components():
             compo.setup_component()
@@ -470,21 +473,7 @@ class Page(object):
         self.root_node.redraw()
 
     def handle_log_time(self, time_used):
-        request = self.request
-        settings = request.registry.settings
-
-        route_name = request.matched_route.name
-
-        key = settings.get(
-            'epfl.performance_log.prefix',
-            'epfl.performance.{route_name}.{lifecycle_name}'
-        ).format(
-            host=socket.gethostname().replace('.', '_'),
-            fqdn=socket.getfqdn().replace('.', '_'),
-            route_name=route_name.replace('.', '_'),
-            lifecycle_name="js_parsing",
-        )
-
+        key = epflutil.get_performance_log_key(self.request, "js_parsing")
         epflutil.log_timing(key, time_used, request=self.request)
 
     def add_js_response(self, js_string):
@@ -543,7 +532,10 @@ class Page(object):
         """
         imports = self.get_names('css_name', only_fresh_names=only_fresh_imports)
 
-        self.transaction.setdefault('rendered_extra_content', set()).update(imports)
+        rendered_extra_content = self.transaction.setdefault('rendered_extra_content', set())
+        if not rendered_extra_content.issuperset(imports):
+            rendered_extra_content.update(imports)
+            self.transaction.set_dirty('rendered_extra_content')
 
         return jinja2.Markup(''.join(['<link rel="stylesheet" type="text/css" href="%s"/>\r\n'
                                       % css for css in imports]))
@@ -562,7 +554,10 @@ class Page(object):
         """
         imports = self.get_names('js_name', only_fresh_names=only_fresh_imports)
 
-        self.transaction.setdefault('rendered_extra_content', set()).update(imports)
+        rendered_extra_content = self.transaction.setdefault('rendered_extra_content', set())
+        if not rendered_extra_content.issuperset(imports):
+            rendered_extra_content.update(imports)
+            self.transaction.set_dirty('rendered_extra_content')
 
         return jinja2.Markup(''.join(['<script type="text/javascript" src="%s"></script>\r\n'
                                       % js for js in imports]))
@@ -618,12 +613,14 @@ class Page(object):
         Expose the remember function of pyramid.security for easy access to the pyramid authorization handler.
         """
         self.remember_cookies = security.remember(self.request, user_id)
+        epflacl.clear_permission_cache(self.request)
 
     def forget(self):
         """
         Expose the forget function of pyramid.security for easy access to the pyramid authorization handler.
         """
         self.remember_cookies = security.forget(self.request)
+        epflacl.clear_permission_cache(self.request)
 
     def toast(self, message, message_type):
         raise Exception('This function is deprecated.')
@@ -6,20 +6,219 @@ A Dict-Like Object that represents a epfl-transaction
 """
 
 from pprint import pprint
-from redis import StrictRedis
-import cPickle as pickle
-from copy import deepcopy
 from collections2 import OrderedDict as odict
-import types, copy, string, uuid, time
+import types, copy, string, uuid, time, bisect
 
-from collections import MutableMapping, defaultdict
-from solute.epfl.core import epflcomponentbase
+from collections import MutableMapping, MutableSequence, OrderedDict, defaultdict
+from solute.epfl.core import epflcomponentbase, epfltransactionstore
 
 
 class TransactionRouteViolation(Exception):
     pass
 
 
+def longest_increasing_subsequence(sequence):
+    """Return the indexes of a longest strictly increasing subsequence of sequence in O(n log n)."""
+    tails, tail_values = [], []
+    predecessors = [None] * len(sequence)
+    for i, value in enumerate(sequence):
+        length = bisect.bisect_left(tail_values, value)
+        if length:
+            predecessors[i] = tails[length - 1]
+        if length == len(tails):
+            tails.append(i)
+            tail_values.append(value)
+        else:
+            tails[length] = i
+            tail_values[length] = value
+
+    result = []
+    i = tails[-1] if tails else None
+    while i is not None:
+        result.append(i)
+        i = predecessors[i]
+    result.reverse()
+    return result
+
+
+class CompoStruct(MutableSequence):
+    """ The ordered component ids of a container with many children. The ids are kept in blocks of at most
+    2 * :attr:`block_size` entries together with a map of every id to its block and the offset of every block in the
+    sequence. Looking up a position or the position of an id bisects the block offsets in O(log(n / block_size)) and
+    scans a single block. Inserting and removing an id change a single block and shift the offsets of the blocks
+    behind it, which is O(n / block_size) integer additions instead of moving O(n) entries of a list.
+    Compares equal to a list with the same ids and is pickled as a list of them. The ids have to be unique.
+
+    Containers use plain lists until they hold :attr:`min_size` children, see :meth:`Transaction.insert_child`.
+    """
+
+    #: Number of ids a block holds after splitting.
+    block_size = 256
+    #: Size from which on containers switch from a list to a :class:`CompoStruct`.
+    min_size = 512
+
+    def __init__(self, cids=()):
+        self.blocks = []
+        #: Position of the first id of every block in the sequence.
+        self.offsets = []
+        #: Maps the ids of the blocks to their position in :attr:`blocks`.
+        self.block_positions = {}
+        self.block_ids = []
+        self.cid_blocks = {}
+        self.length = 0
+        self.next_block_id = 0
+        self.extend(cids)
+
+    def reindex(self):
+        """Rebuild :attr:`offsets` and :attr:`block_positions` after a block has been added or dropped."""
+        self.offsets = []
+        offset = 0
+        for block in self.blocks:
+            self.offsets.append(offset)
+            offset += len(block)
+        self.block_positions = dict((block_id, position) for position, block_id in enumerate(self.block_ids))
+
+    def shift(self, position, delta):
+        """Move the offsets of all blocks behind position by delta."""
+        offsets = self.offsets
+        for i in xrange(position + 1, len(offsets)):
+            offsets[i] += delta
+
+    def new_block(self, position, cids):
+        """Insert a new block holding cids at position in :attr:`blocks`."""
+        block_id = self.next_block_id
+        self.next_block_id += 1
+        self.blocks.insert(position, cids)
+        self.block_ids.insert(position, block_id)
+        for cid in cids:
+            self.cid_blocks[cid] = block_id
+        self.reindex()
+
+    def locate(self, index):
+        """Return the position of the block holding the entry at index and the offset of the entry in that block."""
+        if index < 0:
+            index += self.length
+        if index < 0 or index >= self.length:
+            raise IndexError('CompoStruct index out of range')
+        position = bisect.bisect_right(self.offsets, index) - 1
+        return position, index - self.offsets[position]
+
+    def find(self, cid):
+        """Return the position of the block holding cid and the offset of cid in that block."""
+        try:
+            position = self.block_positions[self.cid_blocks[cid]]
+        except KeyError:
+            raise ValueError('%r is not in CompoStruct' % (cid, ))
+        return position, self.blocks[position].index(cid)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.length)
+            if step != 1:
+                return list(self)[index]
+            # Only the blocks holding the slice are copied.
+            cids = []
+            if start < stop:
+                position, offset = self.locate(start)
+                while len(cids) < stop - start:
+                    cids.extend(self.blocks[position][offset:offset + stop - start - len(cids)])
+                    position, offset = position + 1, 0
+            return cids
+        position, offset = self.locate(index)
+        return self.blocks[position][offset]
+
+    def __setitem__(self, index, cid):
+        if isinstance(index, slice):
+            cids = list(self)
+            cids[index] = cid
+            self.__init__(cids)
+            return
+        position, offset = self.locate(index)
+        block = self.blocks[position]
+        del self.cid_blocks[block[offset]]
+        block[offset] = cid
+        self.cid_blocks[cid] = self.block_ids[position]
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            cids = list(self)
+            del cids[index]
+            self.__init__(cids)
+            return
+        position, offset = self.locate(index)
+        self.remove_at(position, offset)
+
+    def remove_at(self, position, offset):
+        """Remove the entry at offset from the block at position, dropping the block if it gets empty."""
+        block = self.blocks[position]
+        del self.cid_blocks[block.pop(offset)]
+        self.length -= 1
+        if not block:
+            del self.blocks[position]
+            del self.block_ids[position]
+            self.reindex()
+        else:
+            self.shift(position, -1)
+
+    def insert(self, index, cid):
+        if index < 0:
+            index = max(index + self.length, 0)
+        if not self.blocks:
+            self.new_block(0, [])
+        if index >= self.length:
+            position, offset = len(self.blocks) - 1, len(self.blocks[-1])
+        else:
+            position, offset = self.locate(index)
+
+        block = self.blocks[position]
+        block.insert(offset, cid)
+        self.cid_blocks[cid] = self.block_ids[position]
+        self.length += 1
+        self.shift(position, 1)
+
+        if len(block) > 2 * self.block_size:
+            tail = block[self.block_size:]
+            del block[self.block_size:]
+            self.new_block(position + 1, tail)
+
+    def index(self, cid, *args):
+        if args:
+            return list(self).index(cid, *args)
+        position, offset = self.find(cid)
+        return self.offsets[position] + offset
+
+    def remove(self, cid):
+        self.remove_at(*self.find(cid))
+
+    def __contains__(self, cid):
+        return cid in self.cid_blocks
+
+    def __iter__(self):
+        for block in self.blocks:
+            for cid in block:
+                yield cid
+
+    def __len__(self):
+        return self.length
+
+    def __eq__(self, other):
+        if isinstance(other, (list, CompoStruct)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return 'CompoStruct(%r)' % list(self)
+
+    def __reduce__(self):
+        return CompoStruct, (list(self), )
+
+
 class Transaction(MutableMapping):
     """ An object that encapsulates the transaction-access.
     The transactions are stored in the session.
@@ -28,8 +227,19 @@ class Transaction(MutableMapping):
 
     #: Internal cache of the data this transaction holds.
     _data = None
-    #: Internal cache of the data this transaction held when loaded.
-    _data_original = None
+    #: Top level keys of :attr:`data` that have been changed since the transaction was loaded or last stored.
+    _dirty_keys = None
+    #: Component ids whose entries in the compo_store have been changed, added or removed since the transaction was
+    #: loaded or last stored.
+    _dirty_components = None
+    #: Component ids whose entries have been added since the transaction was loaded or last stored, see :meth:`merge`.
+    _new_components = None
+
+    #: Index of the component tree mapping component ids to the id of their container, or None for top level
+    #: components. Filled on demand and maintained by the methods changing the component tree.
+    _parents = None
+    #: Index mapping component ids to their depth in the component tree, see :meth:`get_component_depth`.
+    _depths = None
 
     #: Can contain a new transaction id to be used for storing this transaction. If given, the original transaction will
     #: be stored as locked under its original id so that it will be preserved in the state it was left in. Should be
@@ -42,6 +252,29 @@ class Transaction(MutableMapping):
     #: True if the Transaction was just created.
     created = False
 
+    #: True if the data of this transaction has been found in or written to the transaction store.
+    stored = False
+
+    #: Version of the data of this transaction in the transaction store, 0 if it has not been stored yet.
+    version = 0
+
+    #: What to do if the transaction has been stored by a concurrent request since it was loaded, configured by
+    #: epfl.transaction.conflict: 'overwrite', the default, stores the data regardless, 'fail' raises
+    #: :class:`~solute.epfl.core.epfltransactionstore.TransactionConflict` and 'merge' applies the changes of this
+    #: request to the latest stored data, see :meth:`merge`.
+    conflict_policy = 'overwrite'
+
+    #: Number of merges attempted before the conflict is raised, configured by epfl.transaction.conflict_retries.
+    conflict_retries = 3
+
+    #: Number of hibernated children kept per container, configured by epfl.transaction.max_sleeping_children. The
+    #: children hibernated the longest time ago are deleted beyond that and recreated from data if needed again. 0, the
+    #: default, keeps all of them.
+    max_sleeping_children = 0
+
+    #: The :class:`~solute.epfl.core.epfltransactionstore.ITransactionStore` this transaction is stored in.
+    transaction_store = None
+
     #: The request currently in progress.
     request = None
     #: The session of the request currently in progress.
@@ -53,11 +286,23 @@ class Transaction(MutableMapping):
         self.instances = {}
         self.request = request
         self.session = request.session
+        self.transaction_store = epfltransactionstore.get_transaction_store(request.registry)
+        self.conflict_policy = request.registry.settings.get('epfl.transaction.conflict', 'overwrite')
+        self.conflict_retries = int(request.registry.settings.get('epfl.transaction.conflict_retries', 3))
+        self.max_sleeping_children = int(request.registry.settings.get('epfl.transaction.max_sleeping_children', 0))
         self.tid = tid
         self.created = False
 
         self.compo_reference = {}
 
+        self._dirty_keys = set()
+        self._dirty_components = set()
+        self._new_components = set()
+
+        self._parents = {}
+        self._depths = {}
+        self._references = {}
+
         if not self.tid:
             self.tid = uuid.uuid4().hex
             self.created = True
@@ -114,15 +359,92 @@ class Transaction(MutableMapping):
         del self.data
 
     # EPFL Core Api methods
+    def get_component_parent(self, cid):
+        """
+        :param cid: component id of target component.
+        :returns: the component id of the container of the component with the given cid or None.
+        """
+        try:
+            return self._parents[cid]
+        except KeyError:
+            pass
+        compo_info = self.get_component(cid)
+        if compo_info is None:
+            return None
+        ccid = self._parents[cid] = compo_info.get('ccid')
+        return ccid
+
+    def set_component_parent(self, cid, ccid):
+        """Update the component tree index after the container of a component has been changed. The depths and
+        cached reference targets of all components are reset, since the whole sub tree of the component has been moved.
+
+        :param cid: component id of target component.
+        :param ccid: component id of the new container.
+        """
+        self._parents[cid] = ccid
+        self._depths.clear()
+        self._references.clear()
+
+    def get_reference_target(self, cid, reference):
+        """
+        :param cid: component id of the component the reference is resolved on.
+        :param reference: :class:`solute.epfl.core.epfldescriptor.Reference` instance.
+        :returns: the cached target of the reference, raises a KeyError if there is none.
+        """
+        return self._references[cid, id(reference)][1]
+
+    def set_reference_target(self, cid, reference, target):
+        """Cache the target of a reference resolved on a component until the component tree is changed.
+
+        :param cid: component id of the component the reference is resolved on.
+        :param reference: :class:`solute.epfl.core.epfldescriptor.Reference` instance.
+        :param target: the object the reference points to.
+        """
+        # The reference is kept with its target, so its id can not be reused while the entry exists.
+        self._references[cid, id(reference)] = reference, target
+
     def get_component_depth(self, cid):
         """
         :param cid: component id of target component.
         :returns: the number of containers the component with the given cid is part of.
         """
         try:
-            return self.get_component_depth(self['compo_store'][cid]['ccid']) + 1
+            return self._depths[cid]
         except KeyError:
-            return 0
+            pass
+        ccid = self.get_component_parent(cid)
+        if ccid is None:
+            depth = 0
+        else:
+            depth = self.get_component_depth(ccid) + 1
+        self._depths[cid] = depth
+        return depth
+
+    def get_component_ancestors(self, cid):
+        """
+        :param cid: component id of target component.
+        :returns: the list of the component ids of all containers of the component with the given cid, starting with
+                  its own container.
+        """
+        ancestors = []
+        ccid = self.get_component_parent(cid)
+        while ccid is not None:
+            ancestors.append(ccid)
+            ccid = self.get_component_parent(ccid)
+        return ancestors
+
+    def has_ancestor(self, cid, cids):
+        """
+        :param cid: component id of target component.
+        :param cids: set of component ids.
+        :returns: True if any container of the component with the given cid is part of cids.
+        """
+        ccid = self.get_component_parent(cid)
+        while ccid is not None:
+            if ccid in cids:
+                return True
+            ccid = self.get_component_parent(ccid)
+        return False
 
     def get_existing_components(self):
         """
@@ -141,13 +463,71 @@ class Transaction(MutableMapping):
             compo_info = self.get_component(cid)
             if compo_info is None:
                 raise Exception('Component with cid %s not found in transaction.' % cid)
-            ubc = epflcomponentbase.UnboundComponent.create_from_state(compo_info['class'])
+            state, config = compo_info['class'], compo_info['config']
+            if 'template_cid' in compo_info:
+                config = self.get_component_config(cid)
+                state = (state[0], config, state[2])
+            ubc = epflcomponentbase.UnboundComponent.create_from_state(state)
             self.instances[cid] = ubc(page,
                                       cid,
                                       __instantiate__=True,
-                                      config=compo_info['config'])
+                                      config=config)
         return self.instances[cid]
 
+    def get_component_instances(self, page, cids):
+        """Initiates several components on demand, loading the entries of the ones not instantiated yet in a single step.
+
+        :param page: :class:`~solute.epfl.core.epflpage.Page` instance used to initiate components.
+        :param cids: list of component ids of target components.
+        :returns: list of :class:`~solute.epfl.core.epflcomponentbase.ComponentBase` instances.
+        """
+        self.prefetch_components([cid for cid in cids if cid not in self.instances])
+        return [self.get_component_instance(page, cid) for cid in cids]
+
+    def get_component_config(self, cid):
+        """Return the complete config of a component. Children created from a template only store the part of their
+        config that differs from it, see :meth:`get_config_delta`. Mutable values taken from the template are copied, so
+        they are not shared by the siblings.
+
+        :param cid: component id of target component.
+        :returns: dict
+        """
+        compo_info = self.get_component(cid)
+        if 'template_cid' not in compo_info:
+            return compo_info['config']
+        config = self.get_component(compo_info['template_cid'])['child_templates'][compo_info['class'][0]].copy()
+        for key, value in config.iteritems():
+            try:
+                hash(value)
+            except TypeError:
+                config[key] = copy.deepcopy(value)
+        config.update(compo_info['config'])
+        return config
+
+    def get_config_delta(self, ccid, cls, config):
+        """Return the part of a child components config that differs from the config template of its container. The
+        config of the first child of each class is stored in the containers entry as template for the following ones.
+        The id is always kept, since sleeping children are looked up by it.
+
+        :param ccid: component id of the container.
+        :param cls: class of the child component.
+        :param config: complete config of the child.
+        :returns: dict or None if the config can not be stored as delta to the template.
+        """
+        container = self.get_component(ccid)
+        templates = container.setdefault('child_templates', {})
+        template = templates.get(cls)
+        if template is None:
+            template = templates[cls] = copy.deepcopy(config)
+            self.set_component_dirty(ccid)
+
+        for key in template:
+            if key not in config:
+                return None
+
+        return dict([(key, value) for key, value in config.iteritems()
+                     if key == 'id' or key not in template or template[key] != value])
+
     def get_active_components(self):
         """
         :returns: Return all :class:`~solute.epfl.core.epflcomponentbase.ComponentBase` instances held in this
@@ -171,15 +551,57 @@ class Transaction(MutableMapping):
         :param position: (optional) position the component should hold after the switch.
         """
         compo_info = self.get_component(cid)
+        if compo_info.get('template_cid', ccid) != ccid:
+            # The template is stored in the old parent, so the complete config has to be stored from now on.
+            config = self.get_component_config(cid)
+            compo_info['class'] = (compo_info['class'][0], config, compo_info['class'][2])
+            compo_info['config'] = config
+            del compo_info['template_cid']
+
         old_parent = self.get_component(compo_info['ccid'])
         old_parent['compo_struct'].remove(cid)
+        self.set_component_dirty(compo_info['ccid'])
 
         compo_info['ccid'] = ccid
-        if position is None:
-            position = len(self.get_component(ccid)['compo_struct'])
+        self.set_component_parent(cid, ccid)
+        self.insert_child(self.get_component(compo_info['ccid']), cid, position)
+        self.set_component_dirty(ccid)
+        self.set_component_dirty(cid)
+
+    def reorder_children(self, ccid, cids, offset=0):
+        """Reorder the children of a container in a single step, so cids hold the positions from offset on. The children
+        keeping their order relative to each other, a longest increasing subsequence of their current positions, are not
+        moved.
 
-        new_parent = self.get_component(compo_info['ccid'])
-        new_parent['compo_struct'].insert(position, cid)
+        :param ccid: component id of target container.
+        :param cids: component ids of children of the container in their new order.
+        :param offset: (optional) position of the first of cids.
+        :returns: list of the component ids that had to be moved.
+        """
+        compo_info = self.get_component(ccid)
+        compo_struct = compo_info['compo_struct']
+        current_order = list(compo_struct)
+        target_cids = set(cids)
+        others = [cid for cid in current_order if cid not in target_cids]
+        new_order = others[:offset] + list(cids) + others[offset:]
+        if new_order == current_order:
+            return []
+
+        positions = dict((cid, i) for i, cid in enumerate(current_order))
+        unmoved = set(cids[i] for i in longest_increasing_subsequence([positions[cid] for cid in cids]))
+        compo_info['compo_struct'] = type(compo_struct)(new_order)
+        self.set_component_dirty(ccid)
+        return [cid for cid in cids if cid not in unmoved]
+
+    def prefetch_components(self, cids):
+        """Load the entries of multiple components at once if the storage system loads them lazily. Does nothing
+        otherwise.
+
+        :param cids: iterable of component ids.
+        """
+        hydrate = getattr(self['compo_store'], 'hydrate', None)
+        if hydrate is not None:
+            hydrate(cids)
 
     def get_component(self, cid):
         """Return the components entry in this :class:`Transaction` instance.
@@ -217,16 +639,58 @@ class Transaction(MutableMapping):
         container = self
         if 'ccid' in compo_info:
             container = self.get_component(compo_info['ccid'])
+            self.set_component_dirty(compo_info['ccid'])
+        else:
+            self.set_dirty('compo_struct')
         if 'cid' not in compo_info:
             compo_info['cid'] = cid
 
-        compo_struct = container.setdefault('compo_struct', list())
-        if position is None:
-            compo_struct.append(cid)
-        else:
-            compo_struct.insert(position, cid)
+        self.insert_child(container, cid, position)
 
         self['compo_store'][cid] = compo_info
+        self.set_component_dirty(cid)
+        self._new_components.add(cid)
+        self._parents[cid] = compo_info.get('ccid')
+        self._depths.pop(cid, None)
+
+    def set_components(self, entries, position=None):
+        """Set the entries of several components sharing the same container in a single step, see
+        :meth:`set_component`.
+
+        :param entries: list of (cid, compo_info) tuples.
+        :param position: (optional) position the first component shall hold inside its container, appended if None.
+        """
+        if not entries:
+            return
+        cids = [cid for cid, compo_info in entries]
+        if len(set(cids)) != len(cids):
+            raise Exception('CIDs {cids} are not unique.'.format(cids=cids))
+        for cid, compo_info in entries:
+            if self.has_component(cid):
+                raise Exception('CID {cid} is not unique for this transaction. Existing compo info: {compo_info}'
+                                ' - new compo info: {new_compo_info}'.format(
+                                    cid=cid,
+                                    compo_info=self.get_component(cid),
+                                    new_compo_info=compo_info)
+                                )
+
+        ccid = entries[0][1].get('ccid')
+        container = self
+        if ccid is not None:
+            container = self.get_component(ccid)
+            self.set_component_dirty(ccid)
+        else:
+            self.set_dirty('compo_struct')
+
+        self.insert_children(container, cids, position)
+
+        for cid, compo_info in entries:
+            compo_info.setdefault('cid', cid)
+            self['compo_store'][cid] = compo_info
+            self.set_component_dirty(cid)
+            self._new_components.add(cid)
+            self._parents[cid] = ccid
+            self._depths.pop(cid, None)
 
     def del_component(self, cid):
         """Remove the components entry in this :class:`Transaction` instance.
@@ -243,8 +707,10 @@ class Transaction(MutableMapping):
         if 'ccid' in compo:
             container = self.get_component(compo['ccid'])
             container['compo_struct'].remove(cid)
+            self.set_component_dirty(compo['ccid'])
         else:
             self['compo_struct'].remove(cid)
+            self.set_dirty('compo_struct')
 
         # List has to be copied, since del_component modifies it.
         for child_cid in list(compo.get('compo_struct', [])):
@@ -255,6 +721,10 @@ class Transaction(MutableMapping):
             del self.instances[cid]
 
         self['compo_store'].pop(cid)
+        self.set_component_dirty(cid)
+        self._parents.pop(cid, None)
+        self._depths.pop(cid, None)
+        self._references.clear()
 
     def has_component(self, cid):
         """Check if the child component has an entry in this :class:`Transaction` instance.
@@ -264,9 +734,25 @@ class Transaction(MutableMapping):
         """
         return cid in self['compo_store']
 
+    def get_subtree_cids(self, cid):
+        """Return the id of the component and the ids of all its descendants, including hibernated ones.
+
+        :param cid: component id of target component.
+        """
+        cids = []
+        pending = [cid]
+        while pending:
+            cid = pending.pop()
+            cids.append(cid)
+            compo = self.get_component(cid)
+            pending.extend(compo.get('compo_struct', ()))
+            pending.extend((compo.get('sleeping_compo_struct') or {}).values())
+        return cids
+
     def hibernate_component_id(self, cid):
         """Sets the given component to be temporarily inactive. The component will not be listed or accessible unless
-        reactivated using :func:`wake_component_id` on it.
+        reactivated using :func:`wake_component_id` on it. If the container holds more than
+        :attr:`max_sleeping_children` hibernated children the ones hibernated the longest time ago are deleted.
 
         :param cid: The component to be put to sleep.
         """
@@ -274,10 +760,29 @@ class Transaction(MutableMapping):
         parent = self.get_component(compo.get('ccid'))
 
         parent['compo_struct'].remove(cid)
-        parent.setdefault('sleeping_compo_struct', {})[compo['config']['id']] = cid
+        sleeping_compo_struct = parent.get('sleeping_compo_struct')
+        if type(sleeping_compo_struct) is not OrderedDict:
+            sleeping_compo_struct = parent['sleeping_compo_struct'] = OrderedDict(sleeping_compo_struct or {})
+        sleeping_compo_struct.pop(compo['config']['id'], None)
+        sleeping_compo_struct[compo['config']['id']] = cid
+        self.set_component_dirty(compo.get('ccid'))
+        self._parents.pop(cid, None)
+        self._depths.pop(cid, None)
+        self._references.clear()
         if cid in self.instances:
             del self.instances[cid]
 
+        while 0 < self.max_sleeping_children < len(sleeping_compo_struct):
+            data_id, sleeping_cid = sleeping_compo_struct.popitem(last=False)
+            subtree = self.get_subtree_cids(sleeping_cid)
+            # The child is woken to be deleted as any other child.
+            self.insert_child(parent, sleeping_cid)
+            self.del_component(sleeping_cid)
+            initialized_components = self.get('__initialized_components__')
+            if initialized_components and not initialized_components.isdisjoint(subtree):
+                initialized_components.difference_update(subtree)
+                self.set_dirty('__initialized_components__')
+
     def wake_component_id(self, cid, data_id):
         """Sets the child component identified by the data_id to be active again.
 
@@ -285,16 +790,91 @@ class Transaction(MutableMapping):
         """
         parent = self.get_component(cid)
 
-        parent['compo_struct'].append(parent.get('sleeping_compo_struct').pop(data_id))
+        self.insert_child(parent, parent.get('sleeping_compo_struct').pop(data_id))
+        self.set_component_dirty(cid)
+
+    def insert_child(self, container, cid, position=None):
+        """Insert a component id into the compo_struct of a container, switching it to a :class:`CompoStruct` once it
+        has grown to :attr:`CompoStruct.min_size` entries.
+
+        :param container: compo_info of the container or this :class:`Transaction` instance for top level components.
+        :param cid: component id of the child component.
+        :param position: (optional) position the child component shall hold, appended if None.
+        """
+        compo_struct = container.setdefault('compo_struct', list())
+        if type(compo_struct) is list and len(compo_struct) >= CompoStruct.min_size:
+            compo_struct = container['compo_struct'] = CompoStruct(compo_struct)
+        if position is None:
+            compo_struct.append(cid)
+        else:
+            compo_struct.insert(position, cid)
+
+    def insert_children(self, container, cids, position=None):
+        """Insert multiple component ids into the compo_struct of a container in a single step, see
+        :meth:`insert_child`.
+
+        :param container: compo_info of the container or this :class:`Transaction` instance for top level components.
+        :param cids: list of component ids of the child components.
+        :param position: (optional) position the first child component shall hold, appended if None.
+        """
+        compo_struct = container.setdefault('compo_struct', list())
+        if type(compo_struct) is list and len(compo_struct) + len(cids) >= CompoStruct.min_size:
+            compo_struct = container['compo_struct'] = CompoStruct(compo_struct)
+        if position is None:
+            compo_struct.extend(cids)
+        elif type(compo_struct) is list:
+            compo_struct[position:position] = cids
+        else:
+            for i, cid in enumerate(cids):
+                compo_struct.insert(position + i, cid)
+
+    # Change tracking
+    def set_dirty(self, key):
+        """Mark a top level key of this :class:`Transaction` instance as changed. Has to be called whenever a mutable
+        value stored under that key is changed in place, e.g. the set of initialized components.
+
+        :param key: top level key that has been changed.
+        """
+        self._dirty_keys.add(key)
+
+    def set_component_dirty(self, cid):
+        """Mark the compo_store entry of a component as changed. Has to be called whenever the compo_info of a component
+        is changed in place. Removed components are marked as well.
+
+        :param cid: component id of target component.
+        """
+        self._dirty_components.add(cid)
+
+    def get_dirty_components(self):
+        """
+        :returns: The set of component ids whose entries have been changed, added or removed.
+        """
+        return self._dirty_components
+
+    def get_dirty_keys(self):
+        """
+        :returns: The set of top level keys that have been changed.
+        """
+        return self._dirty_keys
+
+    def reset_dirty(self):
+        """
+        Mark this :class:`Transaction` instance as clean, usually after it has been stored.
+        """
+        self._dirty_keys = set()
+        self._dirty_components = set()
+        self._new_components = set()
 
     # MutableMapping requirements:
     def __getitem__(self, key):
         return self.data.__getitem__(key)
 
     def __setitem__(self, key, value):
+        self._dirty_keys.add(key)
         return self.data.__setitem__(key, value)
 
     def __delitem__(self, key):
+        self._dirty_keys.add(key)
         return self.data.__delitem__(key)
 
     def __contains__(self, key):
@@ -307,17 +887,6 @@ class Transaction(MutableMapping):
         return self.data.__len__()
 
     # Internal storage handling
-    def lock_transaction(self):
-        """
-        Load a copy of the current transaction, unset the flag requesting a new transaction, reset the lock status and
-        store it as locked. After calling this the transaction related to this :class:`Transaction` instance should be
-        stored under a new transaction id, else it would override the locked copy.
-        """
-        old_transaction = Transaction(self.request, self.tid)
-        old_transaction.tid_new = None
-        old_transaction.pop('locked', None)
-        old_transaction.store(lock=True)
-
     def store_as_new(self):
         """
         Generate a fresh transaction id using the uuid module.
@@ -326,121 +895,240 @@ class Transaction(MutableMapping):
 
     def store(self, lock=False):
         """
-        Recursive storing mechanism. If no changes have occurred during this request nothing is done. If the transaction
-        is locked because it has spawned a child transaction a new transaction will be generated. If a new transaction
-        has been requested the current transaction is stored locked and a new unlocked transaction with the same content
-        is stored in its stead.
+        Storing mechanism. If no changes have occurred during this request nothing is done. If the transaction is locked
+        because it has spawned a child transaction a new transaction will be generated. If a new transaction has been
+        requested the current transaction is stored locked and a new unlocked transaction with the same content is
+        stored in its stead, both using a single call to the transaction store.
+
+        If the transaction has been stored by a concurrent request since it was loaded, the :attr:`conflict_policy` is
+        applied.
         """
         if self.is_clean and not lock:
             return
 
-        if self.pop('locked', False):
+        for attempt in range(self.conflict_retries + 1):
+            try:
+                self.save(lock)
+                break
+            except epfltransactionstore.TransactionConflict:
+                if self.conflict_policy != 'merge' or attempt == self.conflict_retries:
+                    raise
+                self.merge()
+
+        self.stored = True
+        self.reset_dirty()
+
+    def save(self, lock=False):
+        """
+        Write the data of this transaction to the transaction store, see :meth:`store`.
+        """
+        is_locked = self.pop('locked', False)
+        if is_locked:
             self.store_as_new()
 
         if lock:
             self['locked'] = lock
 
-        if self.tid_new:
-            self.lock_transaction()
-            self.tid = self.tid_new
-
-        store_type = self.request.registry.settings.get('epfl.transaction.store')
-        transaction_timeout = self.request.registry.settings.get('epfl.transaction.timeout', 1800)
-        if store_type == 'redis':
-            self.redis.setex('TA_%s' % self.tid, transaction_timeout, pickle.dumps(self._data))
-        elif store_type == 'redis_context':
-            with self.redis_context() as redis:
-                redis.setex('TA_%s' % self.tid, pickle.dumps(self._data, pickle.HIGHEST_PROTOCOL), transaction_timeout)
-        elif store_type == 'memory':
-            self.memory['TA_%s' % self.tid] = self._data
+        if self.tid_new and self.tid_new != self.tid and self.stored:
+            locked_tid, self.tid = self.tid, self.tid_new
+            self.version = self.transaction_store.lock_and_save(locked_tid, self.tid, self.data, is_locked=is_locked)
+        else:
+            # There is nothing to lock if the transaction has never been stored.
+            if self.tid_new:
+                self.tid = self.tid_new
+            version = None if self.conflict_policy == 'overwrite' else self.version
+            self.version = self.transaction_store.save(self.tid, self.data, self._dirty_keys, self._dirty_components,
+                                                       version=version)
+
+    def merge(self):
+        """
+        Reload the data of this transaction after a concurrent request has stored it and apply the changes of this
+        request to it. Changed top level keys and components of this request replace the stored ones, except for:
+
+        - The compo_struct of containers, it is merged from both requests. Children are kept in the order of this
+          request if it changed the container, the children added concurrently are appended.
+        - Components deleted by this request, they are deleted together with the children added to them concurrently.
+          Components deleted concurrently stay deleted unless this request added them, components added by this
+          request to a container deleted concurrently are dropped.
+        - Sets like rendered_extra_content, they are united. Ids of components changed by this request follow this
+          request, __initialized_components__ only keeps the ids of components existing after the merge.
+        """
+        data = self.data
+        self._data = None
+        latest = self.data
+        self._parents.clear()
+        self._depths.clear()
+        self._references.clear()
+
+        if not self.stored:
+            # The transaction has been deleted concurrently, so it has to be stored completely.
+            self._data = data
+            self._dirty_keys = set(data)
+            return
+
+        # The changes of this request, the merge adds the components it changes itself.
+        dirty_components = set(self._dirty_components)
+        for key in self._dirty_keys:
+            if key not in data:
+                latest.pop(key, None)
+            elif isinstance(data[key], (set, frozenset)) and isinstance(latest.get(key), (set, frozenset)):
+                latest[key] = type(data[key])(data[key] | (latest[key] - dirty_components))
+            elif key != 'compo_struct' or 'compo_store' in self._dirty_keys:
+                latest[key] = data[key]
+        if 'compo_store' in self._dirty_keys:
+            # The whole compo_store has been replaced, so there is nothing to merge.
+            return
+
+        ours, theirs = data['compo_store'], latest['compo_store']
+
+        # The stored children of all containers affected by the changes of this request, None is the transaction.
+        containers = {}
+        for ccid in self.merge_container_ids(data, latest):
+            container = latest if ccid is None else theirs.get(ccid)
+            containers[ccid] = list(container.get('compo_struct', ())) if container is not None else []
+
+        for cid in dirty_components:
+            if cid in ours and (cid in theirs or cid in self._new_components):
+                theirs[cid] = ours[cid]
+            elif cid in theirs:
+                self.merge_remove_subtree(theirs, cid)
+        for cid in dirty_components:
+            compo_info = theirs.get(cid)
+            if compo_info is not None and compo_info.get('ccid') is not None and compo_info['ccid'] not in theirs:
+                self.merge_remove_subtree(theirs, cid)
+
+        for ccid, stored_children in containers.iteritems():
+            self.merge_children(data, latest, ccid, stored_children, dirty_components)
+
+        initialized_components = latest.get('__initialized_components__')
+        if initialized_components:
+            missing = [cid for cid in initialized_components if cid not in theirs]
+            if missing:
+                initialized_components.difference_update(missing)
+                self._dirty_keys.add('__initialized_components__')
+
+    def merge_container_ids(self, data, latest):
+        """Return the ids of the containers whose children have been changed by this request, see :meth:`merge`. None
+        stands for the top level components.
+        """
+        ccids = set()
+        if 'compo_struct' in self._dirty_keys:
+            ccids.add(None)
+        for cid in self._dirty_components:
+            ccids.add(cid)
+            for compo_store in (data['compo_store'], latest['compo_store']):
+                compo_info = compo_store.get(cid)
+                if compo_info is not None:
+                    ccids.add(compo_info.get('ccid'))
+        return ccids
+
+    def merge_remove_subtree(self, compo_store, cid):
+        """Remove a component and all its descendants from compo_store while merging, see :meth:`merge`.
+        """
+        pending = [cid]
+        while pending:
+            cid = pending.pop()
+            compo_info = compo_store.pop(cid, None)
+            self._dirty_components.add(cid)
+            if compo_info is not None:
+                pending.extend(compo_info.get('compo_struct', ()))
+                pending.extend((compo_info.get('sleeping_compo_struct') or {}).values())
+
+    def merge_children(self, data, latest, ccid, stored_children, dirty_components):
+        """Merge the compo_struct of a container from the children of this request and the stored children, see
+        :meth:`merge`.
+
+        :param ccid: component id of the container or None for the top level components.
+        :param stored_children: the compo_struct of the container stored by the concurrent request.
+        :param dirty_components: the ids of the components changed by this request.
+        """
+        compo_store = latest['compo_store']
+        if ccid is None:
+            container, own_container, changed = latest, data, 'compo_struct' in self._dirty_keys
         else:
-            raise Exception('No valid transaction store found!')
+            container, own_container = compo_store.get(ccid), data['compo_store'].get(ccid)
+            changed = ccid in dirty_components
+            if container is None:
+                return
+        own_children = list((own_container or {}).get('compo_struct', ()))
+
+        candidates = own_children + stored_children if changed else stored_children + own_children
+        own_children = set(own_children)
+        sleeping = set((container.get('sleeping_compo_struct') or {}).values())
+        children, seen = [], set()
+        for cid in candidates:
+            if cid in seen or cid in sleeping:
+                continue
+            if cid in dirty_components and cid not in own_children:
+                # Removed from this container by this request.
+                continue
+            compo_info = compo_store.get(cid)
+            if compo_info is None or compo_info.get('ccid') != ccid:
+                continue
+            seen.add(cid)
+            children.append(cid)
+
+        compo_struct = container.get('compo_struct')
+        if compo_struct is not None and list(compo_struct) == children:
+            return
+        if type(compo_struct) is CompoStruct or len(children) >= CompoStruct.min_size:
+            children = CompoStruct(children)
+        container['compo_struct'] = children
+        if ccid is None:
+            self._dirty_keys.add('compo_struct')
+        else:
+            self._dirty_components.add(ccid)
 
     @property
     def data(self):
         """
         Get data from the configured storage system.
         """
-        if self._data:
+        if self._data is not None:
             return self._data
 
         if not self.tid:
             raise Exception('Transaction store was accessed before transaction id was set.')
 
-        default_data = {'compo_store': {}, 'compo_struct': []}
-
-        store_type = self.request.registry.settings.get('epfl.transaction.store')
-        if store_type in ['redis', 'redis_context']:
-
-            if store_type == 'redis_context':
-                with self.redis_context() as redis:
-                    data = redis.get('TA_%s' % self.tid)
-            else:
-                data = self.redis.get('TA_%s' % self.tid)
-            if data:
-                self._data = pickle.loads(data)
-                self._data_original = pickle.loads(data)
-            else:
-                self._data = default_data
-                self._data_original = deepcopy(self._data)
-            if not self.is_clean:
-                raise Exception("There has been an error in the transaction system.")
-            return self._data
-        elif store_type == 'memory':
-            self._data = deepcopy(self.memory.setdefault('TA_%s' % self.tid, default_data))
-            if self._data == default_data:
-                self.created = True
-            self._data_original = deepcopy(self._data)
-            return self._data
-        else:
-            raise Exception('No valid transaction store found!')
+        self._data, self.version = self.transaction_store.load_versioned(self.tid)
+        self.stored = self._data is not None
+        if self._data is None:
+            # Unknown or expired tids start over like a new transaction.
+            self._data = {'compo_store': {}, 'compo_struct': []}
+            self.created = True
+        return self._data
 
     @data.deleter
     def data(self):
         """
         Delete the transaction from its respective Storage.
         """
-        del self._data
-        del self._data_original
-
-        store_type = self.request.registry.settings.get('epfl.transaction.store')
-        if store_type == 'redis':
-            self.redis.delete('TA_%s' % self.tid)
-        elif store_type == 'redis_context':
-            with self.redis_context() as redis:
-                redis.delete('TA_%s' % self.tid)
-        elif store_type == 'memory':
-            del self.memory['TA_%s' % self.tid]
-        else:
-            raise Exception('No valid transaction store found!')
-
-    @property
-    def redis(self):
-        """
-        Redis storage abstraction layer. Returns a singleton with get, delete and set methods.
-        """
-        if getattr(self.request.registry, 'transaction_redis', None) is None:
-            redis_url = self.request.registry.settings.get('epfl.transaction.url')
-            if not redis_url:
-                raise Exception('Transaction redis url not set!')
-            self.request.registry.transaction_redis = StrictRedis.from_url(redis_url)
-        return self.request.registry.transaction_redis
+        self._data = None
+        self.stored = False
+        self.version = 0
+        self._parents.clear()
+        self._depths.clear()
+        self._references.clear()
+        self.reset_dirty()
 
-    @property
-    def memory(self):
-        """
-        Memory storage abstraction layer. Returns a singleton dictionary.
-        """
-        if getattr(self.request.registry, 'transaction_memory', None) is None:
-            self.request.registry.transaction_memory = {}
-        return self.request.registry.transaction_memory
+        self.transaction_store.delete(self.tid)
 
     @property
     def is_clean(self):
         """
-        Returns true if the transaction has not been changed.
+        Returns true if the transaction has not been changed. Changes are recorded when they are made through the
+        :class:`Transaction` api or are announced using :meth:`set_dirty` and :meth:`set_component_dirty`.
         """
-        return self._data == self._data_original
+        return not self._dirty_keys and not self._dirty_components
 
     def redis_context(self):
+        """
+        Deprecated hook providing the redis client of the redis_context transaction store, implement
+        :meth:`~solute.epfl.core.epfltransactionstore.RedisContextTransactionStore.redis_context` instead. If this
+        method is overridden the redis_context transaction store still uses it.
+        """
         raise NotImplementedError('You have to implement this method!')
+
+
+#: The default :meth:`Transaction.redis_context`, used to detect applications overriding the deprecated hook.
+default_redis_context = Transaction.redis_context.__func__
@@ -0,0 +1,1034 @@
+# coding: utf-8
+
+"""
+Storage backends for :class:`~solute.epfl.core.epfltransaction.Transaction` data.
+"""
+
+import cPickle as pickle
+import copy
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+from collections import MutableMapping, OrderedDict
+
+from pyramid import threadlocal
+from pyramid.path import DottedNameResolver
+from pyramid.settings import asbool
+from redis import BlockingConnectionPool, ConnectionPool, StrictRedis
+from zope.interface import Interface, implementer
+
+from solute.epfl.core import epflutil
+
+# lz4 is optional, it is only required if it is selected by epfl.transaction.codec.compression.
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class ComponentClassTable(object):
+    """ Table of the component classes referenced by the compo_store entries of a transaction. For serialization the
+    class of an entry is replaced by a short reference into this table using :meth:`pack`, so every class is only
+    serialized once per transaction instead of once per entry.
+
+    References are derived from the pickled class, so writers of the same transaction never assign different classes
+    to the same reference.
+    """
+
+    def __init__(self, blobs=None):
+        #: Maps references to pickled classes.
+        self.blobs = {}
+        #: References added by :meth:`pack` that have not been written yet.
+        self.new = set()
+        self.refs = {}
+        self.classes = {}
+        if blobs:
+            self.blobs.update(blobs)
+
+    def get_ref(self, cls):
+        """Return the reference for cls, adding it to the table if necessary."""
+        ref = self.refs.get(cls)
+        if ref is None:
+            blob = pickle.dumps(cls, pickle.HIGHEST_PROTOCOL)
+            ref = self.refs[cls] = hashlib.sha1(blob).hexdigest()[:12]
+            if ref not in self.blobs:
+                self.blobs[ref] = blob
+                self.new.add(ref)
+            self.classes[ref] = cls
+        return ref
+
+    def get_class(self, ref):
+        cls = self.classes.get(ref)
+        if cls is None:
+            cls = self.classes[ref] = pickle.loads(self.blobs[ref])
+            self.refs[cls] = ref
+        return cls
+
+    @staticmethod
+    def get_packed_ref(compo_info):
+        """Return the class reference of a packed compo_store entry or None if the entry is not packed."""
+        state = compo_info.get('class')
+        if type(state) is tuple and isinstance(state[0], basestring):
+            return state[0]
+        return None
+
+    def pack(self, compo_info):
+        """Return a copy of the compo_store entry with its class replaced by a reference."""
+        state = compo_info.get('class')
+        if type(state) is not tuple or len(state) != 3:
+            return compo_info
+
+        packed = compo_info.copy()
+        packed['class'] = (self.get_ref(state[0]), ) + state[1:]
+        return packed
+
+    def unpack(self, compo_info):
+        """Resolve the class reference of a packed compo_store entry in place. Entries that are not packed are returned
+        unchanged.
+        """
+        ref = self.get_packed_ref(compo_info)
+        if ref is not None:
+            compo_info['class'] = (self.get_class(ref), ) + compo_info['class'][1:]
+        return compo_info
+
+
+class TransactionCodec(object):
+    """ Serializes transaction payloads for the transaction stores. Payloads are pickled using
+    epfl.transaction.codec.protocol (default: the highest binary protocol) and, if they are larger than
+    epfl.transaction.codec.threshold bytes, compressed using epfl.transaction.codec.compression (none, zlib or lz4).
+
+    Every encoded blob starts with a header of :attr:`magic`, the format version and the compression used, so the
+    settings may be changed at any time. Blobs without a header are plain pickles written by earlier versions.
+
+    If epfl.performance_log.enabled is set, the encoded bytes and the encode/decode timings are logged per route as
+    transaction_encode(_bytes) and transaction_decode(_bytes).
+    """
+
+    magic = 'EPFL'
+    version = '\x01'
+
+    #: Maps the compression names to their header byte.
+    compressions = {'none': 'n', 'zlib': 'z', 'lz4': 'l'}
+
+    def __init__(self, settings):
+        self.protocol = int(settings.get('epfl.transaction.codec.protocol', pickle.HIGHEST_PROTOCOL))
+        self.threshold = int(settings.get('epfl.transaction.codec.threshold', 16384))
+        self.zlib_level = int(settings.get('epfl.transaction.codec.zlib_level', 1))
+        self.compression = settings.get('epfl.transaction.codec.compression', 'none')
+        if self.compression not in self.compressions:
+            raise Exception('Unknown transaction codec compression %r!' % self.compression)
+        if self.compression == 'lz4' and lz4 is None:
+            raise Exception('Transaction codec compression lz4 requires the lz4 package!')
+        self.log_enabled = asbool(settings.get('epfl.performance_log.enabled', False))
+
+    def encode(self, value):
+        """Return the blob for value."""
+        return self.encode_many([value])[0]
+
+    def decode(self, blob):
+        """Return the value stored in blob."""
+        return self.decode_many([blob])[0]
+
+    def encode_many(self, values):
+        """Return a list of the blobs for values, logging them as a single operation."""
+        start = time.time()
+        blobs = [self.encode_value(value) for value in values]
+        self.log('transaction_encode', start, blobs)
+        return blobs
+
+    def decode_many(self, blobs):
+        """Return a list of the values stored in blobs, logging them as a single operation."""
+        start = time.time()
+        values = [self.decode_value(blob) for blob in blobs]
+        self.log('transaction_decode', start, blobs)
+        return values
+
+    def encode_value(self, value):
+        data = pickle.dumps(value, self.protocol)
+        compression = 'n'
+        if self.compression != 'none' and len(data) > self.threshold:
+            compression = self.compressions[self.compression]
+            if compression == 'z':
+                data = zlib.compress(data, self.zlib_level)
+            else:
+                data = lz4.frame.compress(data)
+        return self.magic + self.version + compression + data
+
+    def decode_value(self, blob):
+        if not blob.startswith(self.magic):
+            return pickle.loads(blob)
+
+        header_length = len(self.magic) + 2
+        version, compression = blob[len(self.magic)], blob[len(self.magic) + 1]
+        if version != self.version:
+            raise Exception('Unknown transaction codec version %r!' % version)
+
+        data = blob[header_length:]
+        if compression == 'z':
+            data = zlib.decompress(data)
+        elif compression == 'l':
+            if lz4 is None:
+                raise Exception('Transaction has been compressed using lz4 but the lz4 package is missing!')
+            data = lz4.frame.decompress(data)
+        elif compression != 'n':
+            raise Exception('Unknown transaction codec compression %r!' % compression)
+        return pickle.loads(data)
+
+    def log(self, lifecycle_name, start, blobs):
+        """Log the time since start and the size of blobs for the route of the current request."""
+        if not self.log_enabled:
+            return
+        request = threadlocal.get_current_request()
+        if request is None or getattr(request, 'matched_route', None) is None:
+            return
+
+        epflutil.log_timing(epflutil.get_performance_log_key(request, lifecycle_name),
+                            int((time.time() - start) * 1000), request=request)
+        # statsd timers aggregate arbitrary values, so the sizes get the same percentiles as the timings.
+        epflutil.log_timing(epflutil.get_performance_log_key(request, lifecycle_name + '_bytes'),
+                            sum([len(blob) for blob in blobs]), request=request)
+
+
+class TransactionConflict(Exception):
+    """Raised if a transaction is saved with a version that does not match the stored version anymore, because a
+    concurrent request has saved the same transaction in the meantime.
+    """
+
+    def __init__(self, tid, version):
+        super(TransactionConflict, self).__init__(
+            "Transaction %s has been changed concurrently, version %s is outdated." % (tid, version)
+        )
+        self.tid = tid
+        self.version = version
+
+
+class ITransactionStore(Interface):
+    """ A TransactionStore persists the data of EPFL transactions between requests. Transactions have to be kept for at
+    least the configured timeout (epfl.transaction.timeout) after they have last been saved or touched.
+    It is selected once per registry, either by the epfl.transaction.store setting or by using the
+    set_transaction_store config directive.
+
+    Every save increments the version of the stored transaction, a transaction that does not exist has version 0.
+    """
+
+    def __init__(self, settings):
+        pass
+
+    def load(self, tid):
+        """ Return the data stored for tid or None if no such transaction exists. """
+        pass
+
+    def load_versioned(self, tid):
+        """ Return a tuple of the data stored for tid and its version, or (None, 0) if no such transaction exists. """
+        pass
+
+    def load_many(self, tids):
+        """ Return a dict mapping every tid to its data or None if no such transaction exists. """
+        pass
+
+    def save(self, tid, data, dirty_keys=None, dirty_components=None, version=None):
+        """ Store data for tid and return the new version. The sets of changed top level keys and component ids may be
+        used to write only the changes, if they are None the data has to be written completely. If a version is given
+        the data is only stored if it matches the stored version, otherwise :class:`TransactionConflict` is raised. """
+        pass
+
+    def lock_and_save(self, locked_tid, tid, data, is_locked=False):
+        """ Mark the transaction stored for locked_tid as locked and store data for the new transaction tid, using as
+        few operations as possible. If is_locked is True, the stored transaction is known to be locked already and
+        only its timeout has to be reset. Returns the version of the new transaction. """
+        pass
+
+    def delete(self, tid):
+        """ Remove the transaction stored for tid. """
+        pass
+
+    def touch(self, tid):
+        """ Reset the timeout of the transaction stored for tid. """
+        pass
+
+
+def lock_and_save(transaction_store, locked_tid, tid, data, is_locked=False):
+    """Default implementation of :meth:`ITransactionStore.lock_and_save` for stores without multi operation support."""
+    if is_locked:
+        transaction_store.touch(locked_tid)
+    else:
+        locked_data = transaction_store.load(locked_tid)
+        if locked_data is not None:
+            locked_data['locked'] = True
+            transaction_store.save(locked_tid, locked_data)
+    return transaction_store.save(tid, data)
+
+
+@implementer(ITransactionStore)
+class MemoryTransactionStore(object):
+    """ Keeps the encoded transactions in the memory of the current process, so every load returns an independent copy.
+    Transactions expire after epfl.transaction.timeout seconds. The store is bounded by
+    epfl.transaction.memory.max_entries and epfl.transaction.memory.max_bytes, evicting the least recently used
+    transactions first (0 means unbounded).
+
+    If epfl.transaction.memory.spill_path is set, evicted transactions and transactions that have been idle for
+    epfl.transaction.memory.spill_idle seconds are moved to a :class:`SQLiteTransactionStore` at that path instead of
+    being dropped, and are moved back into memory once they are loaded again.
+
+    Transactions that can not be pickled, e.g. holding locally defined classes, are kept as deep copy instead. They do
+    not count towards epfl.transaction.memory.max_bytes and are dropped instead of being spilled.
+    Not suitable for clustered systems.
+    """
+
+    def __init__(self, settings):
+        self.timeout = int(settings.get('epfl.transaction.timeout', 1800))
+        self.max_entries = int(settings.get('epfl.transaction.memory.max_entries', 0))
+        self.max_bytes = int(settings.get('epfl.transaction.memory.max_bytes', 0))
+        self.spill_idle = int(settings.get('epfl.transaction.memory.spill_idle', 0))
+        self.codec = TransactionCodec(settings)
+
+        self.spill_store = None
+        if settings.get('epfl.transaction.memory.spill_path'):
+            self.spill_store = SQLiteTransactionStore({
+                'epfl.transaction.sqlite.path': settings.get('epfl.transaction.memory.spill_path'),
+                'epfl.transaction.timeout': self.timeout
+            })
+
+        #: Maps tids to (encoded data or copy, expiry time, last access time, version), least recently used first.
+        self.transactions = OrderedDict()
+        self.size = 0
+        self.lock = threading.RLock()
+
+    def load(self, tid):
+        return self.load_versioned(tid)[0]
+
+    def load_versioned(self, tid):
+        entry = self.load_raw(tid)
+        if entry is None:
+            return None, 0
+        if isinstance(entry[0], dict):
+            return copy.deepcopy(entry[0]), entry[1]
+        return self.codec.decode(entry[0]), entry[1]
+
+    def load_raw(self, tid):
+        """Return a tuple of the encoded data, or the copy of an unpicklable transaction, and the version stored for tid
+        or None if no such transaction exists. Moves spilled transactions back into memory.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.transactions.pop(tid, None)
+            if entry is not None:
+                blob, expires, last_access, version = entry
+                if expires <= now:
+                    self.size -= self.get_size(blob)
+                    return None
+                self.transactions[tid] = blob, expires, now, version
+                return blob, version
+
+        if self.spill_store is None:
+            return None
+
+        entry = self.spill_store.load_raw(tid)
+        if entry is None:
+            return None
+        blob, expires, version = entry
+        self.spill_store.delete(tid)
+        with self.lock:
+            if tid not in self.transactions:
+                self.put(tid, blob, expires, version)
+        return blob, version
+
+    def load_many(self, tids):
+        return dict([(tid, self.load(tid)) for tid in tids])
+
+    def save(self, tid, data, dirty_keys=None, dirty_components=None, version=None):
+        try:
+            blob = self.codec.encode(data)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            blob = copy.deepcopy(data)
+        with self.lock:
+            entry = self.load_raw(tid)
+            stored_version = 0 if entry is None else entry[1]
+            if version is not None and version != stored_version:
+                raise TransactionConflict(tid, version)
+            self.put(tid, blob, time.time() + self.timeout, stored_version + 1)
+        return stored_version + 1
+
+    def lock_and_save(self, locked_tid, tid, data, is_locked=False):
+        return lock_and_save(self, locked_tid, tid, data, is_locked)
+
+    def delete(self, tid):
+        with self.lock:
+            entry = self.transactions.pop(tid, None)
+            if entry is not None:
+                self.size -= self.get_size(entry[0])
+        if self.spill_store is not None:
+            self.spill_store.delete(tid)
+
+    def touch(self, tid):
+        with self.lock:
+            entry = self.transactions.pop(tid, None)
+            if entry is not None:
+                self.transactions[tid] = entry[0], time.time() + self.timeout, time.time(), entry[3]
+                return
+        if self.spill_store is not None:
+            self.spill_store.touch(tid)
+
+    def put(self, tid, blob, expires, version):
+        """Insert the encoded data of a transaction as most recently used entry, then enforce the timeout, idle time and
+        size limits. Has to be called with :attr:`lock` held.
+        """
+        now = time.time()
+        entry = self.transactions.pop(tid, None)
+        if entry is not None:
+            self.size -= self.get_size(entry[0])
+        self.transactions[tid] = blob, expires, now, version
+        self.size += self.get_size(blob)
+
+        # Drop expired and spill idle transactions from the least recently used end.
+        while self.transactions:
+            old_tid, (old_blob, old_expires, old_last_access, old_version) = next(self.transactions.iteritems())
+            if old_expires <= now:
+                self.transactions.popitem(last=False)
+                self.size -= self.get_size(old_blob)
+            elif self.spill_store is not None and self.spill_idle and old_last_access + self.spill_idle <= now:
+                self.evict()
+            else:
+                break
+
+        while len(self.transactions) > 1 and (self.max_entries and len(self.transactions) > self.max_entries
+                                              or self.max_bytes and self.size > self.max_bytes):
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used transaction, spilling it to disk if configured. Has to be called with
+        :attr:`lock` held.
+        """
+        tid, (blob, expires, last_access, version) = self.transactions.popitem(last=False)
+        self.size -= self.get_size(blob)
+        if self.spill_store is not None and not isinstance(blob, dict):
+            self.spill_store.save_raw(tid, blob, expires, version)
+
+    @staticmethod
+    def get_size(blob):
+        """Return the number of bytes blob counts towards epfl.transaction.memory.max_bytes, copies of unpicklable
+        transactions count as 0.
+        """
+        if isinstance(blob, dict):
+            return 0
+        return len(blob)
+
+
+@implementer(ITransactionStore)
+class RedisTransactionStore(object):
+    """ Stores every transaction as a single encoded value under the key TA_<tid> using a shared redis client. The
+    client is configured by epfl.transaction.url, its connection pool by epfl.transaction.redis.socket_timeout and
+    epfl.transaction.redis.socket_connect_timeout in seconds. If epfl.transaction.redis.max_connections is set, requests
+    wait up to epfl.transaction.redis.pool_timeout seconds for a free connection.
+
+    The version of a transaction is kept under the key TAV_<tid>, both keys are written by the Lua script
+    :attr:`save_script_source` so the version check and the write are atomic.
+    """
+
+    #: KEYS: data key, version key. ARGV: expected version or an empty string, timeout, encoded data.
+    #: Returns the new version or -1 if the expected version does not match.
+    save_script_source = """
+        local version = tonumber(redis.call('GET', KEYS[2]) or '0')
+        if ARGV[1] ~= '' and tonumber(ARGV[1]) ~= version then
+            return -1
+        end
+        version = version + 1
+        redis.call('SETEX', KEYS[1], ARGV[2], ARGV[3])
+        redis.call('SETEX', KEYS[2], ARGV[2], version)
+        return version
+    """
+
+    def __init__(self, settings):
+        self.url = settings.get('epfl.transaction.url')
+        self.timeout = int(settings.get('epfl.transaction.timeout', 1800))
+        self.max_connections = int(settings.get('epfl.transaction.redis.max_connections', 0))
+        self.pool_timeout = float(settings.get('epfl.transaction.redis.pool_timeout', 20))
+        self.connection_kwargs = {}
+        for name in ['socket_timeout', 'socket_connect_timeout']:
+            if settings.get('epfl.transaction.redis.' + name):
+                self.connection_kwargs[name] = float(settings.get('epfl.transaction.redis.' + name))
+        self.codec = TransactionCodec(settings)
+        self._redis = None
+        self._save_script = None
+
+    @property
+    def redis(self):
+        """
+        The redis client shared by all requests.
+        """
+        if self._redis is None:
+            if not self.url:
+                raise Exception('Transaction redis url not set!')
+            if self.max_connections:
+                connection_pool = BlockingConnectionPool.from_url(self.url, max_connections=self.max_connections,
+                                                                  timeout=self.pool_timeout, **self.connection_kwargs)
+            else:
+                connection_pool = ConnectionPool.from_url(self.url, **self.connection_kwargs)
+            self._redis = StrictRedis(connection_pool=connection_pool)
+        return self._redis
+
+    @property
+    def save_script(self):
+        """
+        The save script registered with the shared redis client.
+        """
+        if self._save_script is None:
+            self._save_script = self.redis.register_script(self.save_script_source)
+        return self._save_script
+
+    @staticmethod
+    def get_key(tid):
+        return 'TA_%s' % tid
+
+    @staticmethod
+    def get_version_key(tid):
+        return 'TAV_%s' % tid
+
+    def get_save_args(self, tid, data, version=None):
+        """Return the keys and arguments of the save script writing data for tid."""
+        return ([self.get_key(tid), self.get_version_key(tid)],
+                ['' if version is None else version, self.timeout, self.codec.encode(data)])
+
+    @staticmethod
+    def check_version(tid, version, new_version):
+        """Return the new version returned by a save script, raising :class:`TransactionConflict` if it failed."""
+        if new_version == -1:
+            raise TransactionConflict(tid, version)
+        return new_version
+
+    def load(self, tid):
+        data = self.redis.get(self.get_key(tid))
+        if not data:
+            return None
+        return self.codec.decode(data)
+
+    def load_versioned(self, tid):
+        data, version = self.redis.mget([self.get_key(tid), self.get_version_key(tid)])
+        if not data:
+            return None, 0
+        return self.codec.decode(data), int(version or 0)
+
+    def load_many(self, tids):
+        result = dict([(tid, None) for tid in tids])
+        found = [(tid, data) for tid, data in zip(tids, self.redis.mget([self.get_key(tid) for tid in tids])) if data]
+        if found:
+            result.update(zip([tid for tid, data in found], self.codec.decode_many([data for tid, data in found])))
+        return result
+
+    def save(self, tid, data, dirty_keys=None, dirty_components=None, version=None):
+        keys, args = self.get_save_args(tid, data, version)
+        return self.check_version(tid, version, self.save_script(keys=keys, args=args))
+
+    def lock_and_save(self, locked_tid, tid, data, is_locked=False):
+        """Write the locked and the new transaction in a single MULTI. Unless the locked transaction is known to be
+        locked already it has to be loaded first.
+        """
+        pipe = self.redis.pipeline()
+        if is_locked:
+            pipe.expire(self.get_key(locked_tid), self.timeout)
+            pipe.expire(self.get_version_key(locked_tid), self.timeout)
+        else:
+            locked_data = self.load(locked_tid)
+            if locked_data is not None:
+                locked_data['locked'] = True
+                keys, args = self.get_save_args(locked_tid, locked_data)
+                self.save_script(keys=keys, args=args, client=pipe)
+        keys, args = self.get_save_args(tid, data)
+        self.save_script(keys=keys, args=args, client=pipe)
+        return pipe.execute()[-1]
+
+    def delete(self, tid):
+        self.redis.delete(self.get_key(tid), self.get_version_key(tid))
+
+    def touch(self, tid):
+        pipe = self.redis.pipeline()
+        pipe.expire(self.get_key(tid), self.timeout)
+        pipe.expire(self.get_version_key(tid), self.timeout)
+        pipe.execute()
+
+
+class RedisContextTransactionStore(RedisTransactionStore):
+    """ Same as :class:`RedisTransactionStore` but every access uses a redis client provided by the context manager
+    :meth:`redis_context`, which has to be implemented by a subclass registered using the set_transaction_store config
+    directive.
+    """
+
+    def redis_context(self):
+        """Return a context manager providing a redis client. Falls back to
+        :meth:`~solute.epfl.core.epfltransaction.Transaction.redis_context` if an application still overrides it, the
+        method is then called on a transaction bound to the current request only.
+        """
+        from solute.epfl.core.epfltransaction import Transaction, default_redis_context
+
+        if Transaction.redis_context.__func__ is default_redis_context:
+            raise NotImplementedError('You have to implement this method!')
+        transaction = Transaction.__new__(Transaction)
+        transaction.request = threadlocal.get_current_request()
+        transaction.session = getattr(transaction.request, 'session', None)
+        return transaction.redis_context()
+
+    def load(self, tid):
+        with self.redis_context() as redis:
+            data = redis.get(self.get_key(tid))
+        if not data:
+            return None
+        return self.codec.decode(data)
+
+    def load_versioned(self, tid):
+        with self.redis_context() as redis:
+            data, version = redis.mget([self.get_key(tid), self.get_version_key(tid)])
+        if not data:
+            return None, 0
+        return self.codec.decode(data), int(version or 0)
+
+    def load_many(self, tids):
+        return dict([(tid, self.load(tid)) for tid in tids])
+
+    def save(self, tid, data, dirty_keys=None, dirty_components=None, version=None):
+        keys, args = self.get_save_args(tid, data, version)
+        with self.redis_context() as redis:
+            new_version = redis.eval(self.save_script_source, len(keys), *(keys + args))
+        return self.check_version(tid, version, new_version)
+
+    def lock_and_save(self, locked_tid, tid, data, is_locked=False):
+        locked_data = None if is_locked else self.load(locked_tid)
+        with self.redis_context() as redis:
+            pipe = redis.pipeline()
+            if locked_data is not None:
+                locked_data['locked'] = True
+                keys, args = self.get_save_args(locked_tid, locked_data)
+                pipe.eval(self.save_script_source, len(keys), *(keys + args))
+            else:
+                pipe.expire(self.get_key(locked_tid), self.timeout)
+                pipe.expire(self.get_version_key(locked_tid), self.timeout)
+            keys, args = self.get_save_args(tid, data)
+            pipe.eval(self.save_script_source, len(keys), *(keys + args))
+            return pipe.execute()[-1]
+
+    def delete(self, tid):
+        with self.redis_context() as redis:
+            redis.delete(self.get_key(tid), self.get_version_key(tid))
+
+    def touch(self, tid):
+        with self.redis_context() as redis:
+            redis.expire(self.get_key(tid), self.timeout)
+            redis.expire(self.get_version_key(tid), self.timeout)
+
+
+class RedisHashCompoStore(MutableMapping):
+    """The compo_store of a transaction stored in the redis_hash layout. Every component entry lives in its own field
+    of the transactions redis hash and is only loaded from redis once it is accessed. Use :meth:`hydrate` to load
+    multiple entries in a single round-trip.
+    """
+
+    def __init__(self, redis, codec, key, cids, class_table):
+        self.redis = redis
+        self.codec = codec
+        self.key = key
+        self.cids = set(cids)
+        self.entries = {}
+        self.class_table = class_table
+
+    def hydrate(self, cids):
+        """Load the entries of the given component ids that have not yet been loaded using a single HMGET.
+
+        :param cids: iterable of component ids.
+        """
+        missing = [cid for cid in cids if cid in self.cids and cid not in self.entries]
+        if not missing:
+            return
+        fields = [RedisHashData.component_prefix + cid for cid in missing]
+        values = self.redis.hmget(self.key, fields)
+        for cid, value in zip(missing, values):
+            if value is None:
+                raise Exception('Component with cid %s vanished from transaction %s.' % (cid, self.key))
+        entries = self.codec.decode_many(values)
+
+        # Load the classes referenced by the entries that have not been loaded yet.
+        refs = set([self.class_table.get_packed_ref(compo_info) for compo_info in entries])
+        refs = list(refs.difference(self.class_table.blobs).difference([None]))
+        if refs:
+            blobs = self.redis.hmget(self.key, [RedisHashData.class_prefix + ref for ref in refs])
+            if None in blobs:
+                raise Exception('Component class vanished from transaction %s.' % self.key)
+            self.class_table.blobs.update(zip(refs, blobs))
+
+        for cid, compo_info in zip(missing, entries):
+            self.entries[cid] = self.class_table.unpack(compo_info)
+
+    def __getitem__(self, cid):
+        try:
+            return self.entries[cid]
+        except KeyError:
+            if cid not in self.cids:
+                raise
+        self.hydrate([cid])
+        return self.entries[cid]
+
+    def __setitem__(self, cid, compo_info):
+        self.cids.add(cid)
+        self.entries[cid] = compo_info
+
+    def __delitem__(self, cid):
+        self.cids.remove(cid)
+        self.entries.pop(cid, None)
+
+    def __contains__(self, cid):
+        return cid in self.cids
+
+    def __iter__(self):
+        return iter(self.cids)
+
+    def __len__(self):
+        return len(self.cids)
+
+
+class RedisHashData(MutableMapping):
+    """The data of a transaction stored in the redis_hash layout. Each top level key is stored in a field prefixed with
+    :attr:`key_prefix`, each compo_store entry in a field prefixed with :attr:`component_prefix`. Top level keys are
+    loaded eagerly, compo_store entries lazily by :class:`RedisHashCompoStore`. The entries reference their classes in a
+    :class:`ComponentClassTable` whose classes are stored in fields prefixed with :attr:`class_prefix`. The version of
+    the transaction is stored in the field :attr:`version_field`.
+    """
+
+    key_prefix = 'k:'
+    component_prefix = 'c:'
+    class_prefix = 'i:'
+    version_field = 'version'
+
+    def __init__(self, redis, codec, key, keys, cids):
+        """Load the top level keys of the transaction stored in the redis hash key.
+
+        :param redis: redis client.
+        :param codec: :class:`TransactionCodec` the fields are decoded with.
+        :param key: name of the redis hash the transaction is loaded from.
+        :param keys: top level keys present in the redis hash.
+        :param cids: component ids present in the redis hash.
+        """
+        self.redis = redis
+        self.codec = codec
+        self.key = key
+        self.values = {}
+        self.class_table = ComponentClassTable()
+        self.compo_store = RedisHashCompoStore(redis, codec, key, cids, self.class_table)
+        values = redis.hmget(key, [self.version_field] + [self.key_prefix + k for k in keys])
+        #: Version of the loaded transaction, read together with the top level keys.
+        self.version = int(values[0] or 0)
+        if keys:
+            self.values = dict(zip(keys, codec.decode_many(values[1:])))
+
+    @classmethod
+    def load(cls, redis, codec, key):
+        """Return the transaction stored in the redis hash key or None if it does not exist.
+
+        :param redis: redis client.
+        :param codec: :class:`TransactionCodec` the fields are decoded with.
+        :param key: name of the redis hash the transaction is loaded from.
+        """
+        keys, cids = [], []
+        for field in redis.hkeys(key):
+            if field.startswith(cls.key_prefix):
+                keys.append(field[len(cls.key_prefix):])
+            elif field.startswith(cls.component_prefix):
+                cids.append(field[len(cls.component_prefix):])
+
+        if not keys and not cids:
+            return None
+        return cls(redis, codec, key, keys, cids)
+
+    def __getitem__(self, key):
+        if key == 'compo_store':
+            return self.compo_store
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        if key == 'compo_store':
+            self.compo_store = RedisHashCompoStore(self.redis, self.codec, self.key, [], self.class_table)
+            self.compo_store.update(value)
+            return
+        self.values[key] = value
+
+    def __delitem__(self, key):
+        if key == 'compo_store':
+            raise KeyError('The compo_store of a transaction can not be deleted.')
+        del self.values[key]
+
+    def __contains__(self, key):
+        return key == 'compo_store' or key in self.values
+
+    def __iter__(self):
+        return iter(['compo_store'] + self.values.keys())
+
+    def __len__(self):
+        return len(self.values) + 1
+
+
+class RedisHashTransactionStore(RedisTransactionStore):
+    """ Stores every transaction as a redis hash under the key TA_<tid>, using one field per top level key and one per
+    compo_store entry. Loading returns a :class:`RedisHashData` that loads component entries lazily, saving only writes
+    the changed fields. Component classes that are no longer referenced are kept until the next full write.
+    """
+
+    #: KEYS: hash key. ARGV: expected version or an empty string, timeout, 1 if the hash is written completely, number
+    #: of fields to set, followed by the fields and values to set and the fields to delete.
+    #: Returns the new version or -1 if the expected version does not match.
+    save_script_source = """
+        local version = tonumber(redis.call('HGET', KEYS[1], 'version') or '0')
+        if ARGV[1] ~= '' and tonumber(ARGV[1]) ~= version then
+            return -1
+        end
+        if ARGV[3] == '1' then
+            redis.call('DEL', KEYS[1])
+        end
+        local count = tonumber(ARGV[4])
+        for i = 5, 4 + 2 * count, 2 do
+            redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+        end
+        for i = 5 + 2 * count, #ARGV do
+            redis.call('HDEL', KEYS[1], ARGV[i])
+        end
+        version = version + 1
+        redis.call('HSET', KEYS[1], 'version', version)
+        redis.call('EXPIRE', KEYS[1], ARGV[2])
+        return version
+    """
+
+    def load(self, tid):
+        return RedisHashData.load(self.redis, self.codec, self.get_key(tid))
+
+    def load_versioned(self, tid):
+        data = self.load(tid)
+        if data is None:
+            return None, 0
+        return data, data.version
+
+    def load_many(self, tids):
+        return dict([(tid, self.load(tid)) for tid in tids])
+
+    def save(self, tid, data, dirty_keys=None, dirty_components=None, version=None):
+        """Write the changed fields using a single script call. If data has not been loaded from the redis hash of tid or
+        no changes are given all fields are written.
+        """
+        new_version = self.queue_save(self.redis, tid, data, dirty_keys, dirty_components, version)
+        return self.check_version(tid, version, new_version)
+
+    def lock_and_save(self, locked_tid, tid, data, is_locked=False):
+        """Set the locked field of the locked transaction and write the new transaction using a single pipeline."""
+        pipe = self.redis.pipeline()
+        locked_key = self.get_key(locked_tid)
+        if not is_locked:
+            pipe.hset(locked_key, RedisHashData.key_prefix + 'locked', self.codec.encode(True))
+            pipe.hincrby(locked_key, RedisHashData.version_field, 1)
+        pipe.expire(locked_key, self.timeout)
+        self.queue_save(pipe, tid, data)
+        return pipe.execute()[-1]
+
+    def queue_save(self, client, tid, data, dirty_keys=None, dirty_components=None, version=None):
+        """Run the save script writing data for tid on client, which may be a pipeline, see :meth:`save`. Returns the
+        result of the script call.
+        """
+        key = self.get_key(tid)
+
+        if not isinstance(data, RedisHashData):
+            full = True
+            values, compo_store = dict(data), data['compo_store']
+            values.pop('compo_store')
+        else:
+            full = data.key != key or dirty_keys is None or dirty_components is None or 'compo_store' in dirty_keys
+            values, compo_store = data.values, data.compo_store
+            if full:
+                compo_store.hydrate(compo_store.cids)
+
+        if full:
+            dirty_keys = values.keys()
+            dirty_components = compo_store.keys()
+            class_table = ComponentClassTable()
+        else:
+            class_table = data.class_table
+
+        fields, removed = [], []
+        for k in dirty_keys:
+            if k in values:
+                fields.append((RedisHashData.key_prefix + k, values[k]))
+            elif k != 'compo_store':
+                removed.append(RedisHashData.key_prefix + k)
+        for cid in dirty_components:
+            if cid in compo_store:
+                fields.append((RedisHashData.component_prefix + cid, class_table.pack(compo_store[cid])))
+            else:
+                removed.append(RedisHashData.component_prefix + cid)
+        blobs = self.codec.encode_many([value for field, value in fields])
+        fields = [(field, blob) for (field, value), blob in zip(fields, blobs)]
+        fields.extend([(RedisHashData.class_prefix + ref, class_table.blobs[ref]) for ref in class_table.new])
+        class_table.new = set()
+
+        args = ['' if version is None else version, self.timeout, 1 if full else 0, len(fields)]
+        for field, blob in fields:
+            args.extend([field, blob])
+        args.extend(removed)
+        result = self.save_script(keys=[key], args=args, client=client)
+
+        if isinstance(data, RedisHashData):
+            data.key = compo_store.key = key
+            data.class_table = compo_store.class_table = class_table
+        return result
+
+
+@implementer(ITransactionStore)
+class SQLiteTransactionStore(object):
+    """ Stores the encoded transactions in a local SQLite database using write ahead logging, configured by
+    epfl.transaction.sqlite.path. Suitable for single node deployments with multiple worker processes. Every thread
+    uses its own connection.
+    """
+
+    #: Expired transactions are purged every n-th save.
+    purge_interval = 1000
+
+    def __init__(self, settings):
+        self.path = settings.get('epfl.transaction.sqlite.path')
+        if not self.path:
+            raise Exception('Transaction sqlite path not set!')
+        self.timeout = int(settings.get('epfl.transaction.timeout', 1800))
+        self.codec = TransactionCodec(settings)
+        self.local = threading.local()
+        self.save_count = 0
+
+    @property
+    def connection(self):
+        """
+        The connection of the current thread, created on first access.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS epfl_transaction '
+                               '(tid TEXT PRIMARY KEY, data BLOB NOT NULL, expires REAL NOT NULL, '
+                               'version INTEGER NOT NULL DEFAULT 0)')
+            columns = [row[1] for row in connection.execute('PRAGMA table_info(epfl_transaction)')]
+            if 'version' not in columns:
+                connection.execute('ALTER TABLE epfl_transaction ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+            self.local.connection = connection
+        return connection
+
+    def load(self, tid):
+        return self.load_versioned(tid)[0]
+
+    def load_versioned(self, tid):
+        entry = self.load_raw(tid)
+        if entry is None:
+            return None, 0
+        return self.codec.decode(entry[0]), entry[2]
+
+    def load_raw(self, tid):
+        """Return a tuple of the encoded data, the expiry time and the version stored for tid or None if no such
+        transaction exists.
+        """
+        row = self.connection.execute(
+            'SELECT data, expires, version FROM epfl_transaction WHERE tid = ? AND expires > ?', (tid, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        return str(row[0]), row[1], row[2]
+
+    def load_many(self, tids):
+        result = dict([(tid, None) for tid in tids])
+        if not tids:
+            return result
+        rows = self.connection.execute(
+            'SELECT tid, data FROM epfl_transaction WHERE tid IN (%s) AND expires > ?' % ', '.join('?' * len(tids)),
+            list(tids) + [time.time()]
+        )
+        rows = rows.fetchall()
+        result.update(zip([tid for tid, data in rows], self.codec.decode_many([str(data) for tid, data in rows])))
+        return result
+
+    def save(self, tid, data, dirty_keys=None, dirty_components=None, version=None):
+        """Read the stored version and write the new one in a single immediate transaction, so concurrent saves of other
+        processes are serialized.
+        """
+        blob = self.codec.encode(data)
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT version FROM epfl_transaction WHERE tid = ? AND expires > ?',
+                                     (tid, time.time())).fetchone()
+            stored_version = 0 if row is None else row[0]
+            if version is not None and version != stored_version:
+                raise TransactionConflict(tid, version)
+            self.save_raw(tid, blob, version=stored_version + 1)
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return stored_version + 1
+
+    def lock_and_save(self, locked_tid, tid, data, is_locked=False):
+        return lock_and_save(self, locked_tid, tid, data, is_locked)
+
+    def save_raw(self, tid, blob, expires=None, version=0):
+        """Store the encoded data of a transaction with the given version, expiring after the configured timeout unless an
+        expiry time is given.
+        """
+        if expires is None:
+            expires = time.time() + self.timeout
+        self.connection.execute(
+            'INSERT OR REPLACE INTO epfl_transaction (tid, data, expires, version) VALUES (?, ?, ?, ?)',
+            (tid, sqlite3.Binary(blob), expires, version)
+        )
+
+        self.save_count += 1
+        if self.save_count % self.purge_interval == 0:
+            self.purge()
+
+    def delete(self, tid):
+        self.connection.execute('DELETE FROM epfl_transaction WHERE tid = ?', (tid, ))
+
+    def touch(self, tid):
+        self.connection.execute('UPDATE epfl_transaction SET expires = ? WHERE tid = ?',
+                                (time.time() + self.timeout, tid))
+
+    def purge(self):
+        """
+        Remove all expired transactions.
+        """
+        self.connection.execute('DELETE FROM epfl_transaction WHERE expires <= ?', (time.time(), ))
+
+
+#: Transaction stores selectable by name using epfl.transaction.store.
+TRANSACTION_STORES = {'memory': MemoryTransactionStore,
+                      'redis': RedisTransactionStore,
+                      'redis_context': RedisContextTransactionStore,
+                      'redis_hash': RedisHashTransactionStore,
+                      'sqlite': SQLiteTransactionStore}
+
+
+def create_transaction_store(settings):
+    """Create the transaction store configured by epfl.transaction.store. The setting may either be the name of one of
+    the :data:`TRANSACTION_STORES` or a dotted name of a class implementing :class:`ITransactionStore`.
+    """
+    store_type = settings.get('epfl.transaction.store')
+    if not store_type:
+        raise Exception('No valid transaction store found!')
+
+    store_cls = TRANSACTION_STORES.get(store_type)
+    if store_cls is None:
+        try:
+            store_cls = DottedNameResolver().resolve(store_type)
+        except (ImportError, ValueError):
+            raise Exception('No valid transaction store found!')
+    return store_cls(settings)
+
+
+def get_transaction_store(registry):
+    """Return the transaction store registered in the registry. If none is registered yet it is created from the
+    settings and registered, so it will only be selected once.
+    """
+    transaction_store = registry.queryUtility(ITransactionStore)
+    if transaction_store is None:
+        transaction_store = create_transaction_store(registry.settings)
+        registry.registerUtility(transaction_store, ITransactionStore)
+    return transaction_store
@@ -6,11 +6,13 @@ from os.path import exists
 import logging
 import time
 import socket
+import json
+from collections import OrderedDict
 
-from pyramid import security
 from pyramid import path
 from pyramid import threadlocal
 from pyramid.settings import asbool
+from zope.interface import Interface
 
 import solute.epfl
 from solute.epfl import core
@@ -32,6 +34,8 @@ COMPONENT_COUNTER = itertools.count()
 COMPONENT_COUNTER_PREFIX = socket.getfqdn().replace('.', '_')
 DYNAMIC_CLASS_COUNTER = itertools.count()
 
+lifecycle_logger = logging.getLogger('solute.epfl.lifecycle')
+
 
 def generate_cid():
     """Generates a CID using next(), which is an atomic operation on itertools.count() generators.
@@ -64,51 +68,194 @@ def log_timing(key, timing, server=None, port=None, request=None):
     client.timing(key, timing)
 
 
+def get_performance_log_key(request, lifecycle_name):
+    """Build the key lifecycle_name is logged under for the matched route of request, using the format given by
+    epfl.performance_log.prefix.
+    """
+    return request.registry.settings.get(
+        'epfl.performance_log.prefix',
+        'epfl.performance.{route_name}.{lifecycle_name}'
+    ).format(
+        host=socket.gethostname().replace('.', '_'),
+        fqdn=COMPONENT_COUNTER_PREFIX,
+        route_name=request.matched_route.name.replace('.', '_'),
+        lifecycle_name=lifecycle_name.replace('.', '_'),
+    )
+
+
+class LifecycleSpan(object):
+    """A single run of a :class:`Lifecycle` stage, attributed to the component class and cid it ran for."""
+
+    __slots__ = ('name', 'component', 'cid', 'start', 'end', 'children')
+
+    def __init__(self, name, component=None, cid=None):
+        self.name = name
+        self.component = component
+        self.cid = cid
+        self.start = time.time()
+        self.end = None
+        self.children = []
+
+    @property
+    def label(self):
+        name = self.name
+        if type(name) is tuple:
+            name = '.'.join(name)
+        if self.component:
+            return '%s:%s' % (self.component, name)
+        return name
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def to_dict(self):
+        return {'name': self.label,
+                'component': self.component,
+                'cid': self.cid,
+                'start': self.start,
+                'duration': self.duration,
+                'children': [child.to_dict() for child in self.children]}
+
+
+class LifecycleTrace(object):
+    """The tree of :class:`LifecycleSpan` recorded for a request if epfl.lifecycle.trace is set. Obtain it using
+    :func:`get_lifecycle_trace`.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.stack = []
+
+    def open(self, name, obj=None):
+        component, cid = None, None
+        if obj is not None:
+            component = type(obj).__name__.split('_auto_')[0]
+            cid = getattr(obj, 'cid', None)
+        span = LifecycleSpan(name, component, cid)
+        if self.stack:
+            self.stack[-1].children.append(span)
+        else:
+            self.spans.append(span)
+        self.stack.append(span)
+        return span
+
+    def close(self):
+        span = self.stack.pop()
+        span.end = time.time()
+        return span
+
+    def to_dict(self):
+        return {'spans': [span.to_dict() for span in self.spans]}
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def to_collapsed(self):
+        """Return the trace in the collapsed stack format of flamegraph.pl, one line per distinct stack with its self
+        time in microseconds. Spans are labeled by component class, not by cid, so every class adds up to one frame.
+        """
+        totals = OrderedDict()
+
+        def collapse(span, prefix):
+            stack = prefix + (span.label, )
+            self_time = span.duration - sum(child.duration for child in span.children)
+            totals[stack] = totals.get(stack, 0) + max(self_time, 0)
+            for child in span.children:
+                collapse(child, stack)
+
+        for span in self.spans:
+            collapse(span, ())
+
+        return '\n'.join('%s %d' % (';'.join(stack), round(value * 1000000)) for stack, value in totals.items())
+
+
+def get_lifecycle_trace(request, create=False):
+    """Return the :class:`LifecycleTrace` of request. If create is set a trace is started if epfl.lifecycle.trace
+    is enabled for the application, otherwise None is returned for requests that are not traced.
+    """
+    trace = getattr(request, '__epfl_lifecycle_trace', None)
+    if trace is None and create:
+        trace = False
+        if asbool(request.registry.settings.get('epfl.lifecycle.trace', False)):
+            trace = LifecycleTrace()
+        setattr(request, '__epfl_lifecycle_trace', trace)
+    return trace or None
+
+
 class Lifecycle(object):
-    _state = {}
+    """Decorator marking the stages of a request. The stages currently running are available per thread from
+    :meth:`get_state`. If epfl.lifecycle.trace is set every stage is recorded as :class:`LifecycleSpan` in the
+    :class:`LifecycleTrace` of the request, the finished trace is logged as collapsed stacks to the
+    solute.epfl.lifecycle logger at debug level.
+    """
 
-    start_time = None
-    end_time = None
+    _local = threading.local()
 
-    def __init__(self, name, log_time=False):
+    def __init__(self, name, log_time=False, trace_only=False):
+        """
+        :param name: The name of the stage.
+        :param log_time: Log the run time of the stage, see :meth:`log_run_time`.
+        :param trace_only: Only check the stage in if a trace is recorded for the request. Use it for stages running
+                           per component, so requests that are not traced do not pay for the bookkeeping.
+        """
         self.name = name
         self.log_time = log_time
+        self.trace_only = trace_only
 
     @property
     def state(self):
         return self.get_state()
 
-    def checkin(self):
-        if self.log_time:
-            self.start_time = time.time()
-        self.state.append(self.name)
+    def checkin(self, obj=None):
+        local = Lifecycle._local
+        state = self.get_state()
+        if not state:
+            request = threadlocal.get_current_request()
+            local.trace = request and get_lifecycle_trace(request, create=True)
+        state.append(self.name)
+        local.starts.append(time.time() if self.log_time else None)
+        if local.trace:
+            local.trace.open(self.name, obj)
 
     def checkout(self):
+        local = Lifecycle._local
         state = self.state.pop()
         assert state == self.name, Exception("Checkout failed, potential threading problem! %r %r %r" % (state,
                                                                                                          self.name,
                                                                                                          self.state))
+        start_time = local.starts.pop()
+        trace = local.trace
+        if trace:
+            trace.close()
+            if not trace.stack and lifecycle_logger.isEnabledFor(logging.DEBUG):
+                lifecycle_logger.debug(trace.to_collapsed())
+        if not local.state:
+            local.trace = None
         if self.log_time:
-            self.end_time = time.time()
-            self.log_run_time()
+            self.log_run_time(start_time, time.time())
 
     def __call__(self, cb):
         @functools.wraps(cb)
         def _cb(*args, **kwargs):
+            if self.trace_only and not getattr(Lifecycle._local, 'trace', None):
+                return cb(*args, **kwargs)
+            self.checkin(args[0] if args else None)
             try:
-                self.checkin()
-                result = cb(*args, **kwargs)
-            except Exception as e:
-                raise
+                return cb(*args, **kwargs)
             finally:
                 self.checkout()
-            return result
 
         return _cb
 
     @staticmethod
     def get_state():
-        return Lifecycle._state.setdefault(threading.current_thread().getName(), [])
+        local = Lifecycle._local
+        try:
+            return local.state
+        except AttributeError:
+            local.state, local.starts, local.trace = [], [], None
+            return local.state
 
     @staticmethod
     def get_current():
@@ -118,7 +265,7 @@ class Lifecycle(object):
     def depth():
         return len(Lifecycle.get_state())
 
-    def log_run_time(self):
+    def log_run_time(self, start_time, end_time):
         """Log the time this state was active (between checkin and checkout) to the configured graphite server.
         """
         request = threadlocal.get_current_request()
@@ -133,22 +280,13 @@ class Lifecycle(object):
 
         server, port = settings.get('epfl.performance_log.server'), int(settings.get('epfl.performance_log.port'))
 
-        route_name = request.matched_route.name
         lifecycle_name = self.name
         if type(lifecycle_name) is tuple:
             lifecycle_name = '_'.join(lifecycle_name)
 
-        key = settings.get(
-            'epfl.performance_log.prefix',
-            'epfl.performance.{route_name}.{lifecycle_name}'
-        ).format(
-            host=socket.gethostname().replace('.', '_'),
-            fqdn=socket.getfqdn().replace('.', '_'),
-            route_name=route_name.replace('.', '_'),
-            lifecycle_name=lifecycle_name.replace('.', '_'),
-        )
+        key = get_performance_log_key(request, lifecycle_name)
 
-        log_timing(key, int((self.end_time - self.start_time) * 1000), server=server, port=port)
+        log_timing(key, int((end_time - start_time) * 1000), server=server, port=port)
 
 
 class DictTransformer(object):
@@ -252,39 +390,72 @@ def create_static_url(obj, mixin_name, spec=None, wrapper_class=None):
         raise Exception('Static dependency not found. %s' % asset_spec)
 
 
-def get_page_class_by_name(request, page_name):
+class IRouteIndex(Interface):
+    """ Marker for the :class:`RouteIndex` registered as utility, see :func:`get_route_index`.
     """
-    Given a page-name (the page.get_name()-result), it returns this page - or raises an error.
-    todo: This needs some caching!
+
+
+class RouteIndex(object):
+    """
+    Lookup tables for the views registered in the introspector of a registry: The page classes bound to every route, the
+    page classes by their name and the permissions required by the first view of every route.
     """
-    introspector = request.registry.introspector
 
-    for intr in introspector.get_category("views"):
-        view_callable = intr["introspectable"]["callable"]
-        if type(view_callable) is type and issubclass(view_callable, core.epflpage.Page):
-            if view_callable.get_name() == page_name:
-                return view_callable
+    def __init__(self, introspector):
+        self.pages_by_route = {}
+        self.pages_by_name = {}
+        self.route_permissions = {}
 
-    raise ValueError, "Page '" + page_name + "' not found!"
+        for intr in introspector.get_category("views"):
+            route_name = intr["introspectable"]["route_name"]
+            view_callable = intr["introspectable"]["callable"]
+            if type(view_callable) is type and issubclass(view_callable, core.epflpage.Page):
+                self.pages_by_route.setdefault(route_name, []).append(view_callable)
+                self.pages_by_name.setdefault(view_callable.get_name(), view_callable)
+            if route_name not in self.route_permissions:
+                self.route_permissions[route_name] = [r['value'] for r in intr["related"]
+                                                      if r.type_name == 'permission']
 
 
-def get_page_classes_from_route(request, route_name):
+def get_route_index(registry):
     """
-    Given the request and a route-name, it collects all Page-Objects that are bound to this route.
-    It returns a list of the page-classes.
+    Return the :class:`RouteIndex` of the registry, building it on first use. It is rebuilt after the application has
+    been created, see :func:`clear_route_index`.
+    """
+    route_index = registry.queryUtility(IRouteIndex)
+    if route_index is None:
+        route_index = RouteIndex(registry.introspector)
+        registry.registerUtility(route_index, IRouteIndex)
+    return route_index
 
-    todo: This needs some caching!
+
+def clear_route_index(event):
+    """
+    Subscriber for :class:`pyramid.events.ApplicationCreated` dropping a :class:`RouteIndex` built before all views had
+    been registered.
     """
-    introspector = request.registry.introspector
+    registry = event.app.registry
+    route_index = registry.queryUtility(IRouteIndex)
+    if route_index is not None:
+        registry.unregisterUtility(route_index, IRouteIndex)
 
-    candidates = []
-    for intr in introspector.get_category("views"):
-        if intr["introspectable"]["route_name"] == route_name:
-            view_callable = intr["introspectable"]["callable"]
-            if type(view_callable) is type and issubclass(view_callable, core.epflpage.Page):
-                candidates.append(view_callable)
 
-    return candidates
+def get_page_class_by_name(request, page_name):
+    """
+    Given a page-name (the page.get_name()-result), it returns this page - or raises an error.
+    """
+    page_class = get_route_index(request.registry).pages_by_name.get(page_name)
+    if page_class is None:
+        raise ValueError, "Page '" + page_name + "' not found!"
+    return page_class
+
+
+def get_page_classes_from_route(request, route_name):
+    """
+    Given the request and a route-name, it collects all Page-Objects that are bound to this route.
+    It returns a list of the page-classes.
+    """
+    return list(get_route_index(request.registry).pages_by_route.get(route_name, []))
 
 
 def has_permission_for_route(request, route_name, permission=None):
@@ -292,30 +463,21 @@ def has_permission_for_route(request, route_name, permission=None):
     Given a request, a route-name and a permission, it checks, if the current user has this permission for at least
     one of the page-objects that are bound to this route.
     """
+    route_index = get_route_index(request.registry)
 
-    page_objs = get_page_classes_from_route(request, route_name)
-
-    for resource in page_objs:
-        if not security.has_permission("access", resource, request):
+    for resource in route_index.pages_by_route.get(route_name, []):
+        if not core.epflacl.has_permission("access", resource, request):
             return False
 
-    default = True
-
-    views = request.registry.introspector.get_category('views')
-    for related in views:
-        if related['introspectable']['route_name'] == route_name:
-            related = related['related']
-
-            for r in related:
-                if r.type_name != 'permission':
-                    continue
-                default = False
-                if request.has_permission(r['value'], request.root):
-                    return True
+    permissions = route_index.route_permissions.get(route_name)
+    if not permissions:
+        return True
 
-            break
+    for route_permission in permissions:
+        if core.epflacl.has_permission(route_permission, request.root, request):
+            return True
 
-    return default
+    return False
 
 
 def get_component(request, tid, cid):
@@ -417,12 +579,16 @@ class Discover(object):
 
     @classmethod
     def discover_component(cls, input_class):
-        if input_class in cls.discovered_components_set:
+        if input_class in cls.discovered_components_set or '__epfl_discovered' in input_class.__dict__:
             return
-        if not getattr(input_class, '__epfl_do_not_track', False):
+        track = not getattr(input_class, '__epfl_do_not_track', False)
+        if track:
             cls.discovered_components.append(input_class)
             cls.discovered_components_set.add(input_class)
         input_class.discover()
+        if not track:
+            # Untracked classes like dynamic component classes are reused, so they remember being discovered.
+            setattr(input_class, '__epfl_discovered', True)
 
     @classmethod
     def discover_page(cls, input_class):
@@ -5,12 +5,20 @@ from solute.epfl import components
 from component_asserts import AssertCoherence, AssertRendering, AssertStyle
 
 from solute.epfl.core.epflcomponentbase import ComponentBase, ComponentContainerBase
-from solute.epfl.core.epfldescriptor import CompoStateAttribute
+from solute.epfl.core.epfldescriptor import CompoStateAttribute, Reference
 
 
 pytestmark = pytest.mark.component_api
 
 
+class ConfigHelper(object):
+    """Plain object used as mutable config value.
+    """
+
+    def __init__(self):
+        self.items = []
+
+
 @pytest.fixture(params=['static', 'dynamic'])
 def base_type(request, page, component_base_type_class):
     """Generates test scenarios for ComponentBase components.
@@ -166,3 +174,216 @@ def test_new_style_deprecation_protection(page):
 
     with pytest.raises(Exception):
         page()
+
+
+def test_dynamic_class_cache(page):
+    """Components with the same config share their dynamic class, while keeping their own UnboundComponent.
+    """
+    page.root_node = ComponentContainerBase
+    page()
+
+    first = ComponentBase(text='foo', cid='first')
+    second = ComponentBase(text='foo', cid='second')
+    other = ComponentBase(text='bar', cid='other')
+    first_compo = first(page, 'first', __instantiate__=True)
+    second_compo = second(page, 'second', __instantiate__=True)
+    other_compo = other(page, 'other', __instantiate__=True)
+
+    assert type(first_compo) is type(second_compo)
+    assert type(first_compo) is not type(other_compo)
+    assert first_compo.text == 'foo' and other_compo.text == 'bar'
+    assert first_compo.__unbound_component__ is first
+    assert second_compo.__unbound_component__ is second
+
+    # Mutable values are kept by every component, so changing them in place does not affect components sharing the
+    # class.
+    first, second = [page.root_node.add_component(ComponentBase(compo_state=['values'], values=[1], items={'a': 1}))
+                     for i in range(2)]
+    assert type(first) is type(second)
+    assert 'items' not in type(first).__dict__
+    first.items['b'] = 2
+    first.values.append(2)
+    assert second.items == {'a': 1}
+    assert second.values == [1]
+    assert first.values == [1, 2]
+
+    # Hashable objects may be mutable as well, every component keeps the object it has been configured with.
+    first_helper, second_helper = ConfigHelper(), ConfigHelper()
+    first = page.root_node.add_component(ComponentBase(helper=first_helper))
+    second = page.root_node.add_component(ComponentBase(helper=second_helper))
+    assert type(first) is type(second)
+    assert first.helper is first_helper and second.helper is second_helper
+    first.helper.items.append(1)
+    assert second.helper.items == []
+    assert page.root_node.add_component(ComponentBase(helper=ConfigHelper())).helper.items == []
+
+    # The unpicklable config gets a class of its own.
+    get_data = lambda *args: []
+    unpicklable = ComponentBase(get_data=get_data, cid='unpicklable')
+    other_unpicklable = ComponentBase(get_data=get_data, cid='other_unpicklable')
+    assert type(unpicklable(page, 'unpicklable', __instantiate__=True)) is not \
+        type(other_unpicklable(page, 'other_unpicklable', __instantiate__=True))
+
+
+def test_add_components(page):
+    """Several components are added to a container in a single step and initialized in order.
+    """
+    page.root_node = ComponentContainerBase(node_list=[ComponentBase(cid='first'), ComponentBase(cid='last')])
+    page()
+    root_node = page.root_node
+
+    initialized = []
+
+    class TrackedComponent(ComponentBase):
+        def init_transaction(self):
+            super(TrackedComponent, self).init_transaction()
+            initialized.append(self.text)
+
+    compo_objs = root_node.add_components([TrackedComponent(text=str(i)) for i in range(3)], position=1)
+    assert initialized == ['0', '1', '2']
+    assert [compo_obj.text for compo_obj in compo_objs] == ['0', '1', '2']
+    assert list(root_node.compo_struct) == ['first'] + [compo_obj.cid for compo_obj in compo_objs] + ['last']
+
+    # Known cids keep their existing entry, as with add_component.
+    struct = list(root_node.compo_struct)
+    compo_objs = root_node.add_components([ComponentBase(cid='first', text='new'), ComponentBase(cid='new'),
+                                           ComponentBase(cid='new', text='duplicate')])
+    assert [compo_obj.cid for compo_obj in compo_objs] == ['first', 'new', 'new']
+    assert not hasattr(compo_objs[0], 'text') and not hasattr(compo_objs[2], 'text')
+    assert list(root_node.compo_struct) == struct + ['new']
+    assert not hasattr(root_node.add_component(ComponentBase(cid='new', text='single')), 'text')
+    assert list(root_node.compo_struct) == struct + ['new']
+    assert set(root_node.compo_struct).issubset(page.transaction['__initialized_components__'])
+
+    # Generated cids are generated again if they are already in use.
+    ubc = ComponentBase()
+    cids = root_node.register_components([ubc, ubc])
+    assert len(set(cids)) == 2
+    assert list(root_node.compo_struct)[-2:] == cids
+
+
+def test_component_list(page):
+    """ComponentList supports slices and gives access to the cids and entries of the children without instantiating
+    them.
+    """
+    page.root_node = ComponentContainerBase(node_list=[ComponentBase(cid='child%s' % i) for i in range(5)])
+    page()
+    components = page.root_node.components
+    transaction = page.transaction
+    transaction.instances.clear()
+
+    assert components.cids == ['child%s' % i for i in range(5)]
+    assert [compo_info['cid'] for compo_info in components.compo_infos] == components.cids
+    assert not transaction.instances
+
+    assert [compo_obj.cid for compo_obj in components[1:3]] == ['child1', 'child2']
+    assert sorted(transaction.instances.keys()) == ['child1', 'child2']
+    assert components[-1].cid == 'child4'
+
+    cids = []
+    for compo_obj in components:
+        cids.append(compo_obj.cid)
+        if compo_obj.cid == 'child0':
+            page.root_node.del_component('child1')
+    assert cids == ['child0', 'child2', 'child3', 'child4']
+
+
+def test_state_cache(page):
+    """Hashable compo_state values are cached by the instance until they are set again.
+    """
+    page.root_node = ComponentContainerBase(node_list=[ComponentBase(cid='child', value='foo', name=['a'])])
+    page()
+    child = page.child
+    child._state_cache.clear()
+
+    assert child.value == 'foo'
+    assert child._state_cache['value'] == 'foo'
+    child.value = 'bar'
+    assert 'value' not in child._state_cache
+    assert child.value == 'bar'
+    assert page.transaction.get_component('child')['compo_state']['value'] == 'bar'
+
+    # Mutable values are not cached, since they may be changed in place.
+    child.name.append('b')
+    assert 'name' not in child._state_cache
+    assert child.name == ['a', 'b']
+
+
+def test_reference_cache(page):
+    """References made up of container_compo and page steps are resolved once until the component tree changes.
+    """
+    child = ComponentBase(cid='child',
+                          grandparent=Reference().container_compo.container_compo,
+                          parent_cid=Reference().container_compo.cid)
+    page.root_node = ComponentContainerBase(node_list=[ComponentContainerBase(cid='first', node_list=[child]),
+                                                       ComponentContainerBase(cid='second')])
+    page()
+    child = page.child
+
+    assert child.grandparent is page.root_node
+    assert child.parent_cid == 'first'
+    assert page.transaction.get_reference_target('child', type(child).grandparent) is page.root_node
+
+    page.transaction.switch_component('child', 'second')
+    with pytest.raises(KeyError):
+        page.transaction.get_reference_target('child', type(child).grandparent)
+    assert child.parent_cid == 'second'
+    assert child.grandparent is page.root_node
+
+    # Only the container_compo and page steps are cached, other targets are read on every access.
+    page.transaction.set_reference_target('child', type(child).grandparent, None)
+    assert child.grandparent is None
+    with pytest.raises(KeyError):
+        page.transaction.get_reference_target('child', type(child).parent_cid)
+
+
+def test_lazy_compo_config(page):
+    """compo_config attributes are copied into an instance on first access only.
+    """
+    page.root_node = ComponentContainerBase(node_list=[ComponentBase(cid='child')])
+    page()
+    root_node = page.root_node
+    container_cls = type(root_node)
+    root_node.__dict__.pop('node_list', None)
+
+    # Lists are kept by the instances of the dynamic class, not by the class itself.
+    assert 'node_list' in container_cls._instance_config
+    assert container_cls.node_list == []
+    assert root_node.node_list == [ComponentBase(cid='child')]
+    assert 'node_list' in root_node.__dict__
+    root_node.node_list.append(ComponentBase(cid='other'))
+    assert len(root_node.__unbound_component__.__unbound_config__['node_list']) == 1
+
+    compo_obj = ComponentContainerBase(cid='configured')(page, 'configured', __instantiate__=True)
+    assert 'node_list' not in compo_obj.__dict__
+    assert compo_obj.node_list == [] and compo_obj.node_list is not ComponentContainerBase.node_list
+
+
+def test_permission_cache(page, monkeypatch):
+    """Permission decisions are evaluated once per request for equal acls and principals.
+    """
+    from pyramid.authentication import RemoteUserAuthenticationPolicy
+    from pyramid.authorization import ACLAuthorizationPolicy
+    from pyramid.interfaces import IAuthenticationPolicy, IAuthorizationPolicy
+    from solute.epfl.core import epflacl
+
+    request = page.request
+    request.registry.registerUtility(RemoteUserAuthenticationPolicy(), IAuthenticationPolicy)
+    request.registry.registerUtility(ACLAuthorizationPolicy(), IAuthorizationPolicy)
+    calls = []
+    permits = ACLAuthorizationPolicy.permits
+    monkeypatch.setattr(ACLAuthorizationPolicy, 'permits', lambda *args: calls.append(args) or permits(*args))
+    monkeypatch.setattr(ComponentBase, '_access', None)
+
+    page.root_node = ComponentContainerBase(node_list=[ComponentBase(cid='child%s' % i) for i in range(5)])
+    page()
+    assert all(compo_obj.has_access() for compo_obj in page.root_node.components)
+    assert len(calls) == 1
+
+    assert not epflacl.has_permission('access', epflacl.ACL([('Deny', 'system.Everyone', ['access'])]), request)
+    assert not epflacl.has_permission('access', epflacl.ACL([('Deny', 'system.Everyone', ['access'])]), request)
+    assert len(calls) == 2
+
+    epflacl.clear_permission_cache(request)
+    assert epflacl.has_permission('access', page.child0, request)
+    assert len(calls) == 3
@@ -524,3 +524,424 @@ def test_css_js_combination():
     assert css_name[4] == PageWithCSSandJS.css_name
     assert css_name[5] != PageWithCSSandJSNoBundle.css_name
     assert css_name[5] + PageWithCSSandJSNoBundle.css_name_no_bundle == PageWithCSSandJSNoBundle.css_name
+
+
+def test_child_config_delta(pyramid_req):
+    """Children created from the default_child_cls of their container only store the config differing from the one of
+    their siblings, but are regenerated with their complete config.
+    """
+
+    class ChildList(ComponentContainerBase):
+        default_child_cls = ComponentBase(label='default')
+        rows = [{'id': 1, 'text': 'foo'}, {'id': 2, 'text': 'bar'}]
+
+        def get_data(self, *args, **kwargs):
+            return self.rows
+
+    page = Page(None, pyramid_req)
+    page.root_node = ChildList(node_list=[
+        ComponentContainerBase(cid='other_node', node_list=[ComponentBase(cid='other_child')])
+    ])
+    page.handle_transaction()
+    t = page.transaction
+
+    first_cid, second_cid = [c.cid for c in page.root_node.components if c.cid != 'other_node']
+    assert t.get_component(second_cid)['config'] == {'id': 2, 'text': 'bar', '__autogen_cid__': second_cid}
+    assert t.get_component_config(second_cid)['label'] == 'default'
+
+    new_page = Page(None, pyramid_req, transaction=t)
+    new_page.handle_transaction()
+    assert getattr(new_page, second_cid).label == 'default'
+    assert getattr(new_page, second_cid).text == 'bar'
+
+    # Moving a child out of its container stores its complete config.
+    t.switch_component(first_cid, 'other_node')
+    assert t.get_component(first_cid)['config']['label'] == 'default'
+    assert 'template_cid' not in t.get_component(first_cid)
+
+    # Sleeping children are still found by their id.
+    ChildList.rows = [{'id': 1, 'text': 'foo'}]
+    new_page.root_node.update_children(force=True)
+    assert new_page.root_node.sleeping_children == {2: second_cid}
+
+
+def test_child_config_template_copies(pyramid_req):
+    """Mutable config values taken from the template of a container are not shared by the children.
+    """
+
+    class ChildList(ComponentContainerBase):
+        default_child_cls = ComponentBase(tags=['default'])
+        rows = [{'id': i, 'text': 'row %s' % i} for i in range(3)]
+
+        def get_data(self, *args, **kwargs):
+            return self.rows
+
+    page = Page(None, pyramid_req)
+    page.root_node = ChildList()
+    page.handle_transaction()
+    t = page.transaction
+    cids = list(page.root_node.compo_struct)
+    assert 'template_cid' in t.get_component(cids[2])
+
+    t.instances.clear()
+    new_page = Page(None, pyramid_req, transaction=t)
+    new_page.handle_transaction()
+    getattr(new_page, cids[1]).tags.append('changed')
+    assert getattr(new_page, cids[2]).tags == ['default']
+    assert t.get_component_config(cids[2])['tags'] == ['default']
+    assert t.get_component_config(cids[1])['tags'] is not t.get_component_config(cids[2])['tags']
+
+
+def test_virtual_window(pyramid_req):
+    """Containers with a virtual_window only instantiate the children inside the window, the others are kept as
+    transaction entries and compared to the data without instantiating them.
+    """
+
+    class VirtualList(ComponentContainerBase):
+        default_child_cls = ComponentBase(label='default')
+        virtual_window = True
+        row_limit = 10
+        rows = [{'id': i, 'text': 'row %s' % i} for i in range(100)]
+
+        def get_data(self, row_offset, row_limit, row_data):
+            assert (row_offset, row_limit) == (0, None)
+            return self.rows
+
+    page = Page(None, pyramid_req)
+    page.root_node = VirtualList(cid='root_node')
+    page.handle_transaction()
+    t = page.transaction
+
+    assert page.root_node.row_count == 100
+    assert len(page.root_node.compo_struct) == 100
+    assert len(page.root_node.window_components) == 10
+    assert [c.text for c in page.root_node.window_components] == ['row %s' % i for i in range(10)]
+    assert len(t['__initialized_components__']) == 11
+    assert len(t.instances) == 11
+    assert len(page.root_node.components) == 100
+
+    # Moving the window instantiates the children inside of it.
+    page.root_node.handle_set_row(50, 10, {})
+    assert page.root_node.redraw_requested
+    assert [c.text for c in page.root_node.window_components] == ['row %s' % i for i in range(50, 60)]
+    assert len(t['__initialized_components__']) == 21
+
+    # Changed rows outside of the window are recreated without being instantiated.
+    old_cid = page.root_node.compo_struct[0]
+    VirtualList.rows = [{'id': i, 'text': 'new row %s' % i if i == 0 else 'row %s' % i} for i in range(101)]
+    new_page = Page(None, pyramid_req, transaction=t)
+    new_page.handle_transaction()
+    new_page.root_node.update_children(force=True)
+    assert new_page.root_node.row_count == 101
+    assert len(new_page.root_node.compo_struct) == 101
+    assert old_cid not in new_page.root_node.compo_struct
+    assert t.get_component_config(new_page.root_node.compo_struct[0])['text'] == 'new row 0'
+    assert [c.text for c in new_page.root_node.window_components] == ['row %s' % i for i in range(50, 60)]
+    assert new_page.root_node.compo_struct[0] not in t.instances
+    assert new_page.root_node.compo_struct[0] not in t['__initialized_components__']
+
+    # Only the window is rendered.
+    new_page.root_node.render_cache = None
+    out = new_page.root_node.render()
+    compo_struct = new_page.root_node.compo_struct
+    assert 'epflid="%s"' % compo_struct[50] in out and 'epflid="%s"' % compo_struct[60] not in out
+    assert new_page.root_node.compo_struct[0] not in t.instances
+
+    # Indexing covers all children, children outside of the window are instantiated on access.
+    assert new_page.root_node.components[0].text == 'new row 0'
+    assert new_page.root_node.compo_struct[0] in t['__initialized_components__']
+
+    # Iteration covers all children as well, so values and validation include the ones outside of the window.
+    assert len(list(new_page.root_node.components)) == 101
+    for i, compo_obj in enumerate(new_page.root_node.components):
+        compo_obj.name, compo_obj.value = 'row_%s' % i, i
+    assert len(new_page.root_node.get_values()) == 101
+    assert new_page.root_node.validate() is True
+    new_page.root_node.components[0]._validate = lambda: False
+    assert new_page.root_node.validate() is False
+
+    # Without a row_limit all children are part of the window.
+    new_page.root_node.row_limit = None
+    assert new_page.root_node.get_window() == (0, 101)
+    assert new_page.root_node.in_window(100)
+    assert len(new_page.root_node.window_components) == 101
+
+
+def test_lazy_update_children(pyramid_req):
+    """Containers with lazy_update_children only call get_data again if its parameters changed or they have been
+    invalidated.
+    """
+
+    class LazyList(ComponentContainerBase):
+        default_child_cls = ComponentBase(label='default')
+        lazy_update_children = True
+        calls = []
+
+        def get_data(self, row_offset, row_limit, row_data):
+            LazyList.calls.append((row_offset, row_limit))
+            return [{'id': i, 'text': 'row %s' % i} for i in range(row_offset, row_offset + 3)]
+
+    page = Page(None, pyramid_req)
+    page.root_node = LazyList(cid='root_node')
+    page.handle_transaction()
+    assert LazyList.calls == [(0, 30)]
+
+    def next_request(handler=None):
+        new_page = Page(None, pyramid_req, transaction=page.transaction)
+        new_page.handle_transaction()
+        if handler:
+            handler(new_page.root_node)
+        new_page.root_node.after_event_handling()
+        return new_page
+
+    next_request()
+    assert LazyList.calls == [(0, 30)]
+
+    next_request(lambda compo: compo.invalidate())
+    assert LazyList.calls == [(0, 30), (0, 30)]
+
+    new_page = next_request(lambda compo: compo.handle_set_row(10, 30, {}))
+    assert LazyList.calls == [(0, 30), (0, 30), (10, 30)]
+    assert [c.text for c in new_page.root_node.components] == ['row 10', 'row 11', 'row 12']
+
+    next_request(lambda compo: compo.row_data.update({'search': 'foo'}))
+    assert len(LazyList.calls) == 4
+
+
+def test_data_index(pyramid_req):
+    """Containers keep the data ids and row fingerprints of their children, so only children of changed rows are
+    instantiated by update_children.
+    """
+
+    class IndexedList(ComponentContainerBase):
+        default_child_cls = ComponentBase(label='default')
+        rows = [{'id': i, 'text': 'row %s' % i} for i in range(10)]
+
+        def get_data(self, *args, **kwargs):
+            return self.rows
+
+    page = Page(None, pyramid_req)
+    page.root_node = IndexedList(cid='root_node')
+    page.handle_transaction()
+    t = page.transaction
+    cids = list(page.root_node.compo_struct)
+    assert t.get_component('root_node')['data_index'][cids[3]][0] == 3
+
+    def next_request():
+        new_page = Page(None, pyramid_req, transaction=t)
+        new_page.handle_transaction()
+        t.instances.clear()
+        t.instances['root_node'] = new_page.root_node
+        new_page.root_node.update_children(force=True)
+        return new_page
+
+    next_request()
+    assert t.instances.keys() == ['root_node']
+
+    IndexedList.rows = [{'id': i, 'text': 'new row %s' % i if i == 3 else 'row %s' % i} for i in range(10)]
+    new_page = next_request()
+    assert sorted(t.instances.keys()) == sorted(['root_node', cids[3]])
+    assert getattr(new_page, cids[3]).text == 'new row 3'
+    assert list(new_page.root_node.compo_struct) == cids
+
+    # The data ids are read from the data_index without loading the entries of the children.
+    loaded = []
+    get_component = t.get_component
+    t.get_component = lambda cid: loaded.append(cid) or get_component(cid)
+    try:
+        assert new_page.root_node.get_child_data_ids() == [(cid, i) for i, cid in enumerate(cids)]
+    finally:
+        del t.get_component
+    assert not set(loaded).intersection(cids)
+
+
+def test_route_index(pyramid_req, config):
+    """The pages and permissions of routes are looked up in an index built from the registered views.
+    """
+    from solute.epfl.core import epflutil
+
+    class IndexedPage(Page):
+        pass
+
+    class ProtectedPage(Page):
+        pass
+
+    config.add_route('indexed_route', pattern='/indexed')
+    config.add_route('protected_route', pattern='/protected')
+    config.add_view(IndexedPage, route_name='indexed_route')
+    config.add_view(ProtectedPage, route_name='protected_route', permission='secret')
+    config.commit()
+
+    assert epflutil.get_page_classes_from_route(pyramid_req, 'indexed_route') == [IndexedPage]
+    assert epflutil.get_page_classes_from_route(pyramid_req, 'unknown_route') == []
+    page_name = ProtectedPage.get_name()
+    assert epflutil.get_page_class_by_name(pyramid_req, page_name).get_name() == page_name
+    with pytest.raises(ValueError):
+        epflutil.get_page_class_by_name(pyramid_req, 'unknown')
+    assert epflutil.get_route_index(pyramid_req.registry).route_permissions['protected_route'] == ['secret']
+    assert epflutil.has_permission_for_route(pyramid_req, 'indexed_route')
+
+    # The index is rebuilt once the application has been created.
+    config.add_route('other_route', pattern='/other')
+    config.add_view(IndexedPage, route_name='other_route')
+    config.commit()
+    assert epflutil.get_page_classes_from_route(pyramid_req, 'other_route') == []
+    config.make_wsgi_app()
+    assert epflutil.get_page_classes_from_route(pyramid_req, 'other_route') == [IndexedPage]
+
+
+def test_nav_cache(pyramid_req, monkeypatch):
+    """The links of EPFLView navigation lists are filtered once per set of principals.
+    """
+    from pyramid.authentication import RemoteUserAuthenticationPolicy
+    from pyramid.authorization import ACLAuthorizationPolicy
+    from pyramid.interfaces import IAuthenticationPolicy, IAuthorizationPolicy
+    from solute.epfl.core import epflacl
+    from pyramid.registry import Registry
+    from solute.epfl.core.epflassets import EPFLViewLinks, get_nav_cache
+    from solute.epfl.components.link_list_layout import link_list_layout
+
+    pyramid_req.registry.registerUtility(RemoteUserAuthenticationPolicy(), IAuthenticationPolicy)
+    pyramid_req.registry.registerUtility(ACLAuthorizationPolicy(), IAuthorizationPolicy)
+    checked = []
+    monkeypatch.setattr(link_list_layout, 'has_permission_for_route',
+                        lambda request, route: checked.append(route) or route != 'hidden')
+
+    links = [{'id': 1, 'route': 'first', 'text': 'First', 'rank': 2},
+             {'id': 2, 'route': 'hidden', 'text': 'Hidden'},
+             {'id': 3, 'route': 'second', 'text': 'Second', 'rank': 1}]
+
+    def render_nav():
+        page = Page(None, pyramid_req)
+        page.root_node = EPFLViewLinks(cid='root_node', links=links)
+        page.handle_transaction()
+        return [compo_obj.text for compo_obj in page.root_node.components]
+
+    assert render_nav() == ['Second', 'First']
+    assert len(checked) == 3
+    assert render_nav() == ['Second', 'First']
+    assert len(checked) == 3
+
+    # Other principals get their own entry.
+    pyramid_req.environ['REMOTE_USER'] = 'user'
+    epflacl.clear_permission_cache(pyramid_req)
+    assert render_nav() == ['Second', 'First']
+    assert len(checked) == 6
+
+    # The cache is kept per registry.
+    assert len(get_nav_cache(pyramid_req.registry).entries) == 2
+    assert len(get_nav_cache(Registry()).entries) == 0
+
+    get_nav_cache(pyramid_req.registry).clear()
+    render_nav()
+    assert len(checked) == 9
+
+
+def test_lifecycle_trace(pyramid_req):
+    """With epfl.lifecycle.trace set the lifecycle stages of a request are recorded as span tree.
+    """
+    import json
+    from pyramid import testing, threadlocal
+    from solute.epfl.core import epflutil
+
+    page = Page(None, pyramid_req)
+    page.root_node = ComponentContainerBase(cid='root_node', node_list=[ComponentBase(cid='child')])
+
+    pyramid_req.registry.settings['epfl.lifecycle.trace'] = True
+    threadlocal.manager.push({'request': pyramid_req, 'registry': pyramid_req.registry})
+    try:
+        page.handle_transaction()
+        page.after_event_handling()
+        page.render()
+    finally:
+        threadlocal.manager.pop()
+        del pyramid_req.registry.settings['epfl.lifecycle.trace']
+
+    assert epflutil.Lifecycle.get_state() == []
+    assert epflutil.get_lifecycle_trace(testing.DummyRequest(), create=True) is None
+
+    trace = epflutil.get_lifecycle_trace(pyramid_req)
+    assert [span.label for span in trace.spans] == ['Page:page.handle_transaction', 'Page:page.after_event_handling',
+                                                     'Page:page.render']
+    assert [span.label for span in trace.spans[0].children][:2] == [
+        'Page:page.setup_components', 'ComponentContainerBase:container_component.init_transaction']
+    assert trace.stack == []
+
+    render = trace.to_dict()['spans'][2]
+    root_render = render['children'][0]
+    assert root_render['name'] == 'ComponentContainerBase:component.render'
+    assert root_render['cid'] == 'root_node'
+    assert 'child' in [span['cid'] for span in root_render['children']]
+    assert json.loads(trace.to_json()) == json.loads(json.dumps(trace.to_dict()))
+
+    collapsed = dict(line.rsplit(' ', 1) for line in trace.to_collapsed().splitlines())
+    assert 'Page:page.render;ComponentContainerBase:component.render;ComponentBase:component.render' in collapsed
+    assert all(value.isdigit() for value in collapsed.values())
+
+
+def test_lifecycle_trace_only(pyramid_req, monkeypatch):
+    """Component renders are only checked in as lifecycle stage while a trace is recorded.
+    """
+    from pyramid import threadlocal
+    from solute.epfl.core import epflutil
+
+    page = Page(None, pyramid_req)
+    page.root_node = ComponentContainerBase(cid='root_node', node_list=[ComponentBase(cid='child')])
+
+    stages = []
+    checkin = epflutil.Lifecycle.checkin
+
+    def record_checkin(self, obj=None):
+        stages.append(self.name)
+        return checkin(self, obj)
+
+    monkeypatch.setattr(epflutil.Lifecycle, 'checkin', record_checkin)
+    threadlocal.manager.push({'request': pyramid_req, 'registry': pyramid_req.registry})
+    try:
+        page.handle_transaction()
+        page.after_event_handling()
+        out = page.render()
+    finally:
+        threadlocal.manager.pop()
+
+    assert 'epflid="child"' in out
+    assert ('page', 'render') in stages
+    assert ('component', 'render') not in stages
+    assert epflutil.Lifecycle.get_state() == []
+
+
+def test_ajax_redraw(pyramid_req):
+    """Components redrawn during an AJAX request are replaced starting with the outermost one, the JS of their
+    children is sent along with them.
+    """
+    from solute.epfl import components
+
+    page = Page(None, pyramid_req)
+    page.root_node = ComponentContainerBase(
+        node_list=[ComponentContainerBase(cid='parent', node_list=[components.Button(cid='child', value='Child')]),
+                   components.Button(cid='other', value='Other')])
+    page.handle_transaction()
+    t = page.transaction
+
+    pyramid_req.is_xhr = True
+    page = Page(None, pyramid_req, transaction=t)
+    page.handle_transaction()
+    for cid in ['child', 'parent', 'other']:
+        getattr(page, cid).redraw()
+    out = page.render()
+
+    assert out.count("epfl.replace_component('parent'") == 1
+    assert "epfl.replace_component('child'" not in out
+    assert out.count("epfl.replace_component('other'") == 1
+    assert 'epfl.init_component(\\"child\\"' in out
+
+    # Children of a hidden container are not rendered along with it, so they are replaced on their own.
+    t.instances.clear()
+    page = Page(None, pyramid_req, transaction=t)
+    page.handle_transaction()
+    page.parent.set_hidden()
+    page.parent.redraw()
+    page.child.redraw()
+    out = page.render()
+    assert out.count("epfl.replace_component('parent'") == 1
+    assert out.count("epfl.replace_component('child'") == 1
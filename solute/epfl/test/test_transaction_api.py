@@ -1,7 +1,12 @@
+import random
 import time
+import cPickle as pickle
+from contextlib import contextmanager
+
 import pytest
 
-from solute.epfl.core.epfltransaction import Transaction
+from solute.epfl.core.epfltransaction import Transaction, CompoStruct
+from solute.epfl.core import epfltransactionstore
 from collections2.dicts import OrderedDict
 
 
@@ -85,6 +90,187 @@ def test_has_component(pyramid_req):
     assert not transaction.has_component('root_node')
 
 
+def test_component_tree_index(pyramid_req):
+    """Parents, depths and ancestors of components follow changes to the component tree.
+    """
+    transaction = Transaction(pyramid_req, None)
+    transaction.set_component('root_node', {})
+    transaction.set_component('box', {'ccid': 'root_node'})
+    transaction.set_component('other_box', {'ccid': 'root_node'})
+    transaction.set_component('child_node', {'ccid': 'box', 'config': {'id': 1}})
+    transaction.set_component('grand_child_node', {'ccid': 'child_node'})
+
+    assert transaction.get_component_depth('root_node') == 0
+    assert transaction.get_component_depth('grand_child_node') == 3
+    assert transaction.get_component_ancestors('grand_child_node') == ['child_node', 'box', 'root_node']
+    assert transaction.has_ancestor('grand_child_node', set(['box']))
+    assert not transaction.has_ancestor('grand_child_node', set(['other_box', 'grand_child_node']))
+
+    transaction.switch_component('child_node', 'root_node')
+    assert transaction.get_component_depth('grand_child_node') == 2
+    assert transaction.get_component_ancestors('grand_child_node') == ['child_node', 'root_node']
+
+    transaction.hibernate_component_id('child_node')
+    transaction.wake_component_id('root_node', 1)
+    assert transaction.get_component_depth('grand_child_node') == 2
+
+    transaction.del_component('child_node')
+    assert transaction.get_component_parent('grand_child_node') is None
+    assert transaction.get_component_depth('grand_child_node') == 0
+
+    transaction.store()
+    transaction = Transaction(pyramid_req, None, transaction.get_id())
+    assert transaction.get_component_ancestors('other_box') == ['root_node']
+
+
+def test_compo_struct():
+    """A CompoStruct behaves like a list of unique component ids while keeping them in blocks.
+    """
+    class SmallCompoStruct(CompoStruct):
+        block_size = 2
+
+    cids = ['c%s' % i for i in range(20)]
+    compo_struct = SmallCompoStruct(cids)
+    assert compo_struct == cids
+    assert len(compo_struct.blocks) > 1
+
+    compo_struct.insert(3, 'new')
+    cids.insert(3, 'new')
+    compo_struct.remove('c10')
+    cids.remove('c10')
+    compo_struct.insert(100, 'last')
+    cids.insert(100, 'last')
+    del compo_struct[0]
+    del cids[0]
+    compo_struct[-1] = 'other'
+    cids[-1] = 'other'
+
+    assert compo_struct == cids
+    assert compo_struct[5] == cids[5]
+    assert compo_struct[-2] == cids[-2]
+    assert compo_struct[2:6] == cids[2:6]
+    assert compo_struct[-7:100] == cids[-7:100]
+    assert compo_struct[5:3] == cids[5:3] == []
+    assert compo_struct[::3] == cids[::3]
+    assert [compo_struct.index(cid) for cid in cids] == range(len(cids))
+    assert 'new' in compo_struct and 'c10' not in compo_struct
+    with pytest.raises(ValueError):
+        compo_struct.index('c10')
+
+    while compo_struct:
+        compo_struct.remove(compo_struct[len(compo_struct) / 2])
+    assert compo_struct == [] and compo_struct.blocks == []
+
+    compo_struct = pickle.loads(pickle.dumps(SmallCompoStruct(cids), pickle.HIGHEST_PROTOCOL))
+    assert isinstance(compo_struct, CompoStruct) and compo_struct == cids
+
+    # The block offsets used for lookups follow every change.
+    rng = random.Random(0)
+    compo_struct, cids = SmallCompoStruct(), []
+    for i in range(300):
+        if cids and rng.random() < 0.4:
+            cid = rng.choice(cids)
+            compo_struct.remove(cid)
+            cids.remove(cid)
+        else:
+            position = rng.randint(0, len(cids))
+            compo_struct.insert(position, 'r%s' % i)
+            cids.insert(position, 'r%s' % i)
+        assert compo_struct.offsets == [sum(len(block) for block in compo_struct.blocks[:i])
+                                        for i in range(len(compo_struct.blocks))]
+    assert compo_struct == cids
+    assert [compo_struct.index(cid) for cid in cids] == range(len(cids))
+    assert [compo_struct[i] for i in range(len(cids))] == cids
+
+
+def test_large_container(pyramid_req, monkeypatch):
+    """Containers switch to a CompoStruct once they have many children.
+    """
+    monkeypatch.setattr(CompoStruct, 'min_size', 4)
+    transaction = Transaction(pyramid_req, None)
+    transaction.set_component('root_node', {})
+    transaction.set_component('other_node', {})
+    for i in range(10):
+        transaction.set_component('child_node%s' % i, {'ccid': 'root_node'}, position=0)
+    compo_struct = transaction.get_component('root_node')['compo_struct']
+    assert isinstance(compo_struct, CompoStruct)
+    assert compo_struct == ['child_node%s' % i for i in reversed(range(10))]
+
+    transaction.switch_component('child_node9', 'other_node')
+    transaction.switch_component('child_node0', 'root_node', position=0)
+    assert compo_struct[:2] == ['child_node0', 'child_node8']
+    assert transaction.get_component('other_node')['compo_struct'] == ['child_node9']
+
+    transaction.store()
+    transaction = Transaction(pyramid_req, None, transaction.get_id())
+    assert transaction.get_component('root_node')['compo_struct'].index('child_node1') == 8
+
+
+def test_reorder_children(pyramid_req):
+    """Reordering the children of a container only moves the ones out of order relative to the others.
+    """
+    transaction = Transaction(pyramid_req, None)
+    transaction.set_component('root_node', {})
+    for i in range(6):
+        transaction.set_component('child_node%s' % i, {'ccid': 'root_node'})
+
+    # A single child inserted at the top moves only that child.
+    cids = ['child_node%s' % i for i in [5, 1, 2, 3, 4]]
+    assert transaction.reorder_children('root_node', cids, offset=1) == ['child_node5']
+    assert transaction.get_component('root_node')['compo_struct'] == ['child_node0'] + cids
+    assert transaction.reorder_children('root_node', cids, offset=1) == []
+
+    cids = ['child_node%s' % i for i in [4, 3, 1, 2, 5]]
+    assert len(transaction.reorder_children('root_node', cids, offset=1)) == 3
+    assert transaction.get_component('root_node')['compo_struct'] == ['child_node0'] + cids
+
+
+def test_max_sleeping_children(pyramid_req):
+    """Hibernated children beyond max_sleeping_children are deleted, starting with the one hibernated first.
+    """
+    transaction = Transaction(pyramid_req, None)
+    transaction.max_sleeping_children = 2
+    transaction.set_component('root_node', {})
+    for i in range(4):
+        transaction.set_component('child_node%s' % i, {'ccid': 'root_node', 'config': {'id': i}})
+    transaction['__initialized_components__'] = {'child_node0'}
+
+    for i in range(3):
+        transaction.hibernate_component_id('child_node%s' % i)
+    root_node = transaction.get_component('root_node')
+    assert root_node['sleeping_compo_struct'] == {1: 'child_node1', 2: 'child_node2'}
+    assert root_node['compo_struct'] == ['child_node3']
+    assert not transaction.has_component('child_node0')
+    assert 'child_node0' not in transaction['__initialized_components__']
+
+    transaction.wake_component_id('root_node', 1)
+    transaction.hibernate_component_id('child_node3')
+    transaction.hibernate_component_id('child_node1')
+    assert root_node['sleeping_compo_struct'].keys() == [3, 1]
+    assert root_node['compo_struct'] == []
+
+    # Evicted children are deleted along with their descendants, hibernated ones included.
+    transaction.set_component('container', {'ccid': 'root_node', 'config': {'id': 4}})
+    transaction.set_component('grandchild', {'ccid': 'container', 'config': {'id': 0}})
+    transaction.set_component('sleeping_grandchild', {'ccid': 'container', 'config': {'id': 1}})
+    transaction.set_component('great_grandchild', {'ccid': 'grandchild'})
+    transaction.hibernate_component_id('sleeping_grandchild')
+    transaction['__initialized_components__'].update(['container', 'grandchild', 'great_grandchild',
+                                                      'sleeping_grandchild'])
+    transaction.wake_component_id('root_node', 3)
+    transaction.wake_component_id('root_node', 1)
+    for cid in ['container', 'child_node3', 'child_node1']:
+        transaction.hibernate_component_id(cid)
+    assert root_node['sleeping_compo_struct'].keys() == [3, 1]
+    for cid in ['container', 'grandchild', 'sleeping_grandchild', 'great_grandchild']:
+        assert not transaction.has_component(cid)
+    assert transaction['__initialized_components__'] == set()
+
+    # Without max_sleeping_children all hibernated children are kept.
+    transaction = Transaction(pyramid_req, None)
+    assert transaction.max_sleeping_children == 0
+
+
 def test_performance_has_and_set_component(pyramid_req):
     """Testing the performance of has_component and set_component.
     """
@@ -119,3 +305,495 @@ def test_duplicated_cid_on_set_component(pyramid_req):
 
     with pytest.raises(Exception):
         transaction.set_component('child_node_0', {})
+
+
+def test_change_tracking(pyramid_req):
+    """Changes made through the transaction api have to be recorded, storing resets the recorded changes.
+    """
+    transaction = Transaction(pyramid_req, None)
+    transaction.set_component('root_node', {})
+    assert not transaction.is_clean
+
+    transaction.store()
+    assert transaction.is_clean
+
+    transaction.set_component('child_node', {'ccid': 'root_node'})
+    assert transaction.get_dirty_components() == {'root_node', 'child_node'}
+    transaction.store()
+
+    transaction['some_key'] = 'some_value'
+    assert transaction.get_dirty_keys() == {'some_key'}
+    assert transaction.get_dirty_components() == set()
+    transaction.store()
+
+    transaction.del_component('child_node')
+    assert transaction.get_dirty_components() == {'root_node', 'child_node'}
+    transaction.store()
+
+    # A reloaded transaction has to be clean and contain the stored data.
+    reloaded_transaction = Transaction(pyramid_req, None, transaction.get_id())
+    assert reloaded_transaction.is_clean
+    assert reloaded_transaction['some_key'] == 'some_value'
+    assert reloaded_transaction['compo_store'].keys() == ['root_node']
+    assert reloaded_transaction.get_component('root_node')['compo_struct'] == []
+
+
+def test_unknown_tid(pyramid_req):
+    """A tid missing from the transaction store, e.g. because it expired, starts over as a new transaction.
+    """
+    from solute.epfl.core.epflpage import Page
+
+    transaction = Transaction(pyramid_req, None, 'unknown_tid')
+    assert transaction.created
+    assert not transaction.stored
+
+    pyramid_req.params['tid'] = 'unknown_tid'
+    page = Page(None, pyramid_req)
+    assert page.transaction.get_id() == 'unknown_tid'
+    assert page.transaction['__initialized_components__'] == set()
+    assert page.transaction.get_page_name() == page.get_name()
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """Fixture to access an in-process redis server provided by fakeredis.
+    """
+    fakeredis = pytest.importorskip('fakeredis')
+    from redis.client import Pipeline
+
+    def load_scripts(pipe):
+        # fakeredis does not implement SCRIPT EXISTS, so scripts used in pipelines are loaded unconditionally.
+        for script in pipe.scripts:
+            script.sha = script.registered_client.script_load(script.script)
+
+    monkeypatch.setattr(Pipeline, 'load_scripts', load_scripts)
+    return fakeredis.FakeStrictRedis()
+
+
+class FakeRedisContextTransactionStore(epfltransactionstore.RedisContextTransactionStore):
+    """The redis_context transaction store using the redis client it has been created with."""
+
+    def __init__(self, settings, redis):
+        super(FakeRedisContextTransactionStore, self).__init__(settings)
+        self.redis_client = redis
+
+    @contextmanager
+    def redis_context(self):
+        yield self.redis_client
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis', 'redis_context', 'redis_hash'])
+def transaction_store(request, tmpdir):
+    """Fixture to access the transaction stores, the redis stores are backed by fakeredis.
+    """
+    settings = {'epfl.transaction.store': request.param,
+                'epfl.transaction.sqlite.path': str(tmpdir.join('transactions.sqlite'))}
+    if request.param == 'redis_context':
+        return FakeRedisContextTransactionStore(settings, request.getfixturevalue('fake_redis'))
+
+    transaction_store = epfltransactionstore.create_transaction_store(settings)
+    if request.param.startswith('redis'):
+        transaction_store._redis = request.getfixturevalue('fake_redis')
+    return transaction_store
+
+
+@pytest.fixture
+def redis_hash_store(fake_redis):
+    """Fixture to access a redis_hash transaction store backed by fakeredis.
+    """
+    transaction_store = epfltransactionstore.RedisHashTransactionStore({})
+    transaction_store._redis = fake_redis
+    return transaction_store
+
+
+def test_transaction_store(transaction_store):
+    """Test the ITransactionStore api of the transaction stores.
+    """
+    data = {'compo_store': {'root_node': {'cid': 'root_node'}}, 'compo_struct': ['root_node']}
+
+    assert transaction_store.load('some_tid') is None
+
+    transaction_store.save('some_tid', data)
+    assert transaction_store.load('some_tid') == data
+    assert transaction_store.load_many(['some_tid', 'other_tid']) == {'some_tid': data, 'other_tid': None}
+
+    transaction_store.touch('some_tid')
+    assert transaction_store.load('some_tid') == data
+
+    transaction_store.lock_and_save('some_tid', 'new_tid', {'compo_store': {}, 'compo_struct': []})
+    assert transaction_store.load('some_tid') == dict(data, locked=True)
+    assert transaction_store.load('new_tid') == {'compo_store': {}, 'compo_struct': []}
+
+    transaction_store.delete('some_tid')
+    assert transaction_store.load('some_tid') is None
+
+
+def test_transaction_store_selection(pyramid_req, tmpdir):
+    """The transaction store is selected once from the settings, a registered store is used by every transaction.
+    """
+    transaction = Transaction(pyramid_req, None)
+    assert isinstance(transaction.transaction_store, epfltransactionstore.MemoryTransactionStore)
+    assert Transaction(pyramid_req, None).transaction_store is transaction.transaction_store
+
+    settings = {'epfl.transaction.sqlite.path': str(tmpdir.join('transactions.sqlite'))}
+    pyramid_req.registry.registerUtility(epfltransactionstore.SQLiteTransactionStore(settings),
+                                         epfltransactionstore.ITransactionStore)
+    transaction = Transaction(pyramid_req, None)
+    transaction.set_component('root_node', {})
+    transaction.store()
+
+    reloaded_transaction = Transaction(pyramid_req, None, transaction.get_id())
+    assert isinstance(reloaded_transaction.transaction_store, epfltransactionstore.SQLiteTransactionStore)
+    assert reloaded_transaction['compo_struct'] == ['root_node']
+
+
+def test_transaction_redis_context(pyramid_req, fake_redis, monkeypatch):
+    """The redis_context transaction store still uses Transaction.redis_context if an application overrides it.
+    """
+    from pyramid import threadlocal
+
+    transaction_store = epfltransactionstore.RedisContextTransactionStore({})
+    with pytest.raises(NotImplementedError):
+        transaction_store.load('some_tid')
+
+    requests = []
+
+    @contextmanager
+    def redis_context(transaction):
+        requests.append(transaction.request)
+        yield fake_redis
+
+    monkeypatch.setattr(Transaction, 'redis_context', redis_context)
+    pyramid_req.registry.registerUtility(transaction_store, epfltransactionstore.ITransactionStore)
+    threadlocal.manager.push({'request': pyramid_req, 'registry': pyramid_req.registry})
+    try:
+        transaction = Transaction(pyramid_req, None)
+        transaction.set_component('root_node', {})
+        transaction.store()
+        assert Transaction(pyramid_req, None, transaction.get_id())['compo_struct'] == ['root_node']
+    finally:
+        threadlocal.manager.pop()
+    assert requests and set(requests) == set([pyramid_req])
+
+
+def test_store_as_new(pyramid_req, transaction_store):
+    """Storing a transaction as new keeps a locked copy of the stored state under the old transaction id.
+    """
+    pyramid_req.registry.registerUtility(transaction_store, epfltransactionstore.ITransactionStore)
+
+    transaction = Transaction(pyramid_req, None)
+    transaction.set_component('root_node', {})
+    transaction.store_as_new()
+    transaction.store()
+    assert transaction.get_id() == transaction.tid_new
+    transaction.store()
+
+    transaction = Transaction(pyramid_req, None, transaction.get_id())
+    old_tid = transaction.get_id()
+    transaction.set_component('child_node', {'ccid': 'root_node'})
+    transaction.store_as_new()
+    transaction.store()
+    assert transaction.get_id() != old_tid
+
+    old_transaction = Transaction(pyramid_req, None, old_tid)
+    assert old_transaction['locked'] is True
+    assert not old_transaction.has_component('child_node')
+
+    # A locked transaction stores its changes as new transaction again.
+    old_transaction.set_component('other_node', {'ccid': 'root_node'})
+    old_transaction.store()
+    assert old_transaction.get_id() != old_tid
+    assert 'locked' not in Transaction(pyramid_req, None, old_transaction.get_id())
+    assert not Transaction(pyramid_req, None, old_tid).has_component('other_node')
+
+
+def test_redis_hash_store(redis_hash_store, fake_redis):
+    """The redis_hash store loads compo_store entries lazily, writes only the changed fields and stores every component
+    class once per transaction.
+    """
+    from solute.epfl.core.epflcomponentbase import ComponentBase, ComponentContainerBase
+
+    data = {'route': 'some_route',
+            'compo_struct': ['root_node'],
+            'compo_store': {'root_node': {'class': (ComponentContainerBase, {}, ('root_node', None))},
+                            'a': {'class': (ComponentBase, {}, ('a', None))},
+                            'b': {'class': (ComponentBase, {}, ('b', None))}}}
+    assert redis_hash_store.save('some_tid', data) == 1
+
+    key = redis_hash_store.get_key('some_tid')
+    class_fields = [field for field in fake_redis.hkeys(key) if field.startswith('i:')]
+    assert len(class_fields) == 2
+
+    loaded = redis_hash_store.load('some_tid')
+    assert loaded.version == 1
+    assert loaded['route'] == 'some_route'
+    assert sorted(loaded['compo_store']) == ['a', 'b', 'root_node']
+    assert loaded['compo_store'].entries == {}
+    assert loaded['compo_store']['a']['class'][0] is ComponentBase
+    assert loaded['compo_store'].entries.keys() == ['a']
+
+    # Only the changed fields are written, b is left untouched in redis.
+    b_field = fake_redis.hget(key, 'c:b')
+    fake_redis.hset(key, 'c:b', 'untouched')
+    loaded['compo_store']['a']['value'] = 1
+    loaded['route'] = 'other_route'
+    del loaded['compo_store']['root_node']
+    assert redis_hash_store.save('some_tid', loaded, dirty_keys=set(['route']),
+                                 dirty_components=set(['a', 'root_node']), version=1) == 2
+    assert fake_redis.hget(key, 'c:b') == 'untouched'
+    assert not fake_redis.hexists(key, 'c:root_node')
+    assert sorted(field for field in fake_redis.hkeys(key) if field.startswith('i:')) == sorted(class_fields)
+    fake_redis.hset(key, 'c:b', b_field)
+
+    loaded = redis_hash_store.load('some_tid')
+    assert loaded['route'] == 'other_route'
+    assert loaded['compo_store']['a']['value'] == 1
+    assert loaded['compo_store']['a']['class'][0] is loaded['compo_store']['b']['class'][0]
+    assert 'root_node' not in loaded['compo_store']
+
+    # A full write drops the classes that are no longer referenced.
+    assert redis_hash_store.save('some_tid', loaded, version=2) == 3
+    assert len([field for field in fake_redis.hkeys(key) if field.startswith('i:')]) == 1
+
+
+def test_transaction_store_version(transaction_store):
+    """Every save increments the version of a transaction, saving an outdated version raises a conflict.
+    """
+    assert transaction_store.load_versioned('some_tid') == (None, 0)
+    assert transaction_store.save('some_tid', {'compo_store': {}, 'value': 1}, version=0) == 1
+    assert transaction_store.save('some_tid', {'compo_store': {}, 'value': 2}, version=1) == 2
+    assert transaction_store.load_versioned('some_tid') == ({'compo_store': {}, 'value': 2}, 2)
+
+    with pytest.raises(epfltransactionstore.TransactionConflict):
+        transaction_store.save('some_tid', {'compo_store': {}, 'value': 3}, version=1)
+    assert transaction_store.load_versioned('some_tid') == ({'compo_store': {}, 'value': 2}, 2)
+
+    assert transaction_store.save('some_tid', {'compo_store': {}, 'value': 3}) == 3
+    assert transaction_store.lock_and_save('some_tid', 'new_tid', {'compo_store': {}, 'value': 4}) == 1
+    assert transaction_store.load_versioned('some_tid') == ({'compo_store': {}, 'value': 3, 'locked': True}, 4)
+
+
+def test_concurrent_store(pyramid_req, transaction_store):
+    """Changes of concurrent requests on the same transaction are merged per top level key and component, unless the
+    conflict policy is set to fail.
+    """
+    pyramid_req.registry.registerUtility(transaction_store, epfltransactionstore.ITransactionStore)
+
+    transaction = Transaction(pyramid_req, None)
+    transaction.set_component('root_node', {})
+    transaction.set_component('child_node', {'ccid': 'root_node', 'value': 0})
+    transaction.store()
+
+    first = Transaction(pyramid_req, None, transaction.get_id())
+    second = Transaction(pyramid_req, None, transaction.get_id())
+    first.conflict_policy = second.conflict_policy = 'merge'
+    first.get_component('child_node')['value'] = 1
+    first.set_component_dirty('child_node')
+    second.set_component('other_node', {'ccid': 'root_node'})
+    second['some_key'] = 'some_value'
+    first.store()
+    second.store()
+
+    transaction = Transaction(pyramid_req, None, transaction.get_id())
+    assert transaction.get_component('child_node')['value'] == 1
+    assert transaction.get_component('root_node')['compo_struct'] == ['child_node', 'other_node']
+    assert transaction['some_key'] == 'some_value'
+    assert transaction.version == 3
+
+    first = Transaction(pyramid_req, None, transaction.get_id())
+    second = Transaction(pyramid_req, None, transaction.get_id())
+    second.conflict_policy = 'fail'
+    first['some_key'] = 'first'
+    second['some_key'] = 'second'
+    first.store()
+    with pytest.raises(epfltransactionstore.TransactionConflict):
+        second.store()
+    assert Transaction(pyramid_req, None, transaction.get_id())['some_key'] == 'first'
+
+    # By default the last request to store the transaction wins.
+    first = Transaction(pyramid_req, None, transaction.get_id())
+    second = Transaction(pyramid_req, None, transaction.get_id())
+    assert second.conflict_policy == 'overwrite'
+    first['some_key'] = 'first'
+    second['some_key'] = 'second'
+    first.store()
+    second.store()
+    assert Transaction(pyramid_req, None, transaction.get_id())['some_key'] == 'second'
+
+
+def test_concurrent_merge(pyramid_req, transaction_store):
+    """Merging concurrent changes keeps the component tree consistent: the children of a container are merged,
+    deleted subtrees stay deleted and sets of component ids are united.
+    """
+    pyramid_req.registry.registerUtility(transaction_store, epfltransactionstore.ITransactionStore)
+
+    transaction = Transaction(pyramid_req, None)
+    transaction.set_component('root_node', {})
+    transaction.set_component('box', {'ccid': 'root_node'})
+    transaction.set_component('child', {'ccid': 'box'})
+    transaction['__initialized_components__'] = {'root_node', 'box', 'child'}
+    transaction.store()
+    tid = transaction.get_id()
+
+    def concurrent():
+        first, second = Transaction(pyramid_req, None, tid), Transaction(pyramid_req, None, tid)
+        first.conflict_policy = second.conflict_policy = 'merge'
+        return first, second
+
+    def add(transaction, cid, ccid):
+        transaction.set_component(cid, {'ccid': ccid})
+        transaction['__initialized_components__'].add(cid)
+        transaction.set_dirty('__initialized_components__')
+
+    # Children added to the same container by both requests are kept, including components with the same fixed cid.
+    first, second = concurrent()
+    add(first, 'first_child', 'box')
+    add(first, 'fixed', 'box')
+    add(second, 'second_child', 'box')
+    add(second, 'fixed', 'box')
+    first.store()
+    second.store()
+    transaction = Transaction(pyramid_req, None, tid)
+    assert transaction.get_component('box')['compo_struct'] == ['child', 'second_child', 'fixed', 'first_child']
+    assert transaction['__initialized_components__'] == {'root_node', 'box', 'child', 'first_child', 'second_child',
+                                                         'fixed'}
+
+    # A deleted container stays deleted, children added to it concurrently are dropped.
+    first, second = concurrent()
+    first.del_component('box')
+    first['__initialized_components__'].difference_update(['box', 'child', 'first_child', 'second_child', 'fixed'])
+    first.set_dirty('__initialized_components__')
+    add(second, 'late_child', 'box')
+    second.get_component('child')['value'] = 1
+    second.set_component_dirty('child')
+    first.store()
+    second.store()
+    transaction = Transaction(pyramid_req, None, tid)
+    assert transaction.get_component('root_node')['compo_struct'] == []
+    for cid in ['box', 'child', 'late_child']:
+        assert not transaction.has_component(cid)
+    assert transaction['__initialized_components__'] == {'root_node'}
+
+    # A container deleted by this request is deleted with the children added to it concurrently.
+    transaction.set_component('box', {'ccid': 'root_node'})
+    transaction.store()
+    first, second = concurrent()
+    add(first, 'late_child', 'box')
+    second.del_component('box')
+    second['__initialized_components__'].discard('box')
+    second.set_dirty('__initialized_components__')
+    first.store()
+    second.store()
+    transaction = Transaction(pyramid_req, None, tid)
+    assert transaction.get_component('root_node')['compo_struct'] == []
+    assert not transaction.has_component('late_child')
+    assert transaction['__initialized_components__'] == {'root_node'}
+
+
+def test_memory_transaction_store_limits(tmpdir):
+    """The memory transaction store honours the timeout and evicts the least recently used transactions, spilling
+    them to disk if configured.
+    """
+    transaction_store = epfltransactionstore.MemoryTransactionStore({'epfl.transaction.memory.max_entries': 2})
+    for tid in ['a', 'b', 'c']:
+        transaction_store.save(tid, {'tid': tid})
+        transaction_store.load('a')
+    assert transaction_store.load('a') == {'tid': 'a'}
+    assert transaction_store.load('b') is None
+    assert transaction_store.load('c') == {'tid': 'c'}
+
+    transaction_store = epfltransactionstore.MemoryTransactionStore({'epfl.transaction.timeout': -1})
+    transaction_store.save('a', {'tid': 'a'})
+    assert transaction_store.load('a') is None
+    assert transaction_store.size == 0
+
+    transaction_store = epfltransactionstore.MemoryTransactionStore({
+        'epfl.transaction.memory.max_bytes': 1,
+        'epfl.transaction.memory.spill_path': str(tmpdir.join('spill.sqlite'))
+    })
+    transaction_store.save('a', {'tid': 'a'})
+    transaction_store.save('b', {'tid': 'b'})
+    assert transaction_store.transactions.keys() == ['b']
+    assert transaction_store.load('a') == {'tid': 'a'}
+    assert transaction_store.transactions.keys() == ['a']
+    assert transaction_store.load('b') == {'tid': 'b'}
+
+    transaction_store.delete('a')
+    transaction_store.delete('b')
+    assert transaction_store.load('a') is None
+    assert transaction_store.load('b') is None
+
+
+def test_memory_transaction_store_unpicklable(pyramid_req, tmpdir):
+    """The memory transaction store keeps transactions that can not be pickled as deep copy.
+    """
+    class LocalComponent(object):
+        pass
+
+    transaction = Transaction(pyramid_req, None)
+    transaction.set_component('root_node', {'class': LocalComponent, 'value': [1]})
+    transaction.store()
+    loaded = Transaction(pyramid_req, None, transaction.get_id())
+    assert loaded.get_component('root_node')['class'] is LocalComponent
+    loaded.get_component('root_node')['value'].append(2)
+    assert Transaction(pyramid_req, None, transaction.get_id()).get_component('root_node')['value'] == [1]
+
+    # Copies are not counted in bytes and dropped instead of being spilled.
+    transaction_store = epfltransactionstore.MemoryTransactionStore({
+        'epfl.transaction.memory.max_entries': 1,
+        'epfl.transaction.memory.spill_path': str(tmpdir.join('spill.sqlite'))
+    })
+    transaction_store.save('a', {'class': LocalComponent})
+    assert transaction_store.size == 0
+    transaction_store.save('b', {'tid': 'b'})
+    assert transaction_store.load('a') is None
+    assert transaction_store.load('b') == {'tid': 'b'}
+
+
+@pytest.mark.parametrize('compression', ['none', 'zlib', 'lz4'])
+def test_transaction_codec(compression):
+    """The transaction codec compresses payloads above the threshold and still loads plain pickles."""
+    if compression == 'lz4' and epfltransactionstore.lz4 is None:
+        pytest.skip('lz4 is not installed')
+
+    codec = epfltransactionstore.TransactionCodec({'epfl.transaction.codec.compression': compression,
+                                                   'epfl.transaction.codec.threshold': 100})
+    small, large = {'a': 1}, {'compo_store': dict([('cid_%s' % i, {'value': 'x' * 10}) for i in range(100)])}
+
+    blob = codec.encode(small)
+    assert blob.startswith(codec.magic + codec.version + 'n')
+    assert codec.decode(blob) == small
+
+    blob = codec.encode(large)
+    assert codec.decode(blob) == large
+    if compression != 'none':
+        assert blob[len(codec.magic) + 1] == codec.compressions[compression]
+        assert len(blob) < len(pickle.dumps(large, pickle.HIGHEST_PROTOCOL))
+
+    assert codec.decode_many([pickle.dumps(small), pickle.dumps(large, pickle.HIGHEST_PROTOCOL)]) == [small, large]
+
+    with pytest.raises(Exception):
+        epfltransactionstore.TransactionCodec({'epfl.transaction.codec.compression': 'unknown'})
+
+
+def test_component_class_table():
+    """Packed compo_store entries reference their class by a short id that resolves back to the class."""
+    from solute.epfl.core.epflcomponentbase import ComponentBase, ComponentContainerBase
+
+    class_table = epfltransactionstore.ComponentClassTable()
+    config = {'test': None}
+    compo_info = {'cid': 'child_node', 'config': config, 'class': (ComponentBase, config, ('child_node', None))}
+    packed = class_table.pack(compo_info)
+    assert compo_info['class'][0] is ComponentBase
+    assert packed['class'][0] == class_table.get_ref(ComponentBase)
+    assert packed['class'][1] is config
+    assert class_table.get_ref(ComponentContainerBase) != packed['class'][0]
+    assert class_table.new == set(class_table.blobs)
+
+    # A table built from the stored classes resolves the references without knowing the classes before.
+    class_table = epfltransactionstore.ComponentClassTable(class_table.blobs)
+    unpacked = class_table.unpack(pickle.loads(pickle.dumps(packed, pickle.HIGHEST_PROTOCOL)))
+    assert unpacked == compo_info
+    assert unpacked['class'][1] is unpacked['config']
+    assert not class_table.new
+    assert class_table.unpack(compo_info) is compo_info